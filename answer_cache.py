@@ -0,0 +1,132 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from hdb_question_parser import parse_question
+
+
+def normalize_question(question):
+    """
+    Lowercase a question and drop punctuation and repeated whitespace
+    """
+    return " ".join(re.sub(r"[^\w\s$.]", " ", question.lower()).split()).strip(" .")
+
+
+def _intent_key(question):
+    # questions may only share a semantic hit when they ask about the same entities
+    intent = parse_question(question)
+    return (tuple(intent['towns']), tuple(intent['flat_types']), tuple(intent['years']), intent['year_range'],
+            intent['month'], intent['statistic'], intent['measure'], intent['rank_by'])
+
+
+class AnswerCache:
+    """
+    Thread-safe LRU/TTL cache of answers keyed on the normalized question and the index version.
+    With an embed_fn, a question whose normalized embedding is within semantic_distance (cosine)
+    of a cached question about the same towns, flat types and dates reuses that answer.
+    embed_fn may return None to skip the semantic tier for a lookup.
+    """
+
+    def __init__(self, max_size=1024, ttl_seconds=3600, embed_fn=None, semantic_distance=0.05):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.embed_fn = embed_fn
+        self.semantic_distance = semantic_distance
+        self.index_version = None
+        self._entries = OrderedDict()  # normalized question -> (answer, created, embedding, intent key)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Hit/miss counters and current size
+        """
+        lookups = self.hits + self.semantic_hits + self.misses
+        return {
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            'size': len(self._entries),
+            'index_version': self.index_version,
+        }
+
+    def _check_version(self, index_version):
+        # a rebuilt index invalidates every cached answer
+        if index_version != self.index_version:
+            self._entries.clear()
+            self.index_version = index_version
+
+    def _expired(self, created):
+        return self.ttl_seconds is not None and time.monotonic() - created > self.ttl_seconds
+
+    def _lookup_exact(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[1]):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _lookup_semantic(self, embedding, intent_key):
+        candidates = [(key, entry) for key, entry in self._entries.items()
+                      if entry[2] is not None and entry[3] == intent_key and not self._expired(entry[1])]
+        if not candidates:
+            return None
+        similarities = np.stack([entry[2] for _, entry in candidates]) @ embedding
+        best = int(np.argmax(similarities))
+        if 1.0 - similarities[best] > self.semantic_distance:
+            return None
+        key, entry = candidates[best]
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def get_or_compute(self, question, index_version, compute):
+        """
+        Return the cached answer for question, or call compute() and cache its result
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self._check_version(index_version)
+            answer = self._lookup_exact(key)
+            if answer is not None:
+                self.hits += 1
+                return answer
+
+        embedding = None
+        intent_key = None
+        embeddings = self.embed_fn([key]) if self.embed_fn is not None else None
+        if embeddings is not None:
+            embedding = np.asarray(embeddings[0], dtype=np.float32)
+            intent_key = _intent_key(question)
+            with self._lock:
+                answer = self._lookup_semantic(embedding, intent_key)
+                if answer is not None:
+                    self.semantic_hits += 1
+                    return answer
+
+        with self._lock:
+            self.misses += 1
+        answer = compute()
+
+        with self._lock:
+            if index_version == self.index_version:
+                self._entries[key] = (answer, time.monotonic(), embedding, intent_key)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return answer
@@ -1,16 +1,29 @@
 import os
+import time
 import logging
-from datetime import datetime
 import streamlit as st
 import pandas as pd
 
-from get_hdb_data import load_hdb_data_from_csv
-from preprocessing_hdb_data import preprocessing_hdb_dataframe
+from hdb_data_cache import load_cleaned_hdb_data, raw_data_key
+from hdb_price_cube import HDBPriceCube, PRICE_CUBE_FILENAME
+from hdb_comps import ComparablesIndex, COMPS_FILENAME
+from compact_vector_store import CompactVectorStore, COMPACT_STORE_FOLDER
+from keyword_index import KeywordIndex, KEYWORD_INDEX_FILENAME
+from answer_cache import AnswerCache
+from query_client import QueryClient, QUERY_SERVER_URL_ENV_VAR
+from embedding import embed_texts
+from tracing import collect_spans
 from rag_setup import (
     create_rag_documents,
     setup_vector_database,
     create_simple_qa_system,
+    open_vector_database,
     ask_hdb_question,
+    stream_hdb_answer_txtgen,
+    get_index_version,
+    read_index_version,
+    VECTOR_DB_PATH,
+    TRANSACTIONS_COLLECTION_NAME,
 )
 
 # Set logging
@@ -21,36 +34,137 @@ logger = logging.getLogger(__name__)
 DATA_FOLDER = "ResaleFlatPrices/"
 OUTPUT_FOLDER = "Processed_Data/"
 SAMPLE_SIZE = 1000
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL_SECONDS = 3600
+ANSWER_CACHE_SEMANTIC_DISTANCE = 0.05  # cosine distance for reusing the answer of a rephrased question
+PRICE_CUBE_PATH = os.path.join(VECTOR_DB_PATH, PRICE_CUBE_FILENAME)
+SERVE_FROM_SNAPSHOT = True  # reuse the index and price cube written by the last build, run main.py to refresh them
+COMPACT_STORE_PATH = os.path.join(VECTOR_DB_PATH, COMPACT_STORE_FOLDER)
+SERVE_COMPACT_STORE = True  # query the memory-mapped store written by main.py --compact-store when it is current
+KEYWORD_INDEX_PATH = os.path.join(VECTOR_DB_PATH, KEYWORD_INDEX_FILENAME)
+COMPS_PATH = os.path.join(VECTOR_DB_PATH, COMPS_FILENAME)
+QUERY_SERVER_URL = os.environ.get(QUERY_SERVER_URL_ENV_VAR)  # answer through query_server.py when set
 
 # Ensure output folder exists
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+def load_snapshot():
+    """Open the prebuilt index and price cube, None when there is no complete snapshot
+    or the raw csv files changed since it was built."""
+    if not os.path.exists(PRICE_CUBE_PATH):
+        return None
+    vector_db_collection, embedding_model = open_vector_database(VECTOR_DB_PATH)
+    if vector_db_collection is None:
+        return None
+    price_cube = HDBPriceCube.load(PRICE_CUBE_PATH)
+    data_key = raw_data_key(DATA_FOLDER)
+    if price_cube.data_key is not None and data_key is not None and price_cube.data_key != data_key:
+        logger.warning(f"Csv files in {DATA_FOLDER} changed since the snapshot was built, rebuilding it")
+        return None
+    if price_cube.index_version != get_index_version(vector_db_collection):
+        logger.warning("Price cube was saved with another index version, run main.py to rebuild the snapshot")
+    compact_store = CompactVectorStore.open(COMPACT_STORE_PATH) if SERVE_COMPACT_STORE else None
+    if compact_store is not None:
+        if get_index_version(compact_store) == get_index_version(vector_db_collection):
+            vector_db_collection, embedding_model = compact_store, compact_store.embedding_model
+        else:
+            logger.warning("Compact store is older than the index, serving from Chroma")
+    return vector_db_collection, create_simple_qa_system(vector_db_collection), price_cube, embedding_model
+
+
+@st.cache_resource
+def get_drill_down_collection():
+    """Transaction documents behind a summary index built with main.py --summaries --drill-down, None without them."""
+    drill_down_collection, _ = open_vector_database(VECTOR_DB_PATH, collection_name=TRANSACTIONS_COLLECTION_NAME)
+    return drill_down_collection
+
+
 @st.cache_resource  # cache so setup runs only once
 def setup_realtor_ai():
-    """Load data, preprocess, and set up the RAG system."""
+    """Serve from the prebuilt snapshot when there is one, else load data, preprocess, and set up the RAG system.
+    Models load lazily on the first question that needs them."""
+    start = time.perf_counter()
+    if SERVE_FROM_SNAPSHOT:
+        snapshot = load_snapshot()
+        if snapshot is not None:
+            logger.info(f"RealtorAI served from snapshot, ready in {time.perf_counter() - start:.2f}s")
+            return snapshot
+
     if not os.path.exists(DATA_FOLDER):
         st.error(f"Data folder '{DATA_FOLDER}' not found.")
-        return None, None
+        return None, None, None, None
 
-    combined_hdb_df = load_hdb_data_from_csv(folder_path=DATA_FOLDER)
-    if combined_hdb_df.empty:
+    # Load the cleaned data, from the Parquet cache when the raw files are unchanged
+    cleaned_hdb_df = load_cleaned_hdb_data(DATA_FOLDER, cache_folder=OUTPUT_FOLDER)
+    if cleaned_hdb_df.empty:
         st.error("No data loaded from combined CSV files.")
-        return None, None
-
-    # Preprocess
-    cleaned_hdb_df = preprocessing_hdb_dataframe(combined_hdb_df)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    cleaned_hdb_df.to_csv(
-        os.path.join(OUTPUT_FOLDER, f"preprocessed_combined_hdb_data_{timestamp}.csv"),
-        index=False,
-    )
+        return None, None, None, None
 
     # Create RAG system
     rag_documents = create_rag_documents(cleaned_hdb_df, sample_size=SAMPLE_SIZE)
     vector_db_collection, embedding_model = setup_vector_database(rag_documents)
     qa_pipeline = create_simple_qa_system(vector_db_collection)
 
-    return vector_db_collection, qa_pipeline
+    # Exact statistics over the full cleaned data for statistical questions
+    index_version, data_key = get_index_version(vector_db_collection), raw_data_key(DATA_FOLDER)
+    price_cube = HDBPriceCube.from_dataframe(cleaned_hdb_df)
+    price_cube.save(PRICE_CUBE_PATH, index_version=index_version, data_key=data_key)
+    ComparablesIndex.from_dataframe(cleaned_hdb_df).save(COMPS_PATH, index_version=index_version, data_key=data_key)
+
+    logger.info(f"RealtorAI built from {DATA_FOLDER}, ready in {time.perf_counter() - start:.2f}s")
+    return vector_db_collection, qa_pipeline, price_cube, embedding_model
+
+
+@st.cache_resource(max_entries=1)
+def get_keyword_index(index_version):
+    """BM25 index written by main.py --keyword-index for hybrid retrieval, None unless it matches the index version."""
+    keyword_index = KeywordIndex.load(KEYWORD_INDEX_PATH)
+    if not keyword_index.count() or keyword_index.index_version != index_version:
+        return None
+    return keyword_index
+
+
+@st.cache_resource(max_entries=1)
+def get_comps_index(index_version):
+    """Comparable sales index saved with the snapshot, None when there is none.
+    Reloaded when the index version changes."""
+    comps_index = ComparablesIndex.load(COMPS_PATH)
+    if comps_index is not None and comps_index.index_version != index_version:
+        logger.warning("Comparables index was saved with another index version, run main.py to rebuild the snapshot")
+    return comps_index
+
+
+@st.cache_resource
+def get_query_client():
+    """Client of the query server at QUERY_SERVER_URL, None to answer in the app."""
+    return QueryClient(QUERY_SERVER_URL) if QUERY_SERVER_URL else None
+
+
+def answer_question(query, vector_db_collection, price_cube, comps_index, index_version):
+    """Answer through the query server when one is configured, in the app when there is none or it is down.
+    Returns (answer, the server's latency in ms or None when the app answered)."""
+    query_client = get_query_client()
+    if query_client is not None:
+        try:
+            return query_client.ask_with_latency(query)
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"Query server unavailable ({e}), answering in the app")
+    answer = ask_hdb_question(query, vector_db_collection, price_cube=price_cube,
+                              drill_down_collection=get_drill_down_collection(),
+                              keyword_index=get_keyword_index(index_version), comps_index=comps_index)
+    return answer, None
+
+
+@st.cache_resource  # one answer cache shared by all sessions
+def get_answer_cache(_embedding_model):
+    """Answer cache with a semantic tier using the index embedding model,
+    active once a retrieval question has loaded the model."""
+    return AnswerCache(
+        max_size=ANSWER_CACHE_SIZE,
+        ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+        embed_fn=lambda texts: embed_texts(texts, _embedding_model) if _embedding_model.loaded else None,
+        semantic_distance=ANSWER_CACHE_SEMANTIC_DISTANCE,
+    )
 
 
 # ----------------- STREAMLIT APP -----------------
@@ -59,15 +173,78 @@ st.title("RealtorAI - Singapore's HDB Housing Assistant")
 st.write("Ask me anything about Singapore HDB resale prices!")
 
 # Initialize system
-vector_db_collection, qa_pipeline = setup_realtor_ai()
+vector_db_collection, qa_pipeline, price_cube, embedding_model = setup_realtor_ai()
 
+# The loaded collection keeps the version it was opened with, a rebuild by main.py only shows on disk.
+# Reload the snapshot when they differ so answers cached under the old version are no longer served.
 if vector_db_collection is not None:
+    disk_index_version = read_index_version(VECTOR_DB_PATH)
+    if disk_index_version is not None and disk_index_version != get_index_version(vector_db_collection):
+        logger.info("Index was rebuilt since it was loaded, reloading the snapshot")
+        for cached_resource in (setup_realtor_ai, get_drill_down_collection):
+            cached_resource.clear()
+        vector_db_collection, qa_pipeline, price_cube, embedding_model = setup_realtor_ai()
+
+if vector_db_collection is not None:
+    index_version = get_index_version(vector_db_collection)
+    answer_cache = get_answer_cache(embedding_model)
+    comps_index = get_comps_index(index_version)
     query = st.text_input("Your question:")
+    write_answer = st.checkbox("Also write an answer with the language model (streamed as it is generated)")
     if st.button("Ask") and query.strip():
-        with st.spinner("Thinking..."):
-            answer = ask_hdb_question(query, vector_db_collection)
+        server_latencies_ms = []  # set when the query server answered rather than the cache or the app
+
+        def compute_answer():
+            answer, latency_ms = answer_question(query, vector_db_collection, price_cube, comps_index, index_version)
+            if latency_ms is not None:
+                server_latencies_ms.append(latency_ms)
+            return answer
+
+        with st.spinner("Thinking..."), collect_spans() as spans:
+            answer = answer_cache.get_or_compute(query, index_version, compute_answer)
         st.success("Answer")
         st.write(answer)
+        if write_answer:
+            st.write_stream(stream_hdb_answer_txtgen(
+                query, vector_db_collection, qa_pipeline,
+                keyword_index=get_keyword_index(index_version)))
+        with st.expander("Latency breakdown"):
+            if server_latencies_ms:
+                st.write(f"Answered by the query server ({server_latencies_ms[0]:.0f} ms).")
+            if spans:
+                # spans finish innermost first, show them in the order they started
+                st.dataframe(pd.DataFrame(sorted(spans, key=lambda record: record['span_id']))[
+                    ['name', 'depth', 'duration_ms', 'rows']])
+            elif not server_latencies_ms:
+                st.write("Answered from the answer cache.")
+
+    if comps_index is not None:
+        with st.expander("Value a flat from comparable sales"):
+            columns = st.columns(5)
+            town = columns[0].selectbox("Town", comps_index.towns)
+            flat_type = columns[1].selectbox("Flat type", comps_index.flat_types)
+            floor_area = columns[2].number_input("Floor area (sqm)", min_value=20.0, max_value=300.0, value=90.0)
+            storey = columns[3].number_input("Storey", min_value=1, max_value=50, value=8)
+            lease_year = columns[4].number_input("Lease start year", min_value=1960, max_value=2030, value=1995)
+            if st.button("Find comparable sales"):
+                start = time.perf_counter()
+                comps = comps_index.find_comparables({
+                    'town': town, 'flat_type': flat_type, 'floor_area_sqm': floor_area,
+                    'storey_range_min': storey, 'storey_range_max': storey, 'lease_commence_year': lease_year})
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                if comps is None:
+                    st.write(f"No {flat_type} sales in {town} in the data.")
+                else:
+                    st.metric(f"Estimated price in {comps['month']}", f"${comps['estimate']:,.0f}")
+                    st.write(f"Range ${comps['low']:,.0f} - ${comps['high']:,.0f}, "
+                             f"found in {elapsed_ms:.1f} ms")
+                    st.dataframe(comps['comparables'])
+
+    cache_stats = answer_cache.stats()
+    st.sidebar.subheader("Answer cache")
+    st.sidebar.write(f"Hits: {cache_stats['hits']} exact, {cache_stats['semantic_hits']} similar question")
+    st.sidebar.write(f"Misses: {cache_stats['misses']} (hit rate {cache_stats['hit_rate']:.0%})")
+    st.sidebar.write(f"Cached answers: {cache_stats['size']}")
 else:
     st.warning("RealtorAI is not initialized. Check your dataset.")
 
@@ -0,0 +1,113 @@
+"""
+Benchmark the compact memory-mapped vector store against the Chroma collection it is exported from.
+
+The documents are indexed in Chroma once and exported as float16 and int8 stores, with and without
+an IVF index. Every backend answers the same pre-embedded questions, unfiltered and with their
+metadata filters; recall@k is measured against an exact float32 search over the same embeddings.
+Run from the repository root:
+    python -m benchmarks.bench_compact_store --sample-size 100000 --questions 200
+"""
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+from benchmarks.bench_filtered_retrieval import make_questions
+from compact_vector_store import CompactVectorStore, export_collection
+from embedding import embed_texts
+from hdb_data_cache import load_cleaned_hdb_data
+from hdb_question_parser import parse_question
+from rag_setup import build_metadata_filter, create_rag_documents, setup_vector_database, INDEX_BATCH_SIZE
+
+
+def folder_megabytes(path):
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, names in os.walk(path) for name in names) / 1024 / 1024
+
+
+def run(backend, queries, wheres, top_k):
+    latencies = []
+    found = []
+    for query, where in zip(queries, wheres):
+        start = time.perf_counter()
+        results = backend.query(query_embeddings=[query.tolist()], n_results=top_k, where=where,
+                                include=["metadatas"])
+        latencies.append(time.perf_counter() - start)
+        found.append(results['ids'][0])
+    return np.array(latencies) * 1000, found
+
+
+def get_all(collection, where=None, include=()):
+    # collection.get in pages small enough for chroma
+    ids, embeddings = [], []
+    while True:
+        batch = collection.get(where=where, include=list(include), limit=INDEX_BATCH_SIZE, offset=len(ids))
+        if not batch['ids']:
+            return ids, embeddings
+        ids.extend(batch['ids'])
+        if "embeddings" in include:
+            embeddings.extend(batch['embeddings'])
+
+
+def exact_results(collection, queries, wheres, top_k):
+    # ids of the exact float32 top-k of every query among the documents its where clause selects
+    ids, embeddings = get_all(collection, include=["embeddings"])
+    rows = {doc_id: row for row, doc_id in enumerate(ids)}
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    expected = []
+    for query, where in zip(queries, wheres):
+        selected = (np.arange(len(ids)) if where is None
+                    else np.array([rows[doc_id] for doc_id in get_all(collection, where)[0]], dtype=np.int64))
+        scores = embeddings[selected] @ query
+        expected.append([ids[row] for row in selected[np.argsort(-scores)[:top_k]]])
+    return expected
+
+
+def recall(found, expected):
+    return float(np.mean([len(set(ids) & set(truth)) / max(len(truth), 1) for ids, truth in zip(found, expected)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--persist-directory", default="vector_db_bench/")
+    parser.add_argument("--sample-size", type=int, default=None, help="documents to index, default all rows")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--ivf-lists", type=int, default=256)
+    args = parser.parse_args()
+
+    cleaned_df = load_cleaned_hdb_data(args.data_folder)
+    documents = create_rag_documents(cleaned_df, sample_size=args.sample_size)
+    collection, embedding_model = setup_vector_database(documents, persist_directory=args.persist_directory)
+    questions = [question for question, _, _, _ in make_questions(cleaned_df, args.questions)]
+    queries = embed_texts(questions, embedding_model)
+
+    backends = {'chroma': collection}
+    for quantization in ('float16', 'int8'):
+        for n_lists in (0, args.ivf_lists):
+            name = f"{quantization}{'+ivf' if n_lists else ''}"
+            path = os.path.join(args.persist_directory, "compact_bench", name)
+            export_collection(collection, path, quantization=quantization, n_lists=n_lists)
+            backends[name] = CompactVectorStore.open(path, embedding_model)
+
+    chroma_mb = folder_megabytes(args.persist_directory) - folder_megabytes(os.path.join(args.persist_directory,
+                                                                                           "compact_bench"))
+    print(f"{collection.count()} documents, {len(questions)} questions, top_k={args.top_k}")
+    print(f"{'backend':>14} {'filters':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'recall@k':>9} {'size (MB)':>10}")
+    for filtered in (False, True):
+        wheres = [build_metadata_filter(parse_question(question)) if filtered else None for question in questions]
+        expected = exact_results(collection, queries, wheres, args.top_k)
+        for name, backend in backends.items():
+            run(backend, queries[:5], wheres[:5], args.top_k)  # warm up
+            latencies_ms, found = run(backend, queries, wheres, args.top_k)
+            size = chroma_mb if name == 'chroma' else folder_megabytes(backend.path)
+            print(f"{name:>14} {'yes' if filtered else 'no':>8} {np.percentile(latencies_ms, 50):>9.2f} "
+                  f"{np.percentile(latencies_ms, 95):>9.2f} {recall(found, expected):>9.3f} {size:>10.1f}")
+    shutil.rmtree(os.path.join(args.persist_directory, "compact_bench"), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
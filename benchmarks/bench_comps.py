@@ -0,0 +1,74 @@
+"""
+Benchmark the comparables engine on held-out sales.
+
+The index is built from every sale before the last --holdout-months of the data, then each held-out
+sale is valued from its own features as of its sale month. Reports query latency and the error of the
+estimate against the actual price, next to a baseline of the median price of the same town and flat
+type over the preceding year.
+Run from the repository root:
+    python -m benchmarks.bench_comps --holdout-months 6 --sales 2000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from hdb_comps import ComparablesIndex, FEATURES
+from hdb_data_cache import load_cleaned_hdb_data
+
+
+def error_row(name, estimates, prices):
+    errors = np.abs(estimates - prices) / prices
+    print(f"{name:>24} {np.mean(errors):>8.1%} {np.median(errors):>9.1%} {np.mean(errors <= 0.1):>12.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--holdout-months", type=int, default=6)
+    parser.add_argument("--sales", type=int, default=2000, help="held-out sales to value")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    cleaned_df = load_cleaned_hdb_data(args.data_folder)
+    months = cleaned_df['month'].dt.year * 12 + cleaned_df['month'].dt.month - 1
+    cutoff = months.max() - args.holdout_months
+    history, holdout = cleaned_df[months <= cutoff], cleaned_df[months > cutoff]
+    holdout = holdout.sample(n=min(args.sales, len(holdout)), random_state=42)
+
+    start = time.perf_counter()
+    comps_index = ComparablesIndex.from_dataframe(history)
+    print(f"Index of {len(comps_index)} sales built in {time.perf_counter() - start:.2f}s, "
+          f"valuing {len(holdout)} sales from the following {args.holdout_months} months")
+
+    # median price of the town and flat type over the last year of the history
+    recent = history[months[history.index] > cutoff - 12]
+    medians = recent.groupby(['town', 'flat_type'], observed=True)['resale_price'].median()
+
+    latencies_ms, estimates, baselines, prices = [], [], [], []
+    for sale in holdout.itertuples(index=False):
+        subject = {'town': sale.town, 'flat_type': sale.flat_type, 'month': sale.month,
+                   'floor_area_sqm': sale.floor_area_sqm, 'storey_range_min': sale.storey_range_min,
+                   'storey_range_max': sale.storey_range_max, 'remaining_lease': sale.remaining_lease,
+                   'lease_commence_year': sale.lease_commence_date.year}
+        subject = {key: value for key, value in subject.items() if key not in FEATURES or pd.notna(value)}
+        start = time.perf_counter()
+        result = comps_index.find_comparables(subject, k=args.k)
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+        if result is not None and (sale.town, sale.flat_type) in medians.index:
+            estimates.append(result['estimate'])
+            baselines.append(medians[(sale.town, sale.flat_type)])
+            prices.append(sale.resale_price)
+
+    print(f"query p50 {np.percentile(latencies_ms, 50):.2f} ms, p95 {np.percentile(latencies_ms, 95):.2f} ms, "
+          f"p99 {np.percentile(latencies_ms, 99):.2f} ms")
+    print(f"{'estimate':>24} {'MAPE':>8} {'median APE':>9} {'within 10%':>12}")
+    prices = np.array(prices)
+    error_row(f"comps (k={args.k})", np.array(estimates), prices)
+    error_row("town x flat type median", np.array(baselines), prices)
+    print(f"{len(prices)} sales valued")
+
+
+if __name__ == "__main__":
+    main()
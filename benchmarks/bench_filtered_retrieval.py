@@ -0,0 +1,84 @@
+"""
+Benchmark query latency and result precision of retrieval with and without metadata pre-filters.
+
+Questions are generated from the data as (town, flat type, year) combinations; a retrieved document
+is precise when its metadata matches all three. Run from the repository root:
+    python -m benchmarks.bench_filtered_retrieval --questions 200
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from hdb_data_cache import load_cleaned_hdb_data
+from hdb_question_parser import parse_question
+from rag_setup import build_metadata_filter, create_rag_documents, setup_vector_database
+
+QUESTION_TEMPLATES = [
+    "How much did {flat_type} flats in {town} sell for in {year}?",
+    "What are resale prices of {flat_type} HDB in {town} in {year}?",
+    "Show me {flat_type} transactions in {town} during {year}",
+]
+
+
+def make_questions(cleaned_df, n_questions, seed=42):
+    # (question, expected town, flat type, year) for combinations that exist in the data
+    combinations = (cleaned_df.assign(year=cleaned_df['month'].dt.year)
+                    .groupby(['town', 'flat_type', 'year'], observed=True).size().reset_index())
+    rng = random.Random(seed)
+    rows = combinations.sample(n=min(n_questions, len(combinations)), random_state=seed)
+    questions = []
+    for row in rows.itertuples(index=False):
+        flat_type = row.flat_type.title().replace(' Room', '-room')
+        question = rng.choice(QUESTION_TEMPLATES).format(flat_type=flat_type, town=row.town.title(), year=row.year)
+        questions.append((question, row.town, row.flat_type, int(row.year)))
+    return questions
+
+
+def run(collection, questions, top_k, use_filters):
+    latencies = []
+    precisions = []
+    for question, town, flat_type, year in questions:
+        where = build_metadata_filter(parse_question(question)) if use_filters else None
+        start = time.perf_counter()
+        results = collection.query(query_texts=[question], n_results=top_k, where=where)
+        latencies.append(time.perf_counter() - start)
+        metadatas = results['metadatas'][0]
+        matches = [meta['town'] == town and meta['flat_type'] == flat_type and meta['year'] == year
+                   for meta in metadatas]
+        precisions.append(sum(matches) / top_k)
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'precision_at_k': float(np.mean(precisions)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--persist-directory", default="vector_db_bench/")
+    parser.add_argument("--sample-size", type=int, default=None, help="documents to index, default all rows")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    cleaned_df = load_cleaned_hdb_data(args.data_folder)
+    documents = create_rag_documents(cleaned_df, sample_size=args.sample_size)
+    collection, _ = setup_vector_database(documents, persist_directory=args.persist_directory)
+    questions = make_questions(cleaned_df, args.questions)
+
+    # warm up the query embedding path before timing
+    collection.query(query_texts=[questions[0][0]], n_results=args.top_k)
+
+    print(f"{len(questions)} questions over {collection.count()} documents, top_k={args.top_k}")
+    print(f"{'mode':>12} {'p50 (ms)':>10} {'p95 (ms)':>10} {'precision@k':>12}")
+    for mode, use_filters in (("unfiltered", False), ("filtered", True)):
+        stats = run(collection, questions, args.top_k, use_filters)
+        print(f"{mode:>12} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} {stats['precision_at_k']:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
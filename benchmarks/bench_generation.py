@@ -0,0 +1,86 @@
+"""
+Benchmark text generation throughput and latency for written answers.
+
+Documents for every question are retrieved once and packed into prompts by token count. The prompts
+are generated with batched generate calls at each batch size, a question's latency being the time
+from when all questions are pending until its batch finishes, and then streamed one at a time, where
+the first piece arrives before the rest of the answer. Reports tokens/sec and per-question latency.
+Run from the repository root:
+    python -m benchmarks.bench_generation --questions 32 --batch-sizes 1 8 16
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.bench_filtered_retrieval import make_questions
+from generation import build_prompt, generate_texts, model_and_tokenizer, stream_text
+from hdb_data_cache import load_cleaned_hdb_data
+from rag_setup import create_rag_documents, create_simple_qa_system, retrieve_for_generation, setup_vector_database
+
+
+def latency_row(name, latencies_ms, tokens, seconds):
+    print(f"{name:>12} {len(latencies_ms):>10} {tokens / seconds:>11.1f} {np.percentile(latencies_ms, 50):>9.0f} "
+          f"{np.percentile(latencies_ms, 95):>9.0f} {np.mean(latencies_ms):>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--persist-directory", default="vector_db_bench/")
+    parser.add_argument("--sample-size", type=int, default=5000, help="documents to index")
+    parser.add_argument("--questions", type=int, default=32)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16])
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--stream-questions", type=int, default=8, help="questions answered with streaming")
+    args = parser.parse_args()
+
+    cleaned_df = load_cleaned_hdb_data(args.data_folder)
+    collection, _ = setup_vector_database(create_rag_documents(cleaned_df, sample_size=args.sample_size),
+                                          persist_directory=args.persist_directory)
+    qa_pipeline = create_simple_qa_system(collection)
+    _, tokenizer = model_and_tokenizer(qa_pipeline)
+    questions = [question for question, _, _, _ in make_questions(cleaned_df, args.questions)]
+    prompts = []
+    for question in questions:
+        documents, _ = retrieve_for_generation(question, collection, args.top_k, use_filters=True)
+        if documents:
+            prompts.append(build_prompt(question, documents, tokenizer))
+    prompt_tokens = [len(ids) for ids in tokenizer(prompts)['input_ids']]
+    generate_texts(qa_pipeline, prompts[:2], max_new_tokens=args.max_new_tokens)  # warm up
+
+    print(f"{len(prompts)} prompts, {np.mean(prompt_tokens):.0f} tokens on average "
+          f"(max {max(prompt_tokens)}), max_new_tokens={args.max_new_tokens}")
+    print(f"{'mode':>12} {'questions':>10} {'tokens/sec':>11} {'p50 (ms)':>9} {'p95 (ms)':>9} {'mean (ms)':>10}")
+    for batch_size in args.batch_sizes:
+        latencies_ms = []
+        tokens = 0
+        start = time.perf_counter()
+        for batch_start in range(0, len(prompts), batch_size):
+            batch = prompts[batch_start:batch_start + batch_size]
+            _, counts = generate_texts(qa_pipeline, batch, max_new_tokens=args.max_new_tokens, batch_size=batch_size)
+            # every answer in a batch arrives when the batch finishes
+            latencies_ms.extend([(time.perf_counter() - start) * 1000] * len(batch))
+            tokens += sum(counts)
+        latency_row(f"batch {batch_size}", latencies_ms, tokens, time.perf_counter() - start)
+
+    first_piece_ms = []
+    answer_ms = []
+    pieces = 0
+    start = time.perf_counter()
+    for prompt in prompts[:args.stream_questions]:
+        prompt_start = time.perf_counter()
+        for i, _ in enumerate(stream_text(qa_pipeline, prompt, max_new_tokens=args.max_new_tokens)):
+            if i == 0:
+                first_piece_ms.append((time.perf_counter() - prompt_start) * 1000)
+            pieces += 1
+        answer_ms.append((time.perf_counter() - prompt_start) * 1000)
+    # the streamer yields about a word per piece, so this rate counts words rather than tokens
+    latency_row("stream", answer_ms, pieces, time.perf_counter() - start)
+    print(f"stream time to first piece: p50 {np.percentile(first_piece_ms, 50):.0f} ms, "
+          f"p95 {np.percentile(first_piece_ms, 95):.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
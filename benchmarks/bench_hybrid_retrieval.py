@@ -0,0 +1,90 @@
+"""
+Benchmark vector, BM25 keyword and hybrid (reciprocal rank fusion) retrieval on labeled questions.
+
+Questions are generated from the indexed documents and labeled with the metadata a relevant
+document must match: the block and street, the street and flat type, or the town and flat type.
+Reports precision@k, MRR and latency per retriever, without metadata filters unless --filters.
+Run from the repository root:
+    python -m benchmarks.bench_hybrid_retrieval --sample-size 20000 --questions 300
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from hdb_data_cache import load_cleaned_hdb_data
+from hdb_question_parser import parse_question
+from keyword_index import KeywordIndex
+from rag_setup import build_metadata_filter, create_rag_documents, hybrid_query, setup_vector_database
+
+QUESTION_KINDS = [
+    ("block", ('block', 'street_name'), "What did flats at Block {block} {street_name} sell for?"),
+    ("street", ('street_name', 'flat_type'), "{flat_type} resale prices on {street_name}"),
+    ("town", ('town', 'flat_type'), "How much do {flat_type} flats in {town} cost?"),
+]
+
+
+def make_labeled_questions(documents, n_questions, seed=42):
+    # (kind, question, ids of the relevant documents) from the metadata of randomly picked documents
+    rng = random.Random(seed)
+    questions = []
+    for i in range(n_questions):
+        kind, fields, template = QUESTION_KINDS[i % len(QUESTION_KINDS)]
+        meta = rng.choice(documents)['metadata']
+        key = tuple(meta[field] for field in fields)
+        relevant = {doc['id'] for doc in documents if tuple(doc['metadata'][field] for field in fields) == key}
+        flat_type = meta['flat_type'].title().replace(' Room', '-room')
+        questions.append((kind, template.format(block=meta['block'], street_name=meta['street_name'].title(),
+                                                flat_type=flat_type, town=meta['town'].title()), relevant))
+    return questions
+
+
+def retrieve(retriever, question, collection, keyword_index, top_k, use_filters):
+    where = build_metadata_filter(parse_question(question)) if use_filters else None
+    if retriever == "vector":
+        return collection.query(query_texts=[question], n_results=top_k, where=where, include=[])['ids'][0]
+    if retriever == "keyword":
+        return [doc_id for doc_id, _ in keyword_index.search(question, top_k, where=where)]
+    return hybrid_query(question, collection, keyword_index, top_k, where)['ids'][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--persist-directory", default="vector_db_bench/")
+    parser.add_argument("--sample-size", type=int, default=20000, help="documents to index")
+    parser.add_argument("--questions", type=int, default=300)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--filters", action="store_true", help="apply the question's metadata filters")
+    args = parser.parse_args()
+
+    documents = create_rag_documents(load_cleaned_hdb_data(args.data_folder), sample_size=args.sample_size)
+    keyword_index = KeywordIndex()
+    start = time.perf_counter()
+    collection, _ = setup_vector_database(documents, persist_directory=args.persist_directory,
+                                          keyword_index=keyword_index)
+    print(f"{collection.count()} documents indexed in {time.perf_counter() - start:.1f}s")
+    questions = make_labeled_questions(documents, args.questions)
+    retrieve("hybrid", questions[0][1], collection, keyword_index, args.top_k, args.filters)  # warm up
+
+    print(f"{len(questions)} questions, top_k={args.top_k}, filters {'on' if args.filters else 'off'}")
+    print(f"{'retriever':>10} {'questions':>10} {'precision@k':>12} {'MRR':>7} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+    for retriever in ("vector", "keyword", "hybrid"):
+        results = {}
+        for kind, question, relevant in questions:
+            start = time.perf_counter()
+            ids = retrieve(retriever, question, collection, keyword_index, args.top_k, args.filters)
+            latency_ms = (time.perf_counter() - start) * 1000
+            hits = [doc_id in relevant for doc_id in ids]
+            reciprocal_rank = next((1 / rank for rank, hit in enumerate(hits, start=1) if hit), 0.0)
+            for group in (kind, "all"):
+                results.setdefault(group, []).append((sum(hits) / args.top_k, reciprocal_rank, latency_ms))
+        for group in [kind for kind, _, _ in QUESTION_KINDS] + ["all"]:
+            precision, reciprocal_rank, latency_ms = np.array(results[group]).T
+            print(f"{retriever:>10} {group:>10} {precision.mean():>12.3f} {reciprocal_rank.mean():>7.3f} "
+                  f"{np.percentile(latency_ms, 50):>9.2f} {np.percentile(latency_ms, 95):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark the unique-value preprocessing against the original row-wise regex passes.
+
+The loaded data is resampled to each size, both implementations are timed and their peak
+allocations measured with tracemalloc in a separate run, and the outputs are checked to be identical.
+Run from the repository root:
+    python -m benchmarks.bench_preprocessing --sizes 100000 1000000
+    python -m benchmarks.bench_preprocessing --synthetic-rows 1000000 --sizes 1000000
+"""
+import argparse
+import gc
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from benchmarks.synthetic_hdb_data import write_synthetic_csvs
+from get_hdb_data import load_hdb_data_from_csv
+from preprocessing_hdb_data import preprocessing_hdb_dataframe
+
+
+def preprocessing_hdb_dataframe_rowwise(df):
+    # the original implementation, kept here as the reference
+    clean_df = df.copy()
+    clean_df['month'] = pd.to_datetime(clean_df['month'] + '-01', format='%Y-%m-%d', errors='coerce')
+    clean_df['lease_commence_date'] = pd.to_datetime(clean_df['lease_commence_date'].astype(str) + '-01-01',
+                                                     format='%Y-%m-%d', errors='coerce')
+
+    s = clean_df['remaining_lease'].fillna('0').astype(str).str.lower()
+    years = s.str.extract(r'(\d+(?:\.\d+)?)\s*year')[0].astype(float).fillna(0)
+    months = s.str.extract(r'(\d+(?:\.\d+)?)\s*month')[0].astype(float).fillna(0)
+    only_number = pd.to_numeric(s.str.replace(r'[^\d.]', '', regex=True), errors='coerce').fillna(0)
+    total_years = years + months / 12
+    clean_df['remaining_lease'] = total_years.where(total_years != 0, only_number)
+
+    mask = clean_df['remaining_lease'].isna() & clean_df['lease_commence_date'].notna() & clean_df['month'].notna()
+    years_elapsed = (clean_df.loc[mask, 'month'] - clean_df.loc[mask, 'lease_commence_date']).dt.days / 365.25
+    clean_df.loc[mask, 'remaining_lease'] = (99 - years_elapsed).clip(lower=0)
+
+    ranges = clean_df['storey_range'].str.extract(r'(?P<min>\d+)\s*TO\s*(?P<max>\d+)', expand=True)
+    single = clean_df['storey_range'].str.extract(r'(?P<single>\d+)', expand=True)
+    clean_df['storey_range_min'] = ranges['min'].fillna(single['single']).astype(int)
+    clean_df['storey_range_max'] = ranges['max'].fillna(single['single']).astype(int)
+    return clean_df
+
+
+def measure(func, df):
+    # wall time, then peak memory allocated above the input in a second run since tracing slows pandas down
+    gc.collect()
+    start = time.perf_counter()
+    result = func(df)
+    seconds = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = func(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1024 / 1024, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--synthetic-rows", type=int, default=None,
+                        help="benchmark on this many synthetic rows instead of the data folder")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    args = parser.parse_args()
+
+    if args.synthetic_rows:
+        with tempfile.TemporaryDirectory() as data_folder:
+            write_synthetic_csvs(data_folder, args.synthetic_rows)
+            raw_df = load_hdb_data_from_csv(folder_path=data_folder)
+    else:
+        raw_df = load_hdb_data_from_csv(folder_path=args.data_folder)
+
+    print(f"{'rows':>10} {'row-wise (s)':>13} {'unique (s)':>11} {'speedup':>8} "
+          f"{'row-wise peak (MB)':>19} {'unique peak (MB)':>17}")
+    for size in args.sizes:
+        df = raw_df.sample(n=size, replace=size > len(raw_df), random_state=42).reset_index(drop=True)
+        rowwise_seconds, rowwise_mb, expected = measure(preprocessing_hdb_dataframe_rowwise, df)
+        del expected
+        unique_seconds, unique_mb, result = measure(preprocessing_hdb_dataframe, df)
+        pd.testing.assert_frame_equal(result, preprocessing_hdb_dataframe_rowwise(df))
+        print(f"{size:>10} {rowwise_seconds:>13.3f} {unique_seconds:>11.3f} {rowwise_seconds / unique_seconds:>7.1f}x "
+              f"{rowwise_mb:>19.1f} {unique_mb:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Load-test the query server on localhost at increasing concurrency.
+
+Starts query_server.py on the snapshot in --persist-directory (or uses a running server with --url),
+then for each concurrency level runs that many clients, each sending questions back to back over its
+own keep-alive connection. Reports throughput, p50/p95/p99 latency, questions rejected by backpressure
+and the mean micro-batch size. Run with --max-batch-size 1 to compare against no batching.
+Run from the repository root after main.py:
+    python -m benchmarks.bench_query_server --concurrency 1 4 16 64 --requests 500
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from hdb_question_parser import HDB_FLAT_TYPES, HDB_TOWNS
+from query_client import QueryClient
+from query_server import MAX_BATCH_DELAY_MS, MAX_BATCH_SIZE, MAX_QUEUE_SIZE, SERVER_PORT
+from rag_setup import VECTOR_DB_PATH
+
+QUESTION_TEMPLATES = [
+    "Show me recent {flat_type} resale transactions in {town}",
+    "Which {flat_type} flats in {town} were sold recently?",
+    "What is the average resale price of {flat_type} flats in {town}?",
+]
+
+
+def make_questions(n_questions, seed=42):
+    rng = random.Random(seed)
+    return [rng.choice(QUESTION_TEMPLATES).format(town=rng.choice(HDB_TOWNS).title(),
+                                                  flat_type=rng.choice(HDB_FLAT_TYPES[1:5]).title())
+            for _ in range(n_questions)]
+
+
+async def post(reader, writer, path, payload):
+    # one request over a keep-alive connection, returning the status code
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def run_level(host, port, questions, concurrency, n_requests):
+    # concurrency clients share n_requests, returning latencies (ms) of answered requests and rejections
+    latencies_ms = []
+    rejected = 0
+    next_request = 0
+
+    async def client():
+        nonlocal next_request, rejected
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while next_request < n_requests:
+                question = questions[next_request % len(questions)]
+                next_request += 1
+                start = time.perf_counter()
+                status = await post(reader, writer, "/ask", {'question': question})
+                if status == 200:
+                    latencies_ms.append((time.perf_counter() - start) * 1000)
+                elif status == 503:
+                    rejected += 1
+                else:
+                    raise RuntimeError(f"Query server returned {status}")
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return np.array(latencies_ms), rejected, time.perf_counter() - start
+
+
+def wait_for_server(query_client, server, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError("Query server exited during startup")
+        try:
+            return query_client.health()
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("Query server did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="running query server, by default one is started")
+    parser.add_argument("--persist-directory", default=VECTOR_DB_PATH)
+    parser.add_argument("--port", type=int, default=SERVER_PORT + 1)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-batch-delay-ms", type=float, default=MAX_BATCH_DELAY_MS)
+    parser.add_argument("--max-queue-size", type=int, default=MAX_QUEUE_SIZE)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        url = f"http://127.0.0.1:{args.port}"
+        server = subprocess.Popen([sys.executable, "query_server.py", "--port", str(args.port),
+                                   "--persist-directory", args.persist_directory,
+                                   "--max-batch-size", str(args.max_batch_size),
+                                   "--max-batch-delay-ms", str(args.max_batch_delay_ms),
+                                   "--max-queue-size", str(args.max_queue_size)])
+    query_client = QueryClient(url)
+    try:
+        health = wait_for_server(query_client, server)
+        questions = make_questions(max(args.requests, 200))
+        for question in questions[:20]:  # warm up
+            query_client.ask(question)
+        print(f"Serving {health['documents']} documents at {url}, {args.requests} requests per level")
+        print(f"{'clients':>8} {'answered':>9} {'rejected':>9} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} "
+              f"{'p99 (ms)':>9} {'batch size':>11}")
+        for concurrency in args.concurrency:
+            before = query_client.health()
+            latencies_ms, rejected, seconds = asyncio.run(
+                run_level(query_client.host, query_client.port, questions, concurrency, args.requests))
+            after = query_client.health()
+            batches = after['batches'] - before['batches']
+            batch_size = (after['answered'] - before['answered']) / batches if batches else 0.0
+            percentiles = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else [np.nan] * 3
+            print(f"{concurrency:>8} {len(latencies_ms):>9} {rejected:>9} {len(latencies_ms) / seconds:>8.1f} "
+                  f"{percentiles[0]:>9.2f} {percentiles[1]:>9.2f} {percentiles[2]:>9.2f} {batch_size:>11.1f}")
+    finally:
+        query_client.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
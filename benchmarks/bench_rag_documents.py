@@ -0,0 +1,92 @@
+"""
+Benchmark the columnar RAG document builder against the original iterrows loop.
+
+Run from the repository root:
+    python -m benchmarks.bench_rag_documents --sizes 1000 100000 1000000
+"""
+import argparse
+import time
+
+from get_hdb_data import load_hdb_data_from_csv
+from preprocessing_hdb_data import preprocessing_hdb_dataframe
+from rag_setup import iter_rag_document_batches
+
+
+def create_rag_documents_iterrows(df_sample):
+    # the original per-row implementation, kept here as the reference
+    documents = []
+    for idx, row in df_sample.iterrows():
+        doc_text= f"""
+        {row['flat_type']} HDB flat in {row['town']}:
+        - Location: Block {row['block']}, {row['street_name']}, {row['town']}
+        - Size: {row['floor_area_sqm']} square meters
+        - Floor level: {row['storey_range']} (floors {row['storey_range_min']} to {row['storey_range_max']})
+        - Building age: Built in {row['lease_commence_date'].year}, {row['remaining_lease']:.0f} years lease remaining
+        - Price: Sold for ${row['resale_price']:,.0f} SGD in {row['month'].strftime('%B %Y')}
+        - Model: flat model {row['flat_model']}  
+        - Price per sqm: ${row['resale_price']/row['floor_area_sqm']:,.0f} per square meter
+            """.strip()
+
+        documents.append({
+            'id': f"hdb_{idx}",
+            'text': doc_text,
+            'metadata': {
+                'town': row['town'],
+                'flat_type': row['flat_type'],
+                'price': row['resale_price'],
+                'sold_date': row['month'].strftime('%Y-%m'),
+                'remaining_lease': row['remaining_lease']
+            }
+        })
+    return documents
+
+
+def create_rag_documents_columnar(df_sample):
+    documents = []
+    for batch in iter_rag_document_batches(df_sample):
+        documents.extend(batch)
+    return documents
+
+
+def same_documents(reference_docs, columnar_docs):
+    # the reference predates the numeric date fields, so only its own metadata keys are compared
+    return len(reference_docs) == len(columnar_docs) and all(
+        reference['id'] == doc['id'] and reference['text'] == doc['text']
+        and all(doc['metadata'].get(key) == value for key, value in reference['metadata'].items())
+        for reference, doc in zip(reference_docs, columnar_docs))
+
+
+def time_call(func, df):
+    start = time.perf_counter()
+    documents = func(df)
+    return time.perf_counter() - start, documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--skip-iterrows-above", type=int, default=None,
+                        help="only time the columnar builder for sizes larger than this")
+    args = parser.parse_args()
+
+    cleaned_df = preprocessing_hdb_dataframe(load_hdb_data_from_csv(folder_path=args.data_folder))
+
+    print(f"{'rows':>10} {'iterrows (s)':>14} {'columnar (s)':>14} {'speedup':>9}")
+    for size in args.sizes:
+        # resample the real data to reach the requested size
+        df = cleaned_df.sample(n=size, replace=size > len(cleaned_df), random_state=42).reset_index(drop=True)
+
+        columnar_seconds, columnar_docs = time_call(create_rag_documents_columnar, df)
+        if args.skip_iterrows_above is not None and size > args.skip_iterrows_above:
+            print(f"{size:>10} {'-':>14} {columnar_seconds:>14.3f} {'-':>9}")
+            continue
+
+        iterrows_seconds, iterrows_docs = time_call(create_rag_documents_iterrows, df)
+        if not same_documents(iterrows_docs, columnar_docs):
+            raise AssertionError(f"columnar documents differ from the iterrows reference at {size} rows")
+        print(f"{size:>10} {iterrows_seconds:>14.3f} {columnar_seconds:>14.3f} {iterrows_seconds / columnar_seconds:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
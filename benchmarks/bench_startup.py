@@ -0,0 +1,107 @@
+"""
+Benchmark import time and time-to-first-answer when serving from a prebuilt snapshot.
+
+Each measurement runs in a fresh interpreter. "lazy" is the default serving path (models load on
+first use), "eager" imports sentence_transformers and transformers and loads both models up front
+like the app used to. A snapshot is built from synthetic data when --snapshot does not hold one.
+Run from the repository root:
+    python -m benchmarks.bench_startup --snapshot vector_db_bench/ --runs 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+CUBE_QUESTION = "What is the average resale price of 4 room flats in Tampines in 2016?"
+RETRIEVAL_QUESTION = "Show me recent 4 room resale transactions near Tampines St 21"
+
+
+def build_snapshot(snapshot, n_rows):
+    # synthetic data -> cleaned frame -> index and price cube in the snapshot folder
+    import tempfile
+    from benchmarks.synthetic_hdb_data import write_synthetic_csvs
+    from get_hdb_data import load_hdb_data_from_csv
+    from hdb_price_cube import HDBPriceCube, PRICE_CUBE_FILENAME
+    from preprocessing_hdb_data import preprocessing_hdb_dataframe
+    from rag_setup import create_rag_documents, setup_vector_database
+
+    with tempfile.TemporaryDirectory() as data_folder:
+        write_synthetic_csvs(data_folder, n_rows)
+        cleaned_df = preprocessing_hdb_dataframe(load_hdb_data_from_csv(data_folder))
+    setup_vector_database(create_rag_documents(cleaned_df, sample_size=None), persist_directory=snapshot)
+    HDBPriceCube.from_dataframe(cleaned_df).save(os.path.join(snapshot, PRICE_CUBE_FILENAME))
+
+
+def child(snapshot, mode):
+    # one cold start, timings printed as a JSON line for the parent
+    timings = {}
+    start = time.perf_counter()
+    if mode == "eager":
+        import sentence_transformers  # noqa: F401
+        try:
+            import transformers  # noqa: F401
+        except ImportError:
+            pass
+    from hdb_price_cube import HDBPriceCube, PRICE_CUBE_FILENAME
+    from rag_setup import ask_hdb_question, create_simple_qa_system, open_vector_database
+    timings['import_seconds'] = time.perf_counter() - start
+
+    collection, embedding_model = open_vector_database(snapshot)
+    price_cube = HDBPriceCube.load(os.path.join(snapshot, PRICE_CUBE_FILENAME))
+    qa_pipeline = create_simple_qa_system(collection)
+    if mode == "eager":
+        embedding_model.load()
+        try:
+            qa_pipeline.load()
+        except (ImportError, TypeError):
+            timings['qa_pipeline'] = "unavailable"
+    timings['ready_seconds'] = time.perf_counter() - start
+
+    ask_hdb_question(CUBE_QUESTION, collection, price_cube=price_cube)
+    timings['first_cube_answer_seconds'] = time.perf_counter() - start
+    ask_hdb_question(RETRIEVAL_QUESTION, collection, price_cube=price_cube)
+    timings['first_retrieval_answer_seconds'] = time.perf_counter() - start
+    print(json.dumps(timings))
+
+
+def measure(snapshot, mode, runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_startup", "--child", mode,
+                                 "--snapshot", snapshot], capture_output=True, text=True, check=True)
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    keys = [key for key in samples[0] if key.endswith('_seconds')]
+    return {key: float(np.median([sample[key] for sample in samples])) for key in keys}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--snapshot", default="vector_db_bench/")
+    parser.add_argument("--rows", type=int, default=5000, help="synthetic rows when a snapshot has to be built")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts per mode, the median is reported")
+    parser.add_argument("--child", choices=["lazy", "eager"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.snapshot, args.child)
+        return
+
+    from hdb_price_cube import PRICE_CUBE_FILENAME
+    if not os.path.exists(os.path.join(args.snapshot, PRICE_CUBE_FILENAME)):
+        print(f"Building a snapshot from {args.rows} synthetic rows in {args.snapshot}")
+        build_snapshot(args.snapshot, args.rows)
+
+    print(f"median of {args.runs} cold starts, seconds since the first import")
+    print(f"{'mode':>6} {'imports':>9} {'ready':>9} {'1st cube':>9} {'1st retrieval':>14}")
+    for mode in ("eager", "lazy"):
+        stats = measure(args.snapshot, mode, args.runs)
+        print(f"{mode:>6} {stats['import_seconds']:>9.2f} {stats['ready_seconds']:>9.2f} "
+              f"{stats['first_cube_answer_seconds']:>9.2f} {stats['first_retrieval_answer_seconds']:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark summary documents against one document per transaction.
+
+Both document sets are built from the same cleaned data and indexed into separate folders;
+the script reports document counts, build and index time, query latency and how many
+transactions the top-k retrieved documents stand for. Run from the repository root:
+    python -m benchmarks.bench_summary_documents --questions 200
+    python -m benchmarks.bench_summary_documents --transaction-rows 20000
+"""
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+from benchmarks.bench_filtered_retrieval import make_questions
+from hdb_data_cache import load_cleaned_hdb_data
+from hdb_question_parser import parse_question
+from hdb_summary_documents import create_summary_documents
+from rag_setup import build_metadata_filter, create_rag_documents, setup_vector_database
+
+
+def build(name, make_documents, persist_directory):
+    # fresh index for one document set, timed separately from building the documents
+    shutil.rmtree(persist_directory, ignore_errors=True)
+    start = time.perf_counter()
+    documents = make_documents()
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    collection, _ = setup_vector_database(documents, persist_directory=persist_directory)
+    index_seconds = time.perf_counter() - start
+    return collection, {'name': name, 'documents': len(documents), 'build_s': build_seconds,
+                        'index_s': index_seconds}
+
+
+def run(collection, questions, top_k):
+    latencies = []
+    covered = []
+    for question, _, _, _ in questions:
+        where = build_metadata_filter(parse_question(question))
+        start = time.perf_counter()
+        results = collection.query(query_texts=[question], n_results=top_k, where=where)
+        latencies.append(time.perf_counter() - start)
+        covered.append(sum(meta.get('count', 1) for meta in results['metadatas'][0]))
+    latencies_ms = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies_ms, 50)), 'p95_ms': float(np.percentile(latencies_ms, 95)),
+            'covered': float(np.median(covered))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-folder", default="ResaleFlatPrices/")
+    parser.add_argument("--persist-directory", default="vector_db_bench/")
+    parser.add_argument("--transaction-rows", type=int, default=None,
+                        help="index only this many sampled transactions, default all rows")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    cleaned_df = load_cleaned_hdb_data(args.data_folder)
+    questions = make_questions(cleaned_df, args.questions)
+    variants = [
+        ("transactions", lambda: create_rag_documents(cleaned_df, sample_size=args.transaction_rows)),
+        ("summaries", lambda: create_summary_documents(cleaned_df)),
+    ]
+
+    print(f"{len(cleaned_df)} transactions, {len(questions)} filtered questions, top_k={args.top_k}")
+    print(f"{'documents':>13} {'count':>8} {'build (s)':>10} {'index (s)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} "
+          f"{'sales/answer':>13}")
+    for name, make_documents in variants:
+        collection, stats = build(name, make_documents, os.path.join(args.persist_directory, name))
+        collection.query(query_texts=[questions[0][0]], n_results=args.top_k)  # warm up before timing
+        stats.update(run(collection, questions, args.top_k))
+        print(f"{name:>13} {stats['documents']:>8} {stats['build_s']:>10.2f} {stats['index_s']:>10.2f} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['covered']:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
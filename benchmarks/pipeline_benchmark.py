@@ -0,0 +1,152 @@
+"""
+Benchmark every pipeline stage on synthetic HDB data and write the results as JSON.
+
+For each dataset size the harness writes synthetic csv files, then times load_hdb_data_from_csv,
+preprocessing_hdb_dataframe, create_rag_documents, setup_vector_database and ask_hdb_question,
+recording wall time, rows/sec and peak RSS per stage plus p50/p95/p99 query latency.
+Run from the repository root:
+    python -m benchmarks.pipeline_benchmark --rows 10000 100000 1000000 --output bench_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic_hdb_data import write_synthetic_csvs
+from get_hdb_data import load_hdb_data_from_csv
+from preprocessing_hdb_data import preprocessing_hdb_dataframe
+from tracing import PeakRSSMonitor
+
+QUESTION_TEMPLATES = [
+    "How much do {flat_type} flats cost in {town}?",
+    "What did {flat_type} HDB flats in {town} sell for in {year}?",
+    "Show me recent {flat_type} resale transactions near {street_name}",
+]
+
+
+def run_stage(name, rows, func, *args, **kwargs):
+    """
+    Run one stage and return (result, metrics)
+    """
+    with PeakRSSMonitor() as monitor:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    metrics = {
+        'stage': name,
+        'rows': rows,
+        'wall_seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': round(monitor.peak_bytes / 1024 / 1024, 1),
+    }
+    print(f"  {name:<28} {seconds:>9.3f}s {metrics['rows_per_second'] or 0:>14,.0f} rows/s "
+          f"{metrics['peak_rss_mb']:>9.1f} MB peak RSS")
+    return result, metrics
+
+
+def make_questions(cleaned_df, n_questions, seed=42):
+    rows = cleaned_df.sample(n=n_questions, replace=len(cleaned_df) < n_questions, random_state=seed)
+    rng = np.random.default_rng(seed)
+    return [
+        QUESTION_TEMPLATES[rng.integers(len(QUESTION_TEMPLATES))].format(
+            flat_type=str(row.flat_type).lower(), town=str(row.town).title(),
+            year=row.month.year, street_name=str(row.street_name).title())
+        for row in rows.itertuples(index=False)
+    ]
+
+
+def latency_percentiles(latencies_seconds):
+    latencies_ms = np.array(latencies_seconds) * 1000
+    return {
+        'count': len(latencies_ms),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies_ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 3),
+        'mean_ms': round(float(latencies_ms.mean()), 3),
+    }
+
+
+def benchmark_size(n_rows, work_folder, index_rows, n_queries, skip_index):
+    print(f"\n{n_rows:,} rows")
+    data_folder = os.path.join(work_folder, f"csv_{n_rows}")
+    write_synthetic_csvs(data_folder, n_rows)
+
+    stages = []
+    combined_df, metrics = run_stage('load_hdb_data_from_csv', n_rows, load_hdb_data_from_csv, folder_path=data_folder)
+    stages.append(metrics)
+    cleaned_df, metrics = run_stage('preprocessing_hdb_dataframe', n_rows, preprocessing_hdb_dataframe, combined_df)
+    stages.append(metrics)
+    del combined_df
+
+    # documents and index are built from the same capped sample so the embedding stage stays tractable
+    from rag_setup import create_rag_documents
+    document_rows = min(index_rows, len(cleaned_df))
+    documents, metrics = run_stage('create_rag_documents', document_rows, create_rag_documents,
+                                   cleaned_df, sample_size=document_rows)
+    stages.append(metrics)
+
+    result = {'rows': n_rows, 'index_rows': document_rows, 'stages': stages}
+    if skip_index:
+        return result
+
+    from rag_setup import ask_hdb_question, setup_vector_database
+    (collection, _), metrics = run_stage('setup_vector_database', document_rows, setup_vector_database, documents,
+                                         persist_directory=os.path.join(work_folder, f"vector_db_{n_rows}"))
+    stages.append(metrics)
+
+    questions = make_questions(cleaned_df, n_queries)
+    ask_hdb_question(questions[0], collection)  # warm-up
+    latencies = []
+    with PeakRSSMonitor() as monitor:
+        for question in questions:
+            start = time.perf_counter()
+            ask_hdb_question(question, collection)
+            latencies.append(time.perf_counter() - start)
+    result['query_latency'] = {**latency_percentiles(latencies),
+                               'peak_rss_mb': round(monitor.peak_bytes / 1024 / 1024, 1)}
+    print(f"  {'ask_hdb_question':<28} p50 {result['query_latency']['p50_ms']:.2f} ms, "
+          f"p95 {result['query_latency']['p95_ms']:.2f} ms, p99 {result['query_latency']['p99_ms']:.2f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="synthetic dataset sizes, from 10K up to 5M rows")
+    parser.add_argument("--index-rows", type=int, default=10000,
+                        help="documents built and indexed per size (embedding dominates above this)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--skip-index", action="store_true", help="only benchmark load, preprocessing and documents")
+    parser.add_argument("--work-folder", default=None, help="where synthetic csvs and indexes go, default a temp dir")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix="realtorai_bench_")
+    try:
+        results = [benchmark_size(n_rows, work_folder, args.index_rows, args.queries, args.skip_index)
+                   for n_rows in args.rows]
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
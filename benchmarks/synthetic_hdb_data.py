@@ -0,0 +1,144 @@
+"""
+Synthetic HDB resale data in the layout of the data.gov.sg csv files.
+
+Rows are split into the same registration periods as the published files, each with the column set
+of its period: no remaining_lease before 2015, whole years ("70") in 2015-2016 and
+"61 years 04 months" / "61 years" strings from 2017. Run from the repository root:
+    python -m benchmarks.synthetic_hdb_data --rows 1000000 --output-folder synthetic_data/
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from hdb_question_parser import HDB_TOWNS
+
+# (file label, first month, last month, has remaining_lease)
+PERIODS = [
+    ("Approval Date), 1990 - 1999", "1990-01", "1999-12", False),
+    ("Approval Date), 2000 - Feb 2012", "2000-01", "2012-02", False),
+    ("Registration Date), From Mar 2012 to Dec 2014", "2012-03", "2014-12", False),
+    ("Registration Date), From Jan 2015 to Dec 2016", "2015-01", "2016-12", True),
+    ("Registration Date), From Jan 2017 onwards", "2017-01", "2024-12", True),
+]
+
+# flat type: (share of transactions, mean floor area, sd floor area, base price in 1990)
+FLAT_TYPES = {
+    '1 ROOM': (0.002, 31, 2, 25000),
+    '2 ROOM': (0.015, 45, 3, 45000),
+    '3 ROOM': (0.30, 68, 6, 70000),
+    '4 ROOM': (0.38, 95, 6, 110000),
+    '5 ROOM': (0.22, 118, 7, 150000),
+    'EXECUTIVE': (0.08, 145, 8, 190000),
+    'MULTI-GENERATION': (0.003, 160, 6, 230000),
+}
+FLAT_MODELS = ['Improved', 'New Generation', 'Model A', 'Standard', 'Simplified', 'Premium Apartment',
+               'Maisonette', 'Apartment', 'Model A2', 'DBSS', 'Adjoined flat', 'Terrace', 'Type S1']
+STREET_SUFFIXES = ['AVE 1', 'AVE 2', 'AVE 3', 'AVE 4', 'AVE 5', 'ST 11', 'ST 21', 'ST 31', 'DR', 'RD', 'CTRL']
+COLUMNS = ['month', 'town', 'flat_type', 'block', 'street_name', 'storey_range', 'floor_area_sqm', 'flat_model',
+           'lease_commence_date', 'remaining_lease', 'resale_price']
+
+
+def _storey_ranges(rng, n, five_floor_bands):
+    # older files use 5-floor bands ("01 TO 05"), newer ones 3-floor bands ("01 TO 03")
+    band = np.where(five_floor_bands, 5, 3)
+    index = np.minimum(rng.geometric(0.25, size=n) - 1, 15)
+    low = index * band + 1
+    high = low + band - 1
+    return pd.Series(low).map('{:02d}'.format) + " TO " + pd.Series(high).map('{:02d}'.format)
+
+
+def _remaining_lease_text(years_left, string_format):
+    whole_years = np.floor(years_left).astype(int)
+    months = np.floor((years_left - whole_years) * 12).astype(int)
+    with_months = pd.Series(whole_years).astype(str) + " years " + pd.Series(months).map('{:02d}'.format) + " months"
+    years_only = pd.Series(whole_years).astype(str) + " years"
+    text = with_months.where(months > 0, years_only)
+    return text.where(string_format, pd.Series(whole_years).astype(str)).to_numpy()
+
+
+def generate_hdb_resale_frame(n_rows, first_month="1990-01", last_month="2024-12", seed=42):
+    """
+    Synthetic transactions between first_month and last_month with realistic prices and attributes
+    """
+    rng = np.random.default_rng(seed)
+    months = pd.period_range(first_month, last_month, freq="M")
+    sold = months[np.sort(rng.integers(0, len(months), size=n_rows))]
+    sold_year = sold.year.to_numpy()
+
+    flat_types = list(FLAT_TYPES)
+    shares = np.array([FLAT_TYPES[flat_type][0] for flat_type in flat_types])
+    flat_type_index = rng.choice(len(flat_types), size=n_rows, p=shares / shares.sum())
+    mean_area = np.array([FLAT_TYPES[flat_type][1] for flat_type in flat_types])[flat_type_index]
+    sd_area = np.array([FLAT_TYPES[flat_type][2] for flat_type in flat_types])[flat_type_index]
+    floor_area = np.round(rng.normal(mean_area, sd_area), 0)
+    # a few areas carry a decimal like the published data
+    floor_area = np.where(rng.random(n_rows) < 0.002, floor_area + 0.1, floor_area)
+
+    town_index = rng.integers(0, len(HDB_TOWNS), size=n_rows)
+    town_factor = rng.uniform(0.8, 1.35, size=len(HDB_TOWNS))[town_index]
+    lease_commence = np.minimum(sold_year - rng.integers(0, 45, size=n_rows), sold_year).clip(1966)
+    years_left = np.clip(99 - (sold_year - lease_commence) - rng.random(n_rows), 1, 99)
+
+    base_price = np.array([FLAT_TYPES[flat_type][3] for flat_type in flat_types])[flat_type_index]
+    trend = 1.045 ** (sold_year - 1990)
+    price = base_price * town_factor * trend * (floor_area / mean_area) * (0.6 + 0.4 * years_left / 99)
+    price = np.round(price * rng.lognormal(0, 0.08, size=n_rows), -3)
+    # some sellers ask for "lucky" prices with cents
+    price = np.where(rng.random(n_rows) < 0.0005, price + 888.88, price)
+
+    towns = np.array(HDB_TOWNS, dtype=object)[town_index]
+    street_words = pd.Series(towns).str.split('/').str[0].to_numpy()
+    suffixes = np.array(STREET_SUFFIXES, dtype=object)[rng.integers(0, len(STREET_SUFFIXES), size=n_rows)]
+
+    return pd.DataFrame({
+        'month': sold.strftime('%Y-%m'),
+        'town': towns,
+        'flat_type': np.array(flat_types, dtype=object)[flat_type_index],
+        'block': pd.Series(rng.integers(1, 990, size=n_rows)).astype(str)
+                 + np.where(rng.random(n_rows) < 0.1, 'A', ''),
+        'street_name': street_words + " " + suffixes,
+        'storey_range': _storey_ranges(rng, n_rows, sold_year < 2012).to_numpy(),
+        'floor_area_sqm': floor_area,
+        'flat_model': np.array(FLAT_MODELS, dtype=object)[rng.integers(0, len(FLAT_MODELS), size=n_rows)],
+        'lease_commence_date': lease_commence,
+        'years_left': years_left,
+        'resale_price': price,
+    })
+
+
+def write_synthetic_csvs(output_folder, n_rows, seed=42):
+    """
+    Write n_rows synthetic transactions to output_folder split into the published period files.
+    Returns the written file paths.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    df = generate_hdb_resale_frame(n_rows, PERIODS[0][1], PERIODS[-1][2], seed=seed)
+    paths = []
+    for label, first_month, last_month, has_remaining_lease in PERIODS:
+        part = df[(df['month'] >= first_month) & (df['month'] <= last_month)]
+        if part.empty:
+            continue
+        columns = [column for column in COLUMNS if column != 'remaining_lease' or has_remaining_lease]
+        part = part.assign(remaining_lease=_remaining_lease_text(part['years_left'].to_numpy(),
+                                                                 (part['month'] >= "2017-01").to_numpy()))
+        path = os.path.join(output_folder, f"Resale Flat Prices (Based on {label}.csv")
+        part[columns].to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--output-folder", default="synthetic_data/")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    for path in write_synthetic_csvs(args.output_folder, args.rows, seed=args.seed):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+import numpy as np
+import pandas as pd
+
+from embedding import embed_texts, LazySentenceTransformer, EMBEDDING_BATCH_SIZE
+from rag_setup import INDEX_BATCH_SIZE, EMBEDDING_MODEL_NAME
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+COMPACT_STORE_FOLDER = "compact_store"  # inside the snapshot folder, next to the Chroma index and the price cube
+STORE_FILENAME = "store.json"
+QUANTIZATIONS = ('float16', 'int8')
+SEARCH_BLOCK_ROWS = 65536  # rows dequantized to float32 at a time while scoring
+DEFAULT_IVF_PROBES = 8
+EXACT_SEARCH_ROWS = 20000  # fewer candidate rows than this are always scored exactly, even with an IVF index
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+
+
+def _quantize(vectors, quantization):
+    # float16 keeps vectors as they are, int8 stores each vector scaled to [-127, 127] plus its scale
+    if quantization == 'float16':
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def _write_blob(folder, name, texts):
+    # utf-8 strings back to back plus their offsets, so a single string is read without loading the rest
+    encoded = [text.encode("utf-8") for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    np.save(os.path.join(folder, f"{name}_offsets.npy"), offsets)
+    np.save(os.path.join(folder, f"{name}.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+def _metadata_columns(metadatas):
+    # one array per metadata key: strings as codes into a category list, numbers and booleans as they are,
+    # with a presence mask when some documents lack the key
+    columns = []
+    arrays = []
+    for key in dict.fromkeys(key for meta in metadatas for key in meta):
+        values = pd.Series([meta.get(key) for meta in metadatas], dtype=object)
+        present = values.notna().to_numpy()
+        kinds = {type(value) for value in values[present]}
+        spec = {'name': key, 'has_missing': not present.all()}
+        if kinds <= {str}:
+            codes, categories = pd.factorize(values)
+            spec.update(kind='category', categories=categories.tolist())
+            array = codes.astype(np.int32)
+        elif kinds <= {bool}:
+            spec['kind'] = 'bool'
+            array = values.fillna(False).to_numpy(dtype=bool)
+        elif kinds <= {int}:
+            spec['kind'] = 'int'
+            array = values.fillna(0).to_numpy(dtype=np.int64)
+        else:
+            spec['kind'] = 'float'
+            array = values.astype(float).fillna(0).to_numpy(dtype=np.float64)
+        columns.append(spec)
+        arrays.append((array, present))
+    return columns, arrays
+
+
+def _condition_mask(columns, count, field, condition):
+    # rows matching one field condition, {'field': value} or {'field': {'$op': value}}
+    if field not in columns:
+        return np.zeros(count, dtype=bool)
+    kind, values, present, category_codes = columns[field]
+    if not isinstance(condition, dict):
+        condition = {'$eq': condition}
+    mask = np.ones(count, dtype=bool) if present is None else np.array(present, dtype=bool)
+    for operator, operand in condition.items():
+        if kind == 'category':
+            if operator not in ('$eq', '$ne', '$in', '$nin'):
+                raise ValueError(f"{operator} is not supported on string field {field}")
+            operand = ([category_codes.get(value, -2) for value in operand] if operator in ('$in', '$nin')
+                       else category_codes.get(operand, -2))
+        if operator == '$eq':
+            mask &= values == operand
+        elif operator == '$ne':
+            mask &= values != operand
+        elif operator == '$in':
+            mask &= np.isin(values, operand)
+        elif operator == '$nin':
+            mask &= ~np.isin(values, operand)
+        elif operator == '$gt':
+            mask &= values > operand
+        elif operator == '$gte':
+            mask &= values >= operand
+        elif operator == '$lt':
+            mask &= values < operand
+        elif operator == '$lte':
+            mask &= values <= operand
+        else:
+            raise ValueError(f"Unsupported where operator {operator}")
+    return mask
+
+
+def where_mask(where, columns, count):
+    """
+    Boolean mask of the count rows a Chroma style where clause selects. columns maps each metadata field
+    to (kind, values, present, category_codes): kind 'category' for strings stored as codes into
+    category_codes, values an array of count rows and present a mask of rows having the field or None.
+    """
+    mask = np.ones(count, dtype=bool)
+    for key, condition in where.items():
+        if key == '$and':
+            for clause in condition:
+                mask &= where_mask(clause, columns, count)
+        elif key == '$or':
+            mask &= np.logical_or.reduce([where_mask(clause, columns, count) for clause in condition])
+        else:
+            mask &= _condition_mask(columns, count, key, condition)
+    return mask
+
+
+def _spherical_kmeans(vectors, n_lists, seed=42):
+    # centroids of unit vectors by inner product, trained on a sample and refined for a few rounds
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=n_lists) == 0
+        sums[empty] = sample[rng.choice(sample_size, size=empty.sum())]  # reseed lists that lost all rows
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids
+
+
+def _assign_lists(vectors, centroids):
+    # nearest centroid of every row
+    return np.concatenate([np.argmax(vectors[start:start + SEARCH_BLOCK_ROWS] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), SEARCH_BLOCK_ROWS)])
+
+
+class CompactVectorStore:
+    """
+    Read-only vector store answering the Chroma query() calls of ask_hdb_question and ask_hdb_questions.
+    Embeddings are float16 or int8 arrays and metadata is one array per key, all memory-mapped .npy files,
+    so processes serving the same store share one copy through the page cache. Search is an exact
+    vectorized top-k, narrowed to the nearest coarse partitions (IVF) when the store was written with them.
+    """
+
+    def __init__(self, path, embedding_model=None, batch_size=EMBEDDING_BATCH_SIZE):
+        self.path = path
+        with open(os.path.join(path, STORE_FILENAME)) as store_file:
+            self._spec = json.load(store_file)
+        self.metadata = self._spec['collection_metadata']
+        self.name = os.path.basename(os.path.normpath(path))
+        self.embedding_model = embedding_model or LazySentenceTransformer(
+            self.metadata.get('embedding_model', EMBEDDING_MODEL_NAME))
+        self.batch_size = batch_size
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+        self._vectors = load("embeddings")
+        self._scales = load("scales") if self._spec['quantization'] == 'int8' else None
+        self._ids, self._id_offsets = load("ids"), load("ids_offsets")
+        self._documents, self._document_offsets = load("documents"), load("documents_offsets")
+        self._columns = {}
+        self._categories = {}
+        for i, column in enumerate(self._spec['columns']):
+            present = load(f"column_{i}_present") if column['has_missing'] else None
+            self._categories[column['name']] = column.get('categories', [])
+            category_codes = {value: code for code, value in enumerate(self._categories[column['name']])}
+            self._columns[column['name']] = (column['kind'], load(f"column_{i}"), present, category_codes)
+        self._centroids = load("ivf_centroids") if self._spec['n_lists'] else None
+        self._list_offsets = load("ivf_offsets") if self._spec['n_lists'] else None
+        self._rows_by_id = None
+
+    def count(self):
+        return self._spec['count']
+
+    @classmethod
+    def open(cls, path, embedding_model=None, batch_size=EMBEDDING_BATCH_SIZE):
+        """
+        Open a store written by write, None when there is none at path
+        """
+        if not os.path.exists(os.path.join(path, STORE_FILENAME)):
+            return None
+        with span("compact_store.open", path=path) as open_span:
+            store = cls(path, embedding_model, batch_size)
+            open_span.set(rows=store.count())
+        logger.info(f"Opened compact vector store with {store.count()} {store._spec['quantization']} vectors at {path}")
+        return store
+
+    @staticmethod
+    @traced("compact_store.write")
+    def write(path, ids, documents, metadatas, embeddings, quantization='float16', n_lists=0,
+              collection_metadata=None):
+        """
+        Write a store to path, replacing any store there once it is complete.
+        embeddings are L2-normalized float32 rows; with n_lists > 0 the rows are grouped into that
+        many k-means partitions and queries only score the partitions nearest to them.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"quantization must be one of {QUANTIZATIONS}, not {quantization!r}")
+        if not len(ids):
+            raise ValueError("No documents to write to the compact vector store")
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        current_span().set(rows=len(ids), quantization=quantization, n_lists=n_lists)
+        temp_path = os.path.normpath(path) + ".tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+
+        order = np.arange(len(ids))
+        n_lists = min(n_lists, len(ids))
+        if n_lists:
+            # rows of a partition are stored contiguously, a probe reads one slice per partition
+            with span("compact_store.ivf", rows=len(ids), n_lists=n_lists):
+                centroids = _spherical_kmeans(embeddings, n_lists)
+                assignment = _assign_lists(embeddings, centroids)
+                order = np.argsort(assignment, kind='stable')
+                list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+                np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+            np.save(os.path.join(temp_path, "ivf_centroids.npy"), centroids.astype(np.float32))
+            np.save(os.path.join(temp_path, "ivf_offsets.npy"), list_offsets)
+
+        vectors, scales = _quantize(embeddings[order], quantization)
+        np.save(os.path.join(temp_path, "embeddings.npy"), vectors)
+        if scales is not None:
+            np.save(os.path.join(temp_path, "scales.npy"), scales)
+        _write_blob(temp_path, "ids", [ids[row] for row in order])
+        _write_blob(temp_path, "documents", [documents[row] for row in order])
+        columns, arrays = _metadata_columns([metadatas[row] for row in order])
+        for i, (array, present) in enumerate(arrays):
+            np.save(os.path.join(temp_path, f"column_{i}.npy"), array)
+            if columns[i]['has_missing']:
+                np.save(os.path.join(temp_path, f"column_{i}_present.npy"), present)
+
+        collection_metadata = dict(collection_metadata or {})
+        collection_metadata.setdefault('index_version', uuid.uuid4().hex)
+        with open(os.path.join(temp_path, STORE_FILENAME), "w") as store_file:
+            json.dump({'count': len(ids), 'dimension': int(embeddings.shape[1]),
+                       'quantization': quantization, 'n_lists': n_lists, 'columns': columns,
+                       'collection_metadata': collection_metadata}, store_file, indent=1)
+
+        # swap the complete store in, readers of the old one keep their open memory maps
+        old_path = os.path.normpath(path) + ".old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(temp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        logger.info(f"Compact vector store with {len(ids)} {quantization} vectors written to {path}")
+
+    def _string(self, blob, offsets, row):
+        return blob[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+    def _metadata(self, row):
+        meta = {}
+        for name, (kind, values, present, _) in self._columns.items():
+            if present is not None and not present[row]:
+                continue
+            value = values[row]
+            if kind == 'category':
+                meta[name] = self._categories[name][value]
+            elif kind == 'bool':
+                meta[name] = bool(value)
+            elif kind == 'int':
+                meta[name] = int(value)
+            else:
+                meta[name] = float(value)
+        return meta
+
+    def get(self, ids, include=("documents", "metadatas")):
+        """
+        Documents with the given ids in Chroma's get() format, ids not in the store are left out
+        """
+        if self._rows_by_id is None:
+            # only built when documents are fetched by id, e.g. keyword hits of hybrid retrieval
+            self._rows_by_id = {self._string(self._ids, self._id_offsets, row): row for row in range(self.count())}
+        rows = [self._rows_by_id[doc_id] for doc_id in ids if doc_id in self._rows_by_id]
+        result = {'ids': [self._string(self._ids, self._id_offsets, row) for row in rows]}
+        if "documents" in include:
+            result['documents'] = [self._string(self._documents, self._document_offsets, row) for row in rows]
+        if "metadatas" in include:
+            result['metadatas'] = [self._metadata(row) for row in rows]
+        return result
+
+    def _scores(self, queries, rows):
+        # inner products of the queries with the stored vectors of rows (a slice or an index array)
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            vectors *= self._scales[rows][:, None]
+        return queries @ vectors.T
+
+    def _search(self, queries, candidates, n_results):
+        # exact top-k over the candidate rows (None for all), scored block by block
+        total = self.count() if candidates is None else len(candidates)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, total, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, total)
+            rows = np.arange(start, end) if candidates is None else candidates[start:end]
+            block_scores = self._scores(queries, slice(start, end) if candidates is None else rows)
+            scores = np.concatenate([best_scores, block_scores], axis=1)
+            all_rows = np.concatenate([best_rows, np.broadcast_to(rows, block_scores.shape)], axis=1)
+            if scores.shape[1] > n_results:
+                top = np.argpartition(-scores, n_results - 1, axis=1)[:, :n_results]
+                scores = np.take_along_axis(scores, top, axis=1)
+                all_rows = np.take_along_axis(all_rows, top, axis=1)
+            best_scores, best_rows = scores, all_rows
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def _probe(self, query, n_probe, mask):
+        # rows of the n_probe partitions nearest to the query, restricted to mask
+        lists = np.argsort(-(self._centroids @ query))[:n_probe]
+        rows = np.concatenate([np.arange(self._list_offsets[i], self._list_offsets[i + 1]) for i in lists])
+        return rows if mask is None else rows[mask[rows]]
+
+    def query(self, query_texts=None, query_embeddings=None, n_results=10, where=None,
+              include=("documents", "metadatas", "distances"), n_probe=None):
+        """
+        Nearest documents to each query text or embedding, in Chroma's result format.
+        Distances are squared L2 between unit vectors like Chroma's default space.
+        n_probe partitions are searched per query when the store has an IVF index (all of them when
+        n_probe is 0) and the where clause leaves more than EXACT_SEARCH_ROWS rows, falling back to
+        an exact search when the partitions hold fewer than n_results matches.
+        """
+        with span("compact_store.query", top_k=n_results, filtered=where is not None) as query_span:
+            if query_embeddings is None:
+                query_embeddings = embed_texts(list(query_texts), self.embedding_model, batch_size=self.batch_size)
+            queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self._spec['dimension'])
+            mask = where_mask(where, self._columns, self.count()) if where else None
+            exact_candidates = None if mask is None else np.flatnonzero(mask)
+            n_probe = DEFAULT_IVF_PROBES if n_probe is None else n_probe
+
+            candidate_count = self.count() if mask is None else len(exact_candidates)
+            if (self._centroids is not None and 0 < n_probe < self._spec['n_lists']
+                    and candidate_count > EXACT_SEARCH_ROWS):
+                results = []
+                for query in queries:
+                    candidates = self._probe(query, n_probe, mask)
+                    if len(candidates) < n_results:
+                        candidates = exact_candidates
+                    results.append(self._search(query[None, :], candidates, n_results))
+                scores = [result_scores[0] for result_scores, _ in results]
+                rows = [result_rows[0] for _, result_rows in results]
+            else:
+                scores, rows = self._search(queries, exact_candidates, n_results)
+
+            result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+            for query_scores, query_rows in zip(scores, rows):
+                found = np.isfinite(query_scores)
+                query_rows = query_rows[found].tolist()
+                result['ids'].append([self._string(self._ids, self._id_offsets, row) for row in query_rows])
+                if "documents" in include:
+                    result['documents'].append([self._string(self._documents, self._document_offsets, row)
+                                                for row in query_rows])
+                if "metadatas" in include:
+                    result['metadatas'].append([self._metadata(row) for row in query_rows])
+                if "distances" in include:
+                    result['distances'].append(np.maximum(2 - 2 * query_scores[found], 0).tolist())
+            query_span.set(rows=sum(len(ids) for ids in result['ids']))
+        return {key: value for key, value in result.items() if key == 'ids' or key in include}
+
+
+@traced("compact_store.export")
+def export_collection(collection, path, quantization='float16', n_lists=0):
+    """
+    Write the documents, metadata and stored embeddings of a Chroma collection to a compact store at path,
+    without embedding anything again. Returns the number of exported documents.
+    """
+    ids, documents, metadatas, embeddings = [], [], [], []
+    offset = 0
+    while True:
+        batch = collection.get(include=["documents", "metadatas", "embeddings"], limit=INDEX_BATCH_SIZE,
+                               offset=offset)
+        if not batch['ids']:
+            break
+        ids.extend(batch['ids'])
+        documents.extend(batch['documents'])
+        # the content hash is only needed to sync the Chroma index
+        metadatas.extend({key: value for key, value in (meta or {}).items() if key != 'doc_hash'}
+                         for meta in batch['metadatas'])
+        embeddings.append(np.asarray(batch['embeddings'], dtype=np.float32))
+        offset += len(batch['ids'])
+    current_span().set(rows=len(ids))
+    if not ids:
+        raise ValueError("The collection holds no documents to export")
+    CompactVectorStore.write(path, ids, documents, metadatas, np.vstack(embeddings), quantization=quantization,
+                             n_lists=n_lists, collection_metadata=collection.metadata)
+    return len(ids)
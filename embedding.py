@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BATCH_SIZE = 256
+
+
+def text_hash(text):
+    """
+    Hash used to recognise identical texts
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    In-memory store of embeddings keyed by text hash, so each distinct text is embedded once
+    """
+
+    def __init__(self):
+        self._vectors = {}
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __contains__(self, key):
+        return key in self._vectors
+
+    def get(self, key):
+        return self._vectors.get(key)
+
+    def put(self, key, vector):
+        self._vectors[key] = vector
+
+
+class LazySentenceTransformer:
+    """
+    SentenceTransformer that is only imported and loaded on first use, so startup and
+    questions answered without retrieval never pay for torch and the model weights
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        """
+        Load the model if it is not loaded yet and return it
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    with span("embedding.load_model", model=self.model_name):
+                        from sentence_transformers import SentenceTransformer
+                        self._model = SentenceTransformer(self.model_name)
+                    logger.info(f"embedding model loaded: {self.model_name}")
+        return self._model
+
+    def __getattr__(self, name):
+        # only called for attributes not set in __init__, i.e. the model's own methods
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+@contextmanager
+def embedding_pool(embedding_model, num_workers=0):
+    """
+    Start a multi-process CPU encoding pool for the model, or yield None when num_workers <= 1
+    """
+    if num_workers is None or num_workers <= 1:
+        yield None
+        return
+    pool = embedding_model.start_multi_process_pool(target_devices=["cpu"] * num_workers)
+    logger.info(f"Started embedding pool with {num_workers} CPU workers")
+    try:
+        yield pool
+    finally:
+        embedding_model.stop_multi_process_pool(pool)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def embed_texts(texts, embedding_model, batch_size=EMBEDDING_BATCH_SIZE, pool=None, cache=None):
+    """
+    Encode texts with the model into L2-normalized float32 vectors (one row per text).
+    Duplicate texts, and texts already in the cache, are only embedded once.
+    """
+    if cache is None:
+        cache = EmbeddingCache()
+
+    keys = [text_hash(text) for text in texts]
+
+    # collect the distinct texts that still need encoding
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in cache and key not in pending:
+            pending[key] = text
+
+    if pending:
+        pending_texts = list(pending.values())
+        with span("embed.encode", rows=len(pending_texts), requested=len(texts), batch_size=batch_size,
+                  multi_process=pool is not None):
+            if pool is not None:
+                vectors = embedding_model.encode_multi_process(pending_texts, pool, batch_size=batch_size)
+            else:
+                vectors = embedding_model.encode(pending_texts, batch_size=batch_size, convert_to_numpy=True,
+                                                 show_progress_bar=False)
+        for key, vector in zip(pending, _normalize(vectors)):
+            cache.put(key, vector)
+
+    dimension = embedding_model.get_sentence_embedding_dimension()
+    embeddings = np.empty((len(texts), dimension), dtype=np.float32)
+    for row, key in enumerate(keys):
+        embeddings[row] = cache.get(key)
+    return embeddings
+
@@ -0,0 +1,148 @@
+import logging
+import queue
+import threading
+import time
+
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+PROMPT_TEMPLATE = """Based on the HDB resale data provided, answer this question: {question}
+HDB data:
+{context}
+Answer:"""
+DEFAULT_MAX_INPUT_TOKENS = 512  # used when the tokenizer doesn't state a limit, flan-t5's own limit
+GENERATION_MAX_NEW_TOKENS = 64
+GENERATION_BATCH_SIZE = 8
+STREAM_TIMEOUT_SECONDS = 60  # longest wait for the next piece of streamed text
+CONTEXT_SEPARATOR = "\n\n"
+
+
+def model_and_tokenizer(qa_pipeline):
+    """
+    Model and tokenizer of a text generation pipeline, loading it now if it is a LazyQAPipeline
+    """
+    pipe = qa_pipeline.load() if hasattr(qa_pipeline, 'load') else qa_pipeline
+    return pipe.model, pipe.tokenizer
+
+
+def max_input_tokens(tokenizer):
+    """
+    Longest input the model accepts, tokenizers without a limit report a huge sentinel
+    """
+    limit = getattr(tokenizer, 'model_max_length', None)
+    return limit if limit and limit < 1_000_000 else DEFAULT_MAX_INPUT_TOKENS
+
+
+def context_token_budget(tokenizer, question):
+    """
+    Tokens left for the retrieved documents once the prompt template and the question are counted
+    """
+    prompt_tokens = len(tokenizer(PROMPT_TEMPLATE.format(question=question, context=""))['input_ids'])
+    return max(max_input_tokens(tokenizer) - prompt_tokens, 0)
+
+
+def _compact_document(text):
+    # documents are indented multi-line templates, the indentation only costs tokens
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def pack_context(documents, tokenizer, budget):
+    """
+    Join retrieved documents, most relevant first, into a context of at most budget tokens.
+    Duplicates are dropped and a document that doesn't fit is skipped so a shorter, less relevant one
+    still can. Returns (context, number of documents packed, tokens used).
+    """
+    unique = list(dict.fromkeys(_compact_document(text) for text in documents))
+    if not unique:
+        return "", 0, 0
+    separator_tokens = len(tokenizer(CONTEXT_SEPARATOR, add_special_tokens=False)['input_ids'])
+    lengths = [len(ids) for ids in tokenizer(unique, add_special_tokens=False)['input_ids']]
+    packed = []
+    used = 0
+    for text, length in zip(unique, lengths):
+        cost = length + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(text)
+            used += cost
+    return CONTEXT_SEPARATOR.join(packed), len(packed), used
+
+
+def build_prompt(question, documents, tokenizer):
+    """
+    Prompt for a question with as many of its retrieved documents as fit the model's input
+    """
+    context, packed, used = pack_context(documents, tokenizer, context_token_budget(tokenizer, question))
+    logger.debug(f"Packed {packed} of {len(documents)} documents into {used} context tokens")
+    return PROMPT_TEMPLATE.format(question=question, context=context)
+
+
+def _new_tokens(model, inputs, outputs):
+    # decoder-only models return the prompt followed by the answer, encoder-decoders only the answer
+    if getattr(model.config, 'is_encoder_decoder', False):
+        return outputs
+    return outputs[:, inputs['input_ids'].shape[1]:]
+
+
+@traced("generate")
+def generate_texts(qa_pipeline, prompts, max_new_tokens=GENERATION_MAX_NEW_TOKENS, batch_size=GENERATION_BATCH_SIZE):
+    """
+    Generate a text for each prompt, batch_size prompts per generate call.
+    Returns the texts and the number of tokens generated for each.
+    """
+    model, tokenizer = model_and_tokenizer(qa_pipeline)
+    if not getattr(model.config, 'is_encoder_decoder', False):
+        tokenizer.padding_side = 'left'  # decoder-only models continue from the right end of every row
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+    texts = []
+    token_counts = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(prompts), batch_size):
+        batch = prompts[batch_start:batch_start + batch_size]
+        with span("generate.batch", rows=len(batch)) as batch_span:
+            inputs = tokenizer(batch, padding=True, truncation=True, max_length=max_input_tokens(tokenizer),
+                               return_tensors="pt").to(model.device)
+            outputs = _new_tokens(model, inputs, model.generate(**inputs, max_new_tokens=max_new_tokens))
+            special = set(tokenizer.all_special_ids)
+            counts = [sum(1 for token in row if token not in special) for row in outputs.tolist()]
+            batch_span.set(input_tokens=int(inputs['attention_mask'].sum()), generated_tokens=sum(counts))
+        texts.extend(text.strip() for text in tokenizer.batch_decode(outputs, skip_special_tokens=True))
+        token_counts.extend(counts)
+    seconds = time.perf_counter() - start
+    current_span().set(rows=len(prompts), generated_tokens=sum(token_counts),
+                       tokens_per_second=round(sum(token_counts) / seconds, 1) if seconds else None)
+    return texts, token_counts
+
+
+def stream_text(qa_pipeline, prompt, max_new_tokens=GENERATION_MAX_NEW_TOKENS, timeout=STREAM_TIMEOUT_SECONDS):
+    """
+    Yield the generated text piece by piece as the model produces it.
+    An error in generate is raised here, and TimeoutError when no text arrives for timeout seconds.
+    """
+    from transformers import TextIteratorStreamer
+    model, tokenizer = model_and_tokenizer(qa_pipeline)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+    inputs = tokenizer([prompt], truncation=True, max_length=max_input_tokens(tokenizer),
+                       return_tensors="pt").to(model.device)
+    errors = []
+
+    def generate():
+        try:
+            model.generate(**inputs, streamer=streamer, max_new_tokens=max_new_tokens)
+        except Exception as e:
+            errors.append(e)
+            streamer.end()  # end the stream now rather than after the timeout
+
+    # generate runs in a thread and hands decoded pieces to the streamer as they are produced
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        yield from streamer
+    except queue.Empty:
+        # a stuck generate is left to its daemon thread rather than blocking the caller
+        raise TimeoutError(f"No generated text for {timeout}s") from None
+    # the stream ended, so generate has returned or is about to
+    thread.join()
+    if errors:
+        raise errors[0]
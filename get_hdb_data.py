@@ -2,80 +2,256 @@ import requests
 import pandas as pd
 import os
 import glob
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import PeakRSSMonitor, current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+DATA_GOV_SG_API = "https://api-production.data.gov.sg"
+DATA_GOV_SG_DOWNLOAD_API = "https://api-open.data.gov.sg"
+HDB_RESALE_COLLECTION_ID = 189
+
 
 # Get HDB data from data.gov.sg
-def get_hdb_datasets_from_api():
+def get_hdb_datasets_from_api(collection_id=HDB_RESALE_COLLECTION_ID, base_url=DATA_GOV_SG_API, session=requests):
     """Get list of all HDB datasets"""
-    collection_id = 189          
-    url = f"https://api-production.data.gov.sg/v2/public/api/collections/{collection_id}/metadata"
+    url = f"{base_url}/v2/public/api/collections/{collection_id}/metadata"
     
-    response = requests.get(url)
+    response = session.get(url)
+    response.raise_for_status()
     data = response.json()
     
     # Extract the child dataset IDs
     child_datasets = data['data']['collectionMetadata']['childDatasets']
-    print(f"Found {len(child_datasets)} datasets:")
+    logger.info(f"Found {len(child_datasets)} datasets")
     
     return child_datasets
 
 
-def load_hdb_data_from_csv(folder_path="."):
+class LocalDirectorySource:
+    """
+    Ingestion source serving the csv files of a local folder, one source per file.
+    Stands in for data.gov.sg when the files are downloaded by hand or in tests.
+    """
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+
+    def list_sources(self):
+        """
+        [{'source_id', 'name', 'version'}] for every csv file, version changes when the file does
+        """
+        sources = []
+        for path in sorted(glob.glob(os.path.join(self.folder_path, "*.csv"))):
+            stat = os.stat(path)
+            name = os.path.basename(path)
+            sources.append({'source_id': name, 'name': name, 'version': f"{stat.st_size}:{stat.st_mtime_ns}"})
+        return sources
+
+    def fetch(self, source, download_folder):
+        """
+        Local path of the source's csv file
+        """
+        return os.path.join(self.folder_path, source['source_id'])
+
+
+class DataGovSGSource:
     """
-    loads HDB data from csv file obtained from data.gov.sg
+    Ingestion source serving the child datasets of the data.gov.sg HDB resale collection, one source per dataset.
+    base_url, download_base_url and session can point at a stub server.
     """
 
-    #find all csv files in the folder
-    csv_files=glob.glob(os.path.join(folder_path,"*.csv"))
-  
+    def __init__(self, collection_id=HDB_RESALE_COLLECTION_ID, base_url=DATA_GOV_SG_API,
+                 download_base_url=DATA_GOV_SG_DOWNLOAD_API, session=None, poll_seconds=2, max_polls=30):
+        self.collection_id = collection_id
+        self.base_url = base_url
+        self.download_base_url = download_base_url
+        self.session = session or requests.Session()
+        self.poll_seconds = poll_seconds
+        self.max_polls = max_polls
+
+    def list_sources(self):
+        """
+        [{'source_id', 'name', 'version'}] for every child dataset, version is its last update time
+        """
+        sources = []
+        for dataset_id in get_hdb_datasets_from_api(self.collection_id, self.base_url, self.session):
+            response = self.session.get(f"{self.base_url}/v2/public/api/datasets/{dataset_id}/metadata")
+            response.raise_for_status()
+            metadata = response.json()['data']
+            sources.append({'source_id': dataset_id, 'name': metadata.get('name', dataset_id),
+                            'version': metadata.get('lastUpdatedAt')})
+        return sources
+
+    def fetch(self, source, download_folder):
+        """
+        Download the source's csv file into download_folder and return its path
+        """
+        dataset_url = f"{self.download_base_url}/v1/public/api/datasets/{source['source_id']}"
+        self.session.get(f"{dataset_url}/initiate-download").raise_for_status()
+        for _ in range(self.max_polls):
+            response = self.session.get(f"{dataset_url}/poll-download")
+            response.raise_for_status()
+            download_url = response.json()['data'].get('url')
+            if download_url:
+                break
+            time.sleep(self.poll_seconds)
+        else:
+            raise TimeoutError(f"data.gov.sg did not prepare {source['source_id']} for download")
+
+        os.makedirs(download_folder, exist_ok=True)
+        path = os.path.join(download_folder, f"{source['source_id']}.csv")
+        with self.session.get(download_url, stream=True) as response:
+            response.raise_for_status()
+            with open(path + ".tmp", "wb") as csv_file:
+                for block in response.iter_content(chunk_size=1 << 20):
+                    csv_file.write(block)
+        os.replace(path + ".tmp", path)
+        logger.info(f"Downloaded {source['name']} to {path}")
+        return path
+
+
+# Column types of the HDB resale csv files, in output column order.
+# 'float' and 'integer' columns are downcast to the smallest type that holds every value exactly.
+HDB_SCHEMA = {
+    'month': 'string',
+    'town': 'category',
+    'flat_type': 'category',
+    'block': 'string',
+    'street_name': 'string',
+    'storey_range': 'category',
+    'floor_area_sqm': 'float',
+    'flat_model': 'category',
+    'lease_commence_date': 'integer',
+    'remaining_lease': 'string',  # mixed formats such as "70" and "61 years 04 months"
+    'resale_price': 'float',
+}
+
+_READ_DTYPES = {'string': str, 'category': 'category', 'float': 'float64', 'integer': 'float64'}
+
+
+def _downcast(series, kind):
+    if kind == 'integer':
+        if series.isna().any():
+            return series
+        return pd.to_numeric(series, downcast='integer')
+    if kind == 'float':
+        downcast = series.astype('float32')
+        if (downcast.astype('float64') == series)[series.notna()].all():
+            return downcast
+    return series
+
+
+def _read_hdb_csv(file, schema):
+    # read one csv with the schema dtypes for the columns it has
+    with span("load.read_csv", file=os.path.basename(file)) as read_span:
+        header = pd.read_csv(file, nrows=0).columns
+        dtypes = {column: _READ_DTYPES[schema[column]] for column in header if column in schema}
+        df = pd.read_csv(file, dtype=dtypes)
+        read_span.set(rows=len(df))
+    logger.info(f"Loaded {file} with shape {df.shape}")
+    return df
+
+
+def _align_columns(data_frames, schema):
+    # schema columns first in schema order, then any other columns sorted by name
+    extra_columns = sorted({column for df in data_frames for column in df.columns} - set(schema))
+    columns = list(schema) + extra_columns
+
+    # categoricals need identical categories in every frame to stay categorical after concat
+    categories = {
+        column: sorted({value for df in data_frames if column in df.columns for value in df[column].cat.categories})
+        for column, kind in schema.items() if kind == 'category'
+    }
+
+    aligned = []
+    for df in data_frames:
+        missing_columns = [column for column in columns if column not in df.columns]
+        if missing_columns:
+            logger.info(f"Missing columns to be filled with NaN: {missing_columns}")
+        # only copy frames whose columns or categories differ from the target
+        if list(df.columns) != columns:
+            df = df.reindex(columns=columns)
+        for column, values in categories.items():
+            if not (isinstance(df[column].dtype, pd.CategoricalDtype) and list(df[column].cat.categories) == values):
+                df[column] = df[column].astype(pd.CategoricalDtype(values))
+        aligned.append(df)
+    return aligned
+
+
+@traced("load_hdb_data_from_csv")
+def load_hdb_data_from_csv(folder_path=".", schema=HDB_SCHEMA, max_workers=None):
+    """
+    loads HDB data from csv files obtained from data.gov.sg using the column schema,
+    reading the files concurrently and reporting load time and the peak memory the load added
+    """
+    start_time = time.perf_counter()
+
+    #find all csv files in the folder, sorted so the row order is deterministic
+    csv_files = sorted(glob.glob(os.path.join(folder_path, "*.csv")))
+
     # raise error if file not found
     if len(csv_files)>0:
-        print(f"Found {len(csv_files)} csv files in {folder_path}")
+        logger.info(f"Found {len(csv_files)} csv files in {folder_path}")
     else:
         raise ValueError(f"No csv files found in {folder_path}")
-    
-    #reading all csv files
-    data_frames=[]
-    for file in csv_files:
-        try:
-            df=pd.read_csv(file)
-            data_frames.append(df)
-            print(f"Loaded {file} with shape {df.shape}")
-            print(f"Columns: {list(df.columns)}")
-            print(df.head(2))
-        except Exception as e:
-            print(f"Error loading file {file}: {e}")
-    
-    #finding reference column set that has all possible columns names
-    reference_columns = set()
-    for df1 in data_frames:
-        try:
-            #df=pd.read_csv(file)
-            reference_columns |= set(df1.columns)
-        except Exception as e:
-            print(f"Error reading the file {file}: {e}")
-            continue
-    reference_columns_list=list(reference_columns)
-    print(f"all unique columns across all files: {reference_columns_list}")
-
-    #modifying dataframes by reindexing  to match reference columns
-    modified_data_frames=[]
-    total_rows=0
-    for df1 in data_frames:
-        try:
-            print(f"checking dataframe with shape {df1.shape}")
-            print(f"Missing columns to be filled with NaN: {[col for col in reference_columns_list if col not in df1.columns]}")
-            df1=df1.reindex(columns=reference_columns_list)
-            modified_data_frames.append(df1)
-            total_rows += len(df1)
-            print(f"Columns: {list(df1.columns)}")
-            print(df1.head(2))
-            print("\n")
-        except Exception as e:
-            print(f"Error modifying the columns of file {file}: {e}")
-
-    combined_df= pd.concat(modified_data_frames, ignore_index=True)
-    print(f"combined dataframe with rows {total_rows}")
-    
+
+    # sampled rather than end minus start, the per-file frames are freed before the load returns
+    with PeakRSSMonitor() as rss_monitor:
+        start_rss = rss_monitor.peak_bytes
+
+        #reading all csv files in parallel
+        data_frames = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_read_hdb_csv, file, schema) for file in csv_files]
+            for file, future in zip(csv_files, futures):
+                try:
+                    data_frames.append(future.result())
+                except Exception as e:
+                    logger.error(f"Error loading file {file}: {e}")
+
+        if not data_frames:
+            raise ValueError(f"No csv files could be loaded from {folder_path}")
+
+        with span("load.concat"):
+            combined_df = pd.concat(_align_columns(data_frames, schema), ignore_index=True)
+        del data_frames
+
+        with span("load.downcast"):
+            for column, kind in schema.items():
+                if kind in ('float', 'integer'):
+                    combined_df[column] = _downcast(combined_df[column], kind)
+
+    peak_rss_mb = (rss_monitor.peak_bytes - start_rss) / 1024 / 1024
+    current_span().set(rows=len(combined_df), files=len(csv_files), peak_rss_growth_mb=round(peak_rss_mb, 1))
+    frame_mb = combined_df.memory_usage(deep=True).sum() / 1024 / 1024
+    logger.info(f"combined dataframe with rows {len(combined_df)} in {time.perf_counter() - start_time:.2f}s "
+                f"({frame_mb:.1f} MB in memory, RSS peaked {peak_rss_mb:.1f} MB above the start during the load)")
+
     return combined_df
 
 
+def iter_hdb_csv_chunks(file, chunk_size=50000, schema=HDB_SCHEMA, first_row=0, start_index=0):
+    """
+    Yield one csv file in dataframes of at most chunk_size rows, starting at data row first_row.
+    Chunks have the schema columns and dtypes of load_hdb_data_from_csv and are indexed from
+    start_index + first_row, so rows keep the index they get in the combined dataframe.
+    """
+    header = pd.read_csv(file, nrows=0).columns
+    dtypes = {column: _READ_DTYPES[schema[column]] for column in header if column in schema}
+    columns = list(schema) + sorted(set(header) - set(schema))
+    reader = pd.read_csv(file, dtype=dtypes, chunksize=chunk_size,
+                         skiprows=range(1, first_row + 1) if first_row else None)
+    row = first_row
+    with reader:
+        for chunk in reader:
+            chunk = chunk.reindex(columns=columns)
+            chunk.index = pd.RangeIndex(start_index + row, start_index + row + len(chunk))
+            for column, kind in schema.items():
+                if kind in ('float', 'integer'):
+                    chunk[column] = _downcast(chunk[column], kind)
+            row += len(chunk)
+            yield chunk
@@ -0,0 +1,308 @@
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+
+from hdb_question_parser import parse_question, HDB_TOWNS, HDB_FLAT_TYPES
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+COMPS_FILENAME = "comps_index.npz"  # saved next to the vector index, part of the serving snapshot
+COMPS_COLUMNS = ['month', 'town', 'flat_type', 'block', 'street_name', 'storey_range_min', 'storey_range_max',
+                 'floor_area_sqm', 'lease_commence_date', 'remaining_lease', 'resale_price']  # what from_dataframe reads
+# distance features and the difference in each that counts as one unit of distance
+FEATURES = ('floor_area_sqm', 'storey_range_min', 'storey_range_max', 'remaining_lease', 'lease_commence_year',
+            'month_number')
+FEATURE_SCALES = np.array([5.0, 3.0, 3.0, 5.0, 5.0, 12.0], dtype=np.float32)
+RECENT_MONTHS = 36  # comparables are sales from this many months up to the valuation month, when there are enough
+DEFAULT_COMPARABLES = 10
+PRICE_INDEX_SMOOTHING = 3  # months in the centred rolling median of the monthly price per sqm index
+MAX_ANSWER_LINES = 5
+
+_AREA_PATTERN = re.compile(r'(\d{2,3}(?:\.\d+)?)\s*(?:sqm|sq\.?\s*m|square\s*met(?:er|re)s?|m2)\b')
+_STOREY_PATTERN = re.compile(r'\b(?:floor|storey|level)\s*(\d{1,2})\b|\b(\d{1,2})(?:st|nd|rd|th)\s*(?:floor|storey)\b')
+_LEASE_START_PATTERN = re.compile(
+    r'\b(?:lease\s*(?:commenc\w*|start\w*|from|since)|built|completed)\s*(?:in\s*)?(19[6-9]\d|20\d\d)\b')
+_REMAINING_LEASE_PATTERN = re.compile(r'\b(\d{2})\s*(?:years?|yrs?)\s*(?:of\s*)?(?:lease\s*)?(?:left|remaining)\b')
+
+
+def month_number(month):
+    """
+    Months since year 0 of a timestamp or 'YYYY-MM' string, for month arithmetic on integers
+    """
+    month = pd.Timestamp(month)
+    return month.year * 12 + month.month - 1
+
+
+def _month_label(number):
+    return f"{number // 12}-{number % 12 + 1:02d}"
+
+
+def parse_subject(question, towns=HDB_TOWNS, flat_types=HDB_FLAT_TYPES):
+    """
+    Subject flat described in a question: one town and flat type plus at least one of floor area,
+    storey, lease start year or remaining lease. None when the question doesn't describe a flat.
+    A month or year in the question sets the valuation month, the end of the year for a year.
+    """
+    text = question.lower()
+    lease_match = _LEASE_START_PATTERN.search(text)
+    # the lease start year is not a valuation date
+    dated_text = text[:lease_match.start()] + " " + text[lease_match.end():] if lease_match else text
+    intent = parse_question(dated_text, towns=towns, flat_types=flat_types)
+    if len(intent['towns']) != 1 or len(intent['flat_types']) != 1:
+        return None
+    subject = {}
+    area_match = _AREA_PATTERN.search(text)
+    if area_match:
+        subject['floor_area_sqm'] = float(area_match.group(1))
+    storey_match = _STOREY_PATTERN.search(text)
+    if storey_match:
+        storey = int(storey_match.group(1) or storey_match.group(2))
+        subject['storey_range_min'] = subject['storey_range_max'] = storey
+    if lease_match:
+        subject['lease_commence_year'] = int(lease_match.group(1))
+    remaining_match = _REMAINING_LEASE_PATTERN.search(text)
+    if remaining_match:
+        subject['remaining_lease'] = float(remaining_match.group(1))
+    if not subject:
+        return None
+    subject.update(town=intent['towns'][0], flat_type=intent['flat_types'][0])
+    if intent['month']:
+        subject['month'] = intent['month']
+    elif intent['year_range'][1] is not None:
+        subject['month'] = f"{intent['year_range'][1]}-12"
+    return subject
+
+
+class ComparablesIndex:
+    """
+    Nearest-neighbour index of resale transactions for valuing a flat from its most similar recent sales.
+    Rows are sorted by town, flat type and month, so a partition is a contiguous slice and its recent
+    sales a sub-slice found by binary search; distances are computed vectorized over that slice on
+    scaled numeric features. Comparable prices are time-adjusted with a monthly price per sqm index.
+    """
+
+    def __init__(self, values, prices, months, blocks, street_names, partitions, price_index, flat_types,
+                 first_index_month):
+        self._values = values
+        self._scaled = values / FEATURE_SCALES
+        self._prices = prices
+        self._months = months
+        self._blocks = blocks
+        self._street_names = street_names
+        self._partitions = partitions  # (town, flat_type) -> (start row, end row)
+        self._price_index = price_index  # flat type x month, price per sqm
+        self._flat_type_rows = {flat_type: row for row, flat_type in enumerate(flat_types)}
+        self._first_index_month = first_index_month
+        self.towns = sorted({town for town, _ in partitions})
+        self.flat_types = sorted(flat_types)
+        self.last_month = int(months.max()) if len(months) else None
+        self.index_version = None  # vector index and raw data the saved index was built alongside
+        self.data_key = None
+
+    def __len__(self):
+        return len(self._prices)
+
+    @classmethod
+    @traced("comps.build")
+    def from_dataframe(cls, df):
+        """
+        Build the index from the dataframe returned by preprocessing_hdb_dataframe
+        """
+        current_span().set(rows=len(df))
+        logger.info("Building comparables index...")
+        work = pd.DataFrame({
+            'town': df['town'].astype(str),
+            'flat_type': df['flat_type'].astype(str),
+            'block': df['block'].astype(str),
+            'street_name': df['street_name'].astype(str),
+            'floor_area_sqm': df['floor_area_sqm'].astype(float),
+            'storey_range_min': df['storey_range_min'].astype(float),
+            'storey_range_max': df['storey_range_max'].astype(float),
+            'remaining_lease': df['remaining_lease'].astype(float),
+            'lease_commence_year': df['lease_commence_date'].dt.year.astype(float),
+            'month_number': df['month'].dt.year * 12 + df['month'].dt.month - 1,
+            'resale_price': df['resale_price'].astype(float),
+        }).dropna(subset=['month_number', 'floor_area_sqm', 'resale_price'])
+        # a missing feature counts as the typical flat of its kind rather than dropping the sale
+        for feature in ('storey_range_min', 'storey_range_max', 'remaining_lease', 'lease_commence_year'):
+            work[feature] = work[feature].fillna(work.groupby('flat_type')[feature].transform('median'))
+        work = work.dropna(subset=list(FEATURES)).sort_values(['town', 'flat_type', 'month_number'],
+                                                              kind='stable', ignore_index=True)
+
+        keys = list(zip(work['town'], work['flat_type']))
+        towns, flat_types = work['town'].to_numpy(), work['flat_type'].to_numpy()
+        boundaries = np.flatnonzero(np.r_[True, (towns[1:] != towns[:-1]) | (flat_types[1:] != flat_types[:-1])])
+        ends = np.r_[boundaries[1:], len(work)]
+        partitions = {keys[start]: (int(start), int(end)) for start, end in zip(boundaries, ends)}
+
+        price_index, flat_types, first_month = cls._build_price_index(work)
+        index = cls(work[list(FEATURES)].to_numpy(dtype=np.float32), work['resale_price'].to_numpy(),
+                    work['month_number'].to_numpy(dtype=np.int32), work['block'].to_numpy(dtype=str),
+                    work['street_name'].to_numpy(dtype=str), partitions, price_index, flat_types, first_month)
+        logger.info(f"Comparables index built with {len(index)} transactions in {len(partitions)} partitions")
+        return index
+
+    @staticmethod
+    def _build_price_index(work):
+        # monthly median price per sqm per flat type, smoothed, months without sales filled from their neighbours
+        first_month, last_month = int(work['month_number'].min()), int(work['month_number'].max())
+        per_sqm = (work['resale_price'] / work['floor_area_sqm']).groupby(
+            [work['flat_type'], work['month_number']]).median().unstack('month_number')
+        per_sqm = per_sqm.reindex(columns=range(first_month, last_month + 1))
+        per_sqm = per_sqm.T.rolling(PRICE_INDEX_SMOOTHING, center=True, min_periods=1).median().ffill().bfill().T
+        return per_sqm.to_numpy(dtype=np.float64), list(per_sqm.index), first_month
+
+    def save(self, path, index_version=None, data_key=None):
+        """
+        Write the index to a .npz file, written to a temporary file first so readers never see a partial index.
+        index_version and data_key (raw_data_key of the csv files) record what it was built alongside.
+        """
+        self.index_version, self.data_key = index_version, data_key
+        keys = list(self._partitions)
+        temp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            temp_path,
+            values=self._values,
+            prices=self._prices,
+            months=self._months,
+            blocks=self._blocks,
+            street_names=self._street_names,
+            partition_towns=np.array([town for town, _ in keys], dtype=str),
+            partition_flat_types=np.array([flat_type for _, flat_type in keys], dtype=str),
+            partition_bounds=np.array([self._partitions[key] for key in keys], dtype=np.int64).reshape(-1, 2),
+            price_index=self._price_index,
+            index_flat_types=np.array(list(self._flat_type_rows), dtype=str),
+            first_index_month=np.array(self._first_index_month),
+            index_version=np.array(index_version or ''),
+            data_key=np.array(data_key or ''),
+        )
+        os.replace(temp_path, path)
+        logger.info(f"Comparables index with {len(self)} transactions saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by save, None when there is none at path
+        """
+        if not os.path.exists(path):
+            return None
+        with span("comps.load", path=path), np.load(path) as data:
+            partitions = {(town, flat_type): (int(start), int(end)) for town, flat_type, (start, end)
+                          in zip(data['partition_towns'].tolist(), data['partition_flat_types'].tolist(),
+                                 data['partition_bounds'])}
+            index = cls(data['values'], data['prices'], data['months'], data['blocks'], data['street_names'],
+                        partitions, data['price_index'], data['index_flat_types'].tolist(),
+                        int(data['first_index_month']))
+            # indexes saved before the versions were recorded match no vector index
+            index.index_version = (str(data['index_version']) or None) if 'index_version' in data else None
+            index.data_key = (str(data['data_key']) or None) if 'data_key' in data else None
+        logger.info(f"Comparables index with {len(index)} transactions loaded from {path}")
+        return index
+
+    def _index_values(self, flat_type, months):
+        # price index of a flat type at the given month numbers, clamped to the months it covers
+        row = self._price_index[self._flat_type_rows[flat_type]]
+        return row[np.clip(np.asarray(months) - self._first_index_month, 0, len(row) - 1)]
+
+    def find_comparables(self, subject, k=DEFAULT_COMPARABLES, recent_months=RECENT_MONTHS):
+        """
+        The k transactions most similar to a subject flat and its time-adjusted price estimate.
+        subject has town and flat_type and any of the FEATURES, the others don't count towards
+        the distance; its month defaults to the latest month in the index, and a later month is valued
+        at the latest month. Only sales in the recent_months up to that month are compared unless
+        there are fewer than k of them.
+        Returns None when the index has no sales of that town and flat type.
+        """
+        with span("comps.query", top_k=k) as query_span:
+            start, end = self._partitions.get((subject['town'], subject['flat_type']), (0, 0))
+            if start == end:
+                return None
+            target_month = (min(month_number(subject['month']), self.last_month) if subject.get('month')
+                            else self.last_month)
+            months = self._months[start:end]
+            # rows are sorted by month within a partition
+            window_start = start + np.searchsorted(months, target_month - recent_months, side='left')
+            window_end = start + np.searchsorted(months, target_month, side='right')
+            if window_end - window_start < k:
+                window_start = start
+                if window_end - window_start < k:
+                    window_end = end
+
+            subject_values = np.array([subject.get(feature, np.nan) for feature in FEATURES], dtype=np.float32)
+            subject_values[FEATURES.index('month_number')] = target_month
+            known = ~np.isnan(subject_values)
+            differences = self._scaled[window_start:window_end][:, known] - (subject_values / FEATURE_SCALES)[known]
+            distances = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+            n_results = min(k, len(distances))
+            best = np.argpartition(distances, n_results - 1)[:n_results]
+            best = best[np.argsort(distances[best], kind='stable')]
+            rows = window_start + best
+
+            # price per sqm moved to the valuation month, weighted towards the closest comparables
+            adjustment = (self._index_values(subject['flat_type'], target_month)
+                          / self._index_values(subject['flat_type'], self._months[rows]))
+            areas = self._values[rows, FEATURES.index('floor_area_sqm')]
+            adjusted_per_sqm = self._prices[rows] / areas * adjustment
+            weights = 1 / (1 + distances[best])
+            subject_area = subject.get('floor_area_sqm')
+            adjusted = adjusted_per_sqm * subject_area if subject_area else self._prices[rows] * adjustment
+            estimate = float(np.average(adjusted, weights=weights))
+            query_span.set(rows=len(rows), candidates=int(window_end - window_start))
+
+        comparables = pd.DataFrame({
+            'month': [_month_label(number) for number in self._months[rows].tolist()],
+            'block': self._blocks[rows],
+            'street_name': self._street_names[rows],
+            'storey_range': [f"{low:02.0f} TO {high:02.0f}" for low, high
+                             in self._values[rows][:, 1:3].tolist()],
+            'floor_area_sqm': areas,
+            'lease_commence_year': self._values[rows, FEATURES.index('lease_commence_year')].astype(int),
+            'remaining_lease': self._values[rows, FEATURES.index('remaining_lease')],
+            'resale_price': self._prices[rows],
+            'adjusted_price': adjusted,
+            'distance': distances[best],
+        })
+        return {'estimate': estimate, 'low': float(adjusted.min()), 'high': float(adjusted.max()),
+                'month': _month_label(target_month), 'comparables': comparables}
+
+    def answer(self, subject, k=DEFAULT_COMPARABLES):
+        """
+        Price estimate and closest comparable sales of a subject flat as text, None without sales to compare
+        """
+        result = self.find_comparables(subject, k)
+        if result is None:
+            return None
+        details = []
+        if 'floor_area_sqm' in subject:
+            details.append(f"{subject['floor_area_sqm']:g} sqm")
+        if 'storey_range_min' in subject:
+            details.append(f"storey {subject['storey_range_min']}")
+        if 'lease_commence_year' in subject:
+            details.append(f"lease from {subject['lease_commence_year']}")
+        if 'remaining_lease' in subject:
+            details.append(f"{subject['remaining_lease']:g} years of lease left")
+        lines = [f"- {row.month}: Block {row.block} {row.street_name}, storey {row.storey_range}, "
+                 f"{row.floor_area_sqm:g} sqm, lease from {row.lease_commence_year}: sold for "
+                 f"${row.resale_price:,.0f} (${row.adjusted_price:,.0f} at {result['month']} prices)"
+                 for row in result['comparables'].head(MAX_ANSWER_LINES).itertuples(index=False)]
+        valuation_month = result['month']
+        if subject.get('month') and month_number(subject['month']) > month_number(valuation_month):
+            valuation_month += f" (the latest month in the data, not {_month_label(month_number(subject['month']))})"
+        return (f"Estimated price of this {subject['flat_type']} flat in {subject['town']} ({', '.join(details)}) "
+                f"in {valuation_month}: ${result['estimate']:,.0f}, range ${result['low']:,.0f} - "
+                f"${result['high']:,.0f} from the {len(result['comparables'])} most similar sales.\n"
+                f"Most similar sales:\n" + "\n".join(lines))
+
+    def answer_question(self, question):
+        """
+        Parse a question describing a flat and answer it from its comparables, None when it doesn't describe one
+        """
+        with span("comps.answer") as answer_span:
+            subject = parse_subject(question, towns=self.towns or HDB_TOWNS,
+                                    flat_types=self.flat_types or HDB_FLAT_TYPES)
+            answer = self.answer(subject) if subject is not None else None
+            answer_span.set(answered=answer is not None)
+        return answer
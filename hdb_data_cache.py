@@ -0,0 +1,76 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+
+from get_hdb_data import load_hdb_data_from_csv
+from preprocessing_hdb_data import preprocessing_hdb_dataframe, PREPROCESSING_VERSION
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+CACHE_FOLDER = "Processed_Data/"
+CACHE_PREFIX = "cleaned_hdb_data_"
+
+
+def raw_data_cache_key(csv_files):
+    """
+    Key for the cleaned dataset built from csv_files: their paths, sizes and mtimes plus the preprocessing version
+    """
+    fingerprint = {
+        'preprocessing_version': PREPROCESSING_VERSION,
+        'files': [
+            [os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime_ns]
+            for path in sorted(csv_files)
+        ],
+    }
+    return hashlib.sha256(json.dumps(fingerprint).encode("utf-8")).hexdigest()[:16]
+
+
+def raw_data_key(data_folder):
+    """
+    raw_data_cache_key of the csv files in data_folder, None when there are none
+    """
+    csv_files = glob.glob(os.path.join(data_folder, "*.csv"))
+    return raw_data_cache_key(csv_files) if csv_files else None
+
+
+def load_cleaned_hdb_data(data_folder, cache_folder=CACHE_FOLDER):
+    """
+    Return the preprocessed HDB dataframe for the csv files in data_folder.
+    Loads the Parquet cache when the raw files and preprocessing version are unchanged,
+    otherwise rebuilds it from the csv files and replaces the old cache.
+    """
+    csv_files = glob.glob(os.path.join(data_folder, "*.csv"))
+    if not csv_files:
+        raise ValueError(f"No csv files found in {data_folder}")
+
+    cache_path = os.path.join(cache_folder, f"{CACHE_PREFIX}{raw_data_cache_key(csv_files)}.parquet")
+    if os.path.exists(cache_path):
+        with span("cache.read_parquet") as read_span:
+            cleaned_df = pd.read_parquet(cache_path)
+            read_span.set(rows=len(cleaned_df))
+        logger.info(f"Loaded cleaned data from cache {cache_path} with shape {cleaned_df.shape}")
+        return cleaned_df
+
+    logger.info(f"No valid cache in {cache_folder}, preprocessing raw csv files...")
+    cleaned_df = preprocessing_hdb_dataframe(load_hdb_data_from_csv(folder_path=data_folder))
+
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with span("cache.write_parquet", rows=len(cleaned_df)):
+            cleaned_df.to_parquet(tmp_path, index=True)
+        os.replace(tmp_path, cache_path)
+    except ImportError as e:
+        logger.warning(f"Parquet support is not installed, cleaned data not cached: {e}")
+        return cleaned_df
+
+    # keep only the cache matching the current raw files
+    for old_cache in glob.glob(os.path.join(cache_folder, f"{CACHE_PREFIX}*.parquet")):
+        if os.path.abspath(old_cache) != os.path.abspath(cache_path):
+            os.remove(old_cache)
+    logger.info(f"Cached cleaned data to {cache_path}")
+    return cleaned_df
@@ -0,0 +1,252 @@
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from get_hdb_data import iter_hdb_csv_chunks
+from preprocessing_hdb_data import preprocessing_hdb_dataframe, PREPROCESSING_VERSION
+from rag_setup import (iter_rag_document_batches, get_or_create_collection, index_document_batch, delete_documents,
+                       delete_documents_except, bump_index_version, get_index_version,
+                       VECTOR_DB_PATH, EMBEDDING_MODEL_NAME)
+from embedding import EMBEDDING_BATCH_SIZE
+from streaming_index import STREAMING_CHUNK_SIZE
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+STORE_FOLDER = "Processed_Data/cleaned_store/"
+DOWNLOAD_FOLDER = "Processed_Data/downloads/"
+MANIFEST_FILENAME = "ingest_manifest.json"
+
+
+def file_sha256(path, length=None):
+    """
+    sha256 of a file's content, or of its first length bytes
+    """
+    digest = hashlib.sha256()
+    remaining = length
+    with open(path, "rb") as source_file:
+        while remaining is None or remaining > 0:
+            block = source_file.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Record of every ingested source: its version, content hash and size, how many of its rows were ingested,
+    the global row ranges those rows were numbered with (document ids are hdb_<row>) and the cleaned store
+    parts holding them. Saved after every source so an interrupted run only repeats the source in progress.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as manifest_file:
+                self.data = json.load(manifest_file)
+        except (OSError, ValueError):
+            self.data = None
+        if self.data is None or self.data.get('preprocessing_version') != PREPROCESSING_VERSION:
+            if self.data is not None:
+                logger.info("Preprocessing changed since the last ingestion, ingesting every source again")
+            self.data = {'preprocessing_version': PREPROCESSING_VERSION, 'next_row': 0, 'sources': {}}
+
+    @property
+    def sources(self):
+        return self.data['sources']
+
+    def allocate_rows(self, count):
+        """
+        First row of a new range of count rows
+        """
+        start = self.data['next_row']
+        self.data['next_row'] += count
+        return start
+
+    def total_rows(self):
+        return sum(end - start for entry in self.sources.values() for start, end in entry['ranges'])
+
+    def parts(self):
+        return [part for entry in self.sources.values() for part in entry['parts']]
+
+    def row_filter(self):
+        """
+        keep(doc_id) for the document ids of rows in the recorded ranges
+        """
+        ranges = sorted(tuple(row_range) for entry in self.sources.values() for row_range in entry['ranges'])
+        starts = [start for start, _ in ranges]
+
+        def keep(doc_id):
+            row = doc_id[4:] if doc_id.startswith("hdb_") else ""
+            if not row.isdigit():
+                return False
+            position = bisect.bisect_right(starts, int(row)) - 1
+            return position >= 0 and int(row) < ranges[position][1]
+        return keep
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.data, manifest_file, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def _concat_parts(frames):
+    # parts carry their own categories, union them instead of falling back to strings
+    categorical = [column for column in frames[0].columns
+                   if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+    dtypes = {column: pd.CategoricalDtype(union_categoricals([frame[column] for frame in frames],
+                                                             ignore_order=True).categories)
+              for column in categorical}
+    return pd.concat([frame.astype(dtypes) for frame in frames])
+
+
+def load_cleaned_store(store_folder=STORE_FOLDER, columns=None):
+    """
+    Cleaned rows of every ingested source as one dataframe indexed by row id,
+    optionally reading only the given columns
+    """
+    manifest = IngestManifest(os.path.join(store_folder, MANIFEST_FILENAME))
+    parts = sorted(manifest.parts())
+    if not parts:
+        raise ValueError(f"Nothing ingested into {store_folder} yet")
+    with span("store.read_parquet", parts=len(parts)) as read_span:
+        cleaned_df = _concat_parts([pd.read_parquet(os.path.join(store_folder, part), columns=columns)
+                                    for part in parts])
+        read_span.set(rows=len(cleaned_df))
+    return cleaned_df
+
+
+def _remove_source(manifest, source_id, store_folder, collection, keyword_index):
+    # drop a source's rows from the cleaned store and the index
+    entry = manifest.sources.pop(source_id)
+    for part in entry['parts']:
+        part_path = os.path.join(store_folder, part)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    delete_documents(collection, [f"hdb_{row}" for start, end in entry['ranges'] for row in range(start, end)],
+                     keyword_index)
+    logger.info(f"Removed {entry['rows']} rows of {source_id}")
+
+
+def _ingest_rows(path, source_id, first_row, manifest, store_folder, collection, embedding_model, chunk_size,
+                 model_name, batch_size, keyword_index):
+    # preprocess, store and index the rows of path from first_row on, numbered from the manifest's next row
+    start = manifest.data['next_row']
+    parts = []
+    rows = 0
+    for chunk in iter_hdb_csv_chunks(path, chunk_size, first_row=first_row, start_index=start - first_row):
+        with span("ingest.chunk", rows=len(chunk), source=source_id):
+            clean_chunk = preprocessing_hdb_dataframe(chunk).assign(source_id=source_id)
+            part = f"part-{chunk.index[0]:012d}.parquet"
+            clean_chunk.to_parquet(os.path.join(store_folder, part), index=True)
+            parts.append(part)
+            for documents in iter_rag_document_batches(clean_chunk):
+                index_document_batch(collection, embedding_model, documents, model_name, batch_size,
+                                     keyword_index=keyword_index)
+        rows += len(chunk)
+    manifest.allocate_rows(rows)
+    return [start, start + rows], parts
+
+
+def _resync_index(manifest, store_folder, collection, embedding_model, model_name, batch_size, keyword_index):
+    # re-add store rows missing from the index or the keyword index, unchanged documents are not embedded again
+    logger.info("Index out of step with the cleaned store, re-syncing it from the store")
+    for part in sorted(manifest.parts()):
+        clean_part = pd.read_parquet(os.path.join(store_folder, part))
+        for documents in iter_rag_document_batches(clean_part):
+            index_document_batch(collection, embedding_model, documents, model_name, batch_size,
+                                 keyword_index=keyword_index)
+
+
+@traced("ingest_new_sources")
+def ingest_new_sources(source_client, store_folder=STORE_FOLDER, persist_directory=VECTOR_DB_PATH,
+                       download_folder=DOWNLOAD_FOLDER, chunk_size=STREAMING_CHUNK_SIZE,
+                       model_name=EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE, keyword_index=None):
+    """
+    Bring the cleaned store and the vector index up to date with the sources listed by source_client
+    (a LocalDirectorySource or DataGovSGSource), processing only what the manifest has not seen.
+    A source whose file only grew has just its new rows appended, a changed source is replaced and a
+    source no longer listed is removed. A keyword_index is kept in step with the vector index.
+    Returns (collection, embedding_model).
+    """
+    os.makedirs(store_folder, exist_ok=True)
+    manifest = IngestManifest(os.path.join(store_folder, MANIFEST_FILENAME))
+    collection, embedding_model = get_or_create_collection(persist_directory, model_name, batch_size)
+
+    # parts of a source interrupted before the manifest was saved
+    recorded_parts = set(manifest.parts())
+    for part_path in glob.glob(os.path.join(store_folder, "part-*.parquet")):
+        if os.path.basename(part_path) not in recorded_parts:
+            os.remove(part_path)
+
+    listed = source_client.list_sources()
+    changed = 0
+    for source in listed:
+        source_id = source['source_id']
+        entry = manifest.sources.get(source_id)
+        if entry is not None and entry['version'] == source['version']:
+            continue
+
+        path = source_client.fetch(source, download_folder)
+        size = os.path.getsize(path)
+        sha256 = file_sha256(path)
+        if entry is not None and entry['sha256'] == sha256:
+            entry['version'] = source['version']
+            manifest.save()
+            continue
+
+        first_row = 0
+        if entry is not None and size > entry['bytes'] and file_sha256(path, entry['bytes']) == entry['sha256']:
+            # the same file with rows appended, e.g. the latest month of the current dataset
+            first_row = entry['rows']
+            logger.info(f"{source['name']} grew, ingesting the rows after row {first_row}")
+        elif entry is not None:
+            logger.info(f"{source['name']} changed, replacing its rows")
+            _remove_source(manifest, source_id, store_folder, collection, keyword_index)
+            entry = None
+        else:
+            logger.info(f"New source {source['name']}")
+
+        row_range, parts = _ingest_rows(path, source_id, first_row, manifest, store_folder, collection,
+                                        embedding_model, chunk_size, model_name, batch_size, keyword_index)
+        new_rows = row_range[1] - row_range[0]
+        if entry is None:
+            entry = manifest.sources[source_id] = {'name': source['name'], 'ranges': [], 'parts': []}
+        entry.update(version=source['version'], sha256=sha256, bytes=size, rows=first_row + new_rows,
+                     ingested_at=datetime.now(timezone.utc).isoformat())
+        entry['ranges'].append(row_range)
+        entry['parts'].extend(parts)
+        manifest.save()
+        changed += new_rows
+        logger.info(f"Ingested {new_rows} rows of {source['name']} as rows {row_range[0]}-{row_range[1] - 1}")
+
+    for source_id in set(manifest.sources) - {source['source_id'] for source in listed}:
+        changed += manifest.sources[source_id]['rows']
+        _remove_source(manifest, source_id, store_folder, collection, keyword_index)
+        manifest.save()
+
+    total_rows = manifest.total_rows()
+    if collection.count() < total_rows or (keyword_index is not None and keyword_index.count() < total_rows):
+        _resync_index(manifest, store_folder, collection, embedding_model, model_name, batch_size, keyword_index)
+        changed += 1
+    if changed or collection.count() != total_rows:
+        # drop documents of interrupted runs and of rows no source holds anymore
+        changed += delete_documents_except(collection, manifest.row_filter(), keyword_index)
+    if changed or get_index_version(collection) is None:
+        bump_index_version(collection)
+
+    current_span().set(rows=total_rows, changed=changed)
+    logger.info(f"Cleaned store holds {total_rows} rows from {len(manifest.sources)} sources, "
+                f"vector database holds {collection.count()} documents")
+    return collection, embedding_model
@@ -0,0 +1,242 @@
+import itertools
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+from hdb_question_parser import parse_question, HDB_TOWNS, HDB_FLAT_TYPES
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+MEASURES = ('resale_price', 'price_per_sqm')
+PERCENTILES = (5, 10, 25, 75, 90, 95)
+STATISTICS = ('count', 'mean', 'median', 'min', 'max') + tuple(f"p{p}" for p in PERCENTILES)
+
+# Every grouping of the cube, a cell key is (town, flat_type, year, month) with None for "all"
+GROUPING_SETS = [
+    dims for size in range(4) for dims in itertools.combinations(('town', 'flat_type', 'year'), size)
+] + [('town', 'flat_type', 'month'), ('town', 'month'), ('flat_type', 'month'), ('month',)]
+
+STATISTIC_LABELS = {'count': 'number of transactions', 'mean': 'average', 'median': 'median',
+                    'min': 'lowest', 'max': 'highest'}
+MEASURE_LABELS = {'resale_price': 'resale price', 'price_per_sqm': 'price per sqm'}
+MAX_ANSWER_LINES = 20
+PRICE_CUBE_COLUMNS = ['town', 'flat_type', 'month', 'floor_area_sqm', 'resale_price']  # what from_dataframe reads
+PRICE_CUBE_FILENAME = "price_cube.npz"  # saved next to the vector index so the two form one serving snapshot
+
+
+def _statistic_label(statistic):
+    if statistic in STATISTIC_LABELS:
+        return STATISTIC_LABELS[statistic]
+    return f"{statistic[1:]}th percentile"
+
+
+def _format_value(statistic, measure, value):
+    if statistic == 'count':
+        return f"{value:,.0f}"
+    if measure == 'price_per_sqm':
+        return f"${value:,.0f} per sqm"
+    return f"${value:,.0f}"
+
+
+def _describe_cell(town, flat_type, year, month):
+    description = f"{flat_type} flats" if flat_type else "HDB flats"
+    if town:
+        description += f" in {town}"
+    if month:
+        description += f" in {pd.Timestamp(month + '-01').strftime('%B %Y')}"
+    elif year:
+        description += f" in {year}"
+    return description
+
+
+class HDBPriceCube:
+    """
+    Precomputed price statistics of the cleaned HDB data grouped by town x flat_type x year/month, plus rollups.
+    Cell values live in one float array, cell keys map to its rows.
+    """
+
+    def __init__(self, cell_index, values):
+        self._cell_index = cell_index
+        self._values = values
+        self._columns = {(measure, statistic): i for i, (measure, statistic)
+                         in enumerate(itertools.product(MEASURES, STATISTICS))}
+        keys = list(cell_index)
+        self.towns = sorted({key[0] for key in keys if key[0] is not None})
+        self.flat_types = sorted({key[1] for key in keys if key[1] is not None})
+        self.years = sorted({key[2] for key in keys if key[2] is not None})
+        self.index_version = None  # vector index and raw data the saved cube was built alongside
+        self.data_key = None
+
+    def __len__(self):
+        return len(self._cell_index)
+
+    @classmethod
+    @traced("price_cube.build")
+    def from_dataframe(cls, df):
+        """
+        Build the cube from the dataframe returned by preprocessing_hdb_dataframe
+        """
+        current_span().set(rows=len(df))
+        logger.info("Building price aggregate cube...")
+        work = pd.DataFrame({
+            'town': df['town'].astype(str),
+            'flat_type': df['flat_type'].astype(str),
+            'year': df['month'].dt.year,
+            'month': df['month'].dt.strftime('%Y-%m'),
+            'resale_price': df['resale_price'].astype(float),
+            'price_per_sqm': df['resale_price'].astype(float) / df['floor_area_sqm'].astype(float),
+        }).dropna(subset=['year'])
+        work['year'] = work['year'].astype(int)
+
+        cell_keys = []
+        blocks = []
+        quantiles = [p / 100 for p in PERCENTILES]
+        for dims in GROUPING_SETS:
+            if dims:
+                grouped = work.groupby(list(dims), observed=True, sort=False)[list(MEASURES)]
+            else:
+                grouped = work.assign(_all=0).groupby('_all')[list(MEASURES)]
+            stats = grouped.agg(['count', 'mean', 'median', 'min', 'max'])
+            # quantile() returns groups in sorted order whatever sort says, line them up with stats
+            percentiles = grouped.quantile(quantiles).unstack().reindex(stats.index)
+            columns = []
+            for measure in MEASURES:
+                columns.extend(stats[(measure, statistic)].to_numpy(dtype=float) for statistic in STATISTICS[:5])
+                columns.extend(percentiles[(measure, q)].to_numpy(dtype=float) for q in quantiles)
+            blocks.append(np.column_stack(columns))
+
+            index = stats.index.to_frame(index=False)
+            for values in index.itertuples(index=False):
+                named = dict(zip(dims, values)) if dims else {}
+                cell_keys.append((named.get('town'), named.get('flat_type'),
+                                  int(named['year']) if 'year' in named else None, named.get('month')))
+
+        values = np.vstack(blocks)
+        cube = cls({key: row for row, key in enumerate(cell_keys)}, values)
+        logger.info(f"Price cube built with {len(cube)} cells")
+        return cube
+
+    def save(self, path, index_version=None, data_key=None):
+        """
+        Write the cube to a .npz file, written to a temporary file first so readers never see a partial cube.
+        index_version and data_key (raw_data_key of the csv files) record what the cube was built alongside.
+        """
+        self.index_version, self.data_key = index_version, data_key
+        keys = list(self._cell_index)
+        rows = np.fromiter(self._cell_index.values(), dtype=np.int64, count=len(keys))
+        temp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            temp_path,
+            values=self._values[rows],
+            town=np.array([key[0] or '' for key in keys]),
+            flat_type=np.array([key[1] or '' for key in keys]),
+            year=np.array([key[2] if key[2] is not None else -1 for key in keys], dtype=np.int64),
+            month=np.array([key[3] or '' for key in keys]),
+            index_version=np.array(index_version or ''),
+            data_key=np.array(data_key or ''),
+        )
+        os.replace(temp_path, path)
+        logger.info(f"Price cube with {len(keys)} cells saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a cube written by save, without the cleaned dataframe
+        """
+        with span("price_cube.load", path=path), np.load(path) as data:
+            cell_keys = zip(data['town'].tolist(), data['flat_type'].tolist(), data['year'].tolist(),
+                            data['month'].tolist())
+            cell_index = {(town or None, flat_type or None, year if year >= 0 else None, month or None): row
+                          for row, (town, flat_type, year, month) in enumerate(cell_keys)}
+            cube = cls(cell_index, data['values'])
+            # cubes saved before the versions were recorded match no index
+            cube.index_version = (str(data['index_version']) or None) if 'index_version' in data else None
+            cube.data_key = (str(data['data_key']) or None) if 'data_key' in data else None
+        logger.info(f"Price cube with {len(cube)} cells loaded from {path}")
+        return cube
+
+    def lookup(self, town=None, flat_type=None, year=None, month=None, measure='resale_price', statistic='mean'):
+        """
+        Statistic of a measure for one cell, None when the cell or the statistic does not exist
+        """
+        row = self._cell_index.get((town, flat_type, year, month))
+        column = self._columns.get((measure, statistic))
+        if row is None or column is None:
+            return None
+        return float(self._values[row, column])
+
+    def answer(self, intent):
+        """
+        Answer a parsed question intent from the cube, None when the intent is not structured
+        or asks for a statistic the cube does not hold
+        """
+        if not intent['structured'] or (intent['measure'], intent['statistic']) not in self._columns:
+            return None
+
+        statistic, measure = intent['statistic'], intent['measure']
+        label = _statistic_label(statistic)
+        years = intent['years']
+        first_year, last_year = intent.get('year_range', (None, None))
+        if not years and (first_year is not None or last_year is not None):
+            years = [year for year in self.years
+                     if (first_year is None or year >= first_year) and (last_year is None or year <= last_year)]
+        if intent['month']:
+            periods = [(None, intent['month'])]
+        else:
+            periods = [(year, None) for year in years] or [(None, None)]
+        towns = intent['towns'] or [None]
+        flat_types = intent['flat_types'] or [None]
+
+        if intent['rank_by']:
+            return self._answer_ranking(intent, towns[0], flat_types[0], periods[0])
+
+        lines = []
+        for town, flat_type, (year, month) in itertools.product(towns, flat_types, periods):
+            value = self.lookup(town, flat_type, year, month, measure, statistic)
+            count = self.lookup(town, flat_type, year, month, measure, 'count')
+            description = _describe_cell(town, flat_type, year, month)
+            if value is None or not count:
+                lines.append(f"- {description}: no transactions in the data")
+            elif statistic == 'count':
+                lines.append(f"- {description}: {value:,.0f} transactions")
+            else:
+                lines.append(f"- {description}: {label} {MEASURE_LABELS[measure]} "
+                             f"{_format_value(statistic, measure, value)} (from {count:,.0f} transactions)")
+
+        coverage = f"{self.years[0]}-{self.years[-1]}" if self.years else "none"
+        return (f"Based on all HDB resale transactions in the data (years covered: {coverage}):\n"
+                + "\n".join(lines[:MAX_ANSWER_LINES]))
+
+    def _answer_ranking(self, intent, town, flat_type, period):
+        # rank the dimension left open by the question on its average
+        year, month = period
+        measure = intent['measure']
+        candidates = self.flat_types if intent['rank_by'] == 'flat_type' else self.towns
+        ranked = []
+        for candidate in candidates:
+            key_town, key_flat_type = (town, candidate) if intent['rank_by'] == 'flat_type' else (candidate, flat_type)
+            value = self.lookup(key_town, key_flat_type, year, month, measure, 'mean')
+            if value is not None:
+                ranked.append((value, candidate))
+        if not ranked:
+            return f"No transactions in the data for {_describe_cell(town, flat_type, year, month)}."
+
+        ranked.sort(reverse=intent['statistic'] == 'max')
+        dimension = "flat type" if intent['rank_by'] == 'flat_type' else "town"
+        superlative = "most expensive" if intent['statistic'] == 'max' else "cheapest"
+        lines = [f"- {candidate}: average {MEASURE_LABELS[measure]} {_format_value('mean', measure, value)}"
+                 for value, candidate in ranked[:MAX_ANSWER_LINES]]
+        return (f"The {superlative} {dimension} for {_describe_cell(town, flat_type, year, month)} is "
+                f"{ranked[0][1]} on average:\n" + "\n".join(lines))
+
+    def answer_question(self, question):
+        """
+        Parse a question and answer it from the cube, None when it has no structured intent
+        """
+        with span("price_cube.answer") as answer_span:
+            answer = self.answer(parse_question(question, towns=self.towns or HDB_TOWNS,
+                                                flat_types=self.flat_types or HDB_FLAT_TYPES))
+            answer_span.set(answered=answer is not None)
+        return answer
@@ -0,0 +1,166 @@
+import re
+from functools import lru_cache
+
+# Towns and flat types as they appear in the HDB resale data
+HDB_TOWNS = [
+    'ANG MO KIO', 'BEDOK', 'BISHAN', 'BUKIT BATOK', 'BUKIT MERAH', 'BUKIT PANJANG', 'BUKIT TIMAH',
+    'CENTRAL AREA', 'CHOA CHU KANG', 'CLEMENTI', 'GEYLANG', 'HOUGANG', 'JURONG EAST', 'JURONG WEST',
+    'KALLANG/WHAMPOA', 'MARINE PARADE', 'PASIR RIS', 'PUNGGOL', 'QUEENSTOWN', 'SEMBAWANG', 'SENGKANG',
+    'SERANGOON', 'TAMPINES', 'TOA PAYOH', 'WOODLANDS', 'YISHUN',
+]
+HDB_FLAT_TYPES = ['1 ROOM', '2 ROOM', '3 ROOM', '4 ROOM', '5 ROOM', 'EXECUTIVE', 'MULTI-GENERATION']
+
+# Short names people use for towns, only applied when no full town name matched
+TOWN_ALIASES = {
+    'jurong': ['JURONG EAST', 'JURONG WEST'],
+    'kallang': ['KALLANG/WHAMPOA'],
+    'whampoa': ['KALLANG/WHAMPOA'],
+    'amk': ['ANG MO KIO'],
+    'cck': ['CHOA CHU KANG'],
+    'central': ['CENTRAL AREA'],
+}
+
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september',
+               'october', 'november', 'december']
+
+_FLAT_TYPE_PATTERNS = [
+    (re.compile(r'\b([1-5])\s*[- ]?\s*(?:room|rm)s?\b'), None),
+    (re.compile(r'\bexec(?:utive)?s?\b'), 'EXECUTIVE'),
+    (re.compile(r'\bmulti[\s-]?gen(?:eration)?\b'), 'MULTI-GENERATION'),
+]
+_YEAR_PATTERN = re.compile(r'\b(19[6-9]\d|20\d\d)\b')
+_YEAR = r'(19[6-9]\d|20\d\d)'
+_YEAR_BETWEEN_PATTERN = re.compile(r'\b(?:between|from)\s+' + _YEAR + r'\s+(?:and|to|until|till)\s+' + _YEAR + r'\b'
+                                   r'|\b' + _YEAR + r'\s*(?:-|to)\s*' + _YEAR + r'\b')
+_YEAR_SINCE_PATTERN = re.compile(r'\b(since|after|from|onwards? from)\s+' + _YEAR + r'\b|\b' + _YEAR + r'\s+onwards?\b')
+_YEAR_BEFORE_PATTERN = re.compile(r'\b(before|until|till|up to|prior to)\s+' + _YEAR + r'\b')
+_MONTH_YEAR_PATTERN = re.compile(
+    r'\b(' + '|'.join(name[:3] for name in MONTH_NAMES) + r')[a-z]*\.?\s+(19[6-9]\d|20\d\d)\b')
+_PERCENTILE_PATTERN = re.compile(r'\b(\d{1,2})(?:st|nd|rd|th)?\s*percentile\b|\bp(\d{1,2})\b')
+_PER_SQM_PATTERN = re.compile(r'per\s*(?:sqm|square\s*met(?:er|re)s?|m2)|\bpsm\b')
+_PRICE_WORDS_PATTERN = re.compile(r'\b(price|prices|priced|cost|costs|sold|sell|selling|worth|value|how much)\b')
+_PRICE_ADJECTIVES_PATTERN = re.compile(r'\b(cheap|cheaper|cheapest|expensive|pricier|priciest|dearest)\b')
+# measures other than price, a statistic of these is left to retrieval unless the question also asks about price
+_OTHER_MEASURE_PATTERN = re.compile(r'\b(lease|leases|floor area|size|sizes|sqm|square met(?:er|re)s?|storey|storeys|'
+                                    r'floor|floors|level|levels|built|age|older|oldest|newer|newest)\b')
+
+# (pattern, statistic) checked in order, first match wins
+_STATISTIC_PATTERNS = [
+    (re.compile(r'\bmedian\b'), 'median'),
+    (re.compile(r'\b(average|mean|avg|typical)\b'), 'mean'),
+    (re.compile(r'\b(most expensive|highest|maximum|max|priciest|dearest)\b'), 'max'),
+    (re.compile(r'\b(cheapest|least expensive|lowest|minimum)\b|(?<!\d )\bmin\b'), 'min'),  # but not "10 min walk"
+    (re.compile(r'\b(how many|number of|count of|volume)\b'), 'count'),
+]
+_RANK_PATTERNS = [
+    (re.compile(r'\bflat[\s-]?types?\b'), 'flat_type'),
+    (re.compile(r'\b(town|towns|estate|estates|area|areas)\b'), 'town'),
+]
+
+
+@lru_cache(maxsize=None)
+def _town_pattern(town):
+    words = re.split(r'[\s/]+', town.lower())
+    return re.compile(r'\b' + r'[\s/-]*'.join(re.escape(word) for word in words) + r'\b')
+
+
+def _parse_year_range(text):
+    # (first year, last year) of an explicit period such as "between 2013 and 2015", None for an open end
+    between = _YEAR_BETWEEN_PATTERN.search(text)
+    if between:
+        start, end = sorted(int(year) for year in between.groups() if year)
+        return start, end
+    since = _YEAR_SINCE_PATTERN.search(text)
+    if since:
+        year = int(since.group(2) or since.group(3))
+        return (year + 1 if since.group(1) == 'after' else year), None
+    before = _YEAR_BEFORE_PATTERN.search(text)
+    if before:
+        year = int(before.group(2))
+        return None, (year - 1 if before.group(1) in ('before', 'prior to') else year)
+    return None, None
+
+
+def parse_question(question, towns=HDB_TOWNS, flat_types=HDB_FLAT_TYPES):
+    """
+    Extract the structured intent of a question: towns, flat types, years and year range, month,
+    statistic and measure.
+    'structured' is True when the question can be answered from aggregate statistics.
+    """
+    text = question.lower()
+
+    # towns, full names first, then aliases on what is left
+    found_towns = []
+    remaining = text
+    for town in towns:
+        match = _town_pattern(town).search(remaining)
+        if match:
+            found_towns.append(town)
+            remaining = remaining[:match.start()] + ' ' + remaining[match.end():]
+    for alias, alias_towns in TOWN_ALIASES.items():
+        if _town_pattern(alias).search(remaining):
+            found_towns.extend(town for town in alias_towns if town in towns and town not in found_towns)
+
+    # flat types
+    found_flat_types = []
+    for pattern, flat_type in _FLAT_TYPE_PATTERNS:
+        for match in pattern.finditer(text):
+            value = flat_type or f"{match.group(1)} ROOM"
+            if value in flat_types and value not in found_flat_types:
+                found_flat_types.append(value)
+
+    # month and year
+    month = None
+    month_match = _MONTH_YEAR_PATTERN.search(text)
+    if month_match:
+        month_number = [name[:3] for name in MONTH_NAMES].index(month_match.group(1)) + 1
+        month = f"{month_match.group(2)}-{month_number:02d}"
+    years = sorted({int(year) for year in _YEAR_PATTERN.findall(text)})
+    year_range = _parse_year_range(text)
+    if year_range != (None, None):
+        # years lists every year of a closed range, open ranges are resolved against the data
+        years = list(range(year_range[0], year_range[1] + 1)) if None not in year_range else []
+    elif years:
+        year_range = (years[0], years[-1])
+
+    measure = 'price_per_sqm' if _PER_SQM_PATTERN.search(text) else 'resale_price'
+    asks_price = bool(_PRICE_WORDS_PATTERN.search(text)) or measure == 'price_per_sqm'
+
+    # statistic, of the price unless the question is about another measure such as the lease or floor area
+    statistic = None
+    percentile_match = _PERCENTILE_PATTERN.search(text)
+    if percentile_match:
+        percentile = int(percentile_match.group(1) or percentile_match.group(2))
+        statistic = 'median' if percentile == 50 else f"p{percentile}"
+    else:
+        for pattern, name in _STATISTIC_PATTERNS:
+            if pattern.search(text):
+                statistic = name
+                break
+    if (statistic is not None and _OTHER_MEASURE_PATTERN.search(text)
+            and not (asks_price or _PRICE_ADJECTIVES_PATTERN.search(text))):
+        statistic = None
+
+    # "most expensive flat type" ranks a dimension that was not pinned down
+    rank_by = None
+    if statistic in ('max', 'min'):
+        for pattern, dimension in _RANK_PATTERNS:
+            pinned = found_flat_types if dimension == 'flat_type' else found_towns
+            if pattern.search(text) and not pinned:
+                rank_by = dimension
+                break
+
+    has_entities = bool(found_towns or found_flat_types or years or month)
+    structured = statistic is not None or (has_entities and asks_price)
+
+    return {
+        'towns': found_towns,
+        'flat_types': found_flat_types,
+        'years': years,
+        'year_range': year_range,
+        'month': month,
+        'statistic': statistic or 'mean',
+        'measure': measure,
+        'rank_by': rank_by,
+        'structured': structured,
+    }
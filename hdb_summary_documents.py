@@ -0,0 +1,222 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+# Grouping of each summary level, every group becomes one document
+SUMMARY_LEVELS = {
+    'year': ('town', 'flat_type', 'year'),
+    'quarter': ('town', 'flat_type', 'year', 'quarter'),
+    'street': ('town', 'street_name', 'flat_type'),
+    'block': ('town', 'street_name', 'block'),
+}
+DEFAULT_SUMMARY_LEVELS = ('year', 'quarter', 'street')
+QUARTER_LEVEL_YEARS = 5  # quarterly summaries for the most recent years only, the yearly ones cover all history
+TOP_ITEMS = 3
+
+
+def _summary_frame(df):
+    # the columns the summaries are computed from, one row per transaction
+    work = pd.DataFrame({
+        'town': df['town'].astype(str),
+        'flat_type': df['flat_type'].astype(str),
+        'street_name': df['street_name'].astype(str),
+        'block': df['block'].astype(str),
+        'year': df['month'].dt.year,
+        'quarter': df['month'].dt.quarter,
+        'price': df['resale_price'].astype(float),
+        'price_per_sqm': df['resale_price'].astype(float) / df['floor_area_sqm'].astype(float),
+        'floor_area_sqm': df['floor_area_sqm'].astype(float),
+        'lease_commence_year': df['lease_commence_date'].dt.year,
+        # 0 marks a missing remaining lease after preprocessing
+        'remaining_lease': df['remaining_lease'].astype(float).where(df['remaining_lease'] > 0),
+    }).dropna(subset=['year'])
+    work['year'] = work['year'].astype(int)
+    work['quarter'] = work['quarter'].astype(int)
+    return work
+
+
+def _top_items(work, dims, column):
+    # "A (12), B (7), C (3)": the most frequent values of column within each group
+    counts = work.groupby(list(dims) + [column], observed=True).size().rename('n').reset_index()
+    counts = counts.sort_values(list(dims) + ['n', column], ascending=[True] * len(dims) + [False, True])
+    counts = counts.groupby(list(dims), observed=True).head(TOP_ITEMS)
+    counts['item'] = counts[column].astype(str) + " (" + counts['n'].map('{:,}'.format) + ")"
+    return counts.groupby(list(dims), observed=True)['item'].agg(', '.join)
+
+
+def _group_statistics(work, dims):
+    grouped = work.groupby(list(dims), observed=True, sort=True)
+    stats = grouped.agg(
+        count=('price', 'size'),
+        mean=('price', 'mean'),
+        median=('price', 'median'),
+        min=('price', 'min'),
+        max=('price', 'max'),
+        price_per_sqm=('price_per_sqm', 'median'),
+        floor_area_sqm=('floor_area_sqm', 'median'),
+        built_first=('lease_commence_year', 'min'),
+        built_median=('lease_commence_year', 'median'),
+        built_last=('lease_commence_year', 'max'),
+        remaining_lease=('remaining_lease', 'median'),
+        first_year=('year', 'min'),
+        last_year=('year', 'max'),
+    )
+    percentiles = grouped['price'].quantile([0.1, 0.9]).unstack()
+    stats['p10'] = percentiles[0.1]
+    stats['p90'] = percentiles[0.9]
+    return stats
+
+
+def _add_trend(stats, work, level, dims):
+    # average price against the previous period, or first against last year for streets and blocks
+    if level in ('year', 'quarter'):
+        series_dims = [dim for dim in dims if dim not in ('year', 'quarter')]
+        previous = stats.groupby(level=series_dims, observed=True)[['mean']].shift()
+        period = stats.index.to_frame(index=False)
+        previous_period = period.groupby(series_dims, observed=True).shift()
+        stats['trend_from'] = previous['mean']
+        if level == 'year':
+            stats['trend_label'] = previous_period['year'].to_numpy()
+        else:
+            stats['trend_label'] = (previous_period['year'].astype('Int64').astype(str) + " Q"
+                                    + previous_period['quarter'].astype('Int64').astype(str)).to_numpy()
+        stats['trend_to'] = stats['mean']
+        return stats
+    yearly = work.groupby(list(dims) + ['year'], observed=True)['price'].mean()
+    by_group = yearly.groupby(level=list(dims), observed=True)
+    stats['trend_from'] = by_group.first()
+    stats['trend_to'] = by_group.last()
+    stats['trend_label'] = stats['first_year']
+    return stats
+
+
+def _period_label(level, key, stats_row):
+    if level == 'year':
+        return str(key['year'])
+    if level == 'quarter':
+        return f"{key['year']} Q{key['quarter']}"
+    first_year, last_year = int(stats_row['first_year']), int(stats_row['last_year'])
+    return str(first_year) if first_year == last_year else f"{first_year}-{last_year}"
+
+
+def _trend_text(level, stats_row):
+    if pd.isna(stats_row['trend_from']) or stats_row['trend_from'] <= 0:
+        return "no earlier period to compare with"
+    change = (stats_row['trend_to'] / stats_row['trend_from'] - 1) * 100
+    direction = "up" if change >= 0 else "down"
+    if level in ('year', 'quarter'):
+        return f"average price {direction} {abs(change):.1f}% from {stats_row['trend_label']}"
+    if stats_row['first_year'] == stats_row['last_year']:
+        return "sales in a single year only"
+    return (f"average price {direction} {abs(change):.1f}% from {int(stats_row['first_year'])} "
+            f"to {int(stats_row['last_year'])}")
+
+
+def _subject(level, key):
+    flat_type = f"{key['flat_type']} HDB flats" if key.get('flat_type') else "HDB flats"
+    if level in ('year', 'quarter'):
+        return f"{flat_type} in {key['town']}"
+    if level == 'street':
+        return f"{flat_type} on {key['street_name']}, {key['town']}"
+    return f"{flat_type} at Block {key['block']} {key['street_name']}, {key['town']}"
+
+
+def _format_summary(level, key, stats_row, top_items):
+    period = _period_label(level, key, stats_row)
+    remaining = (f", median {stats_row['remaining_lease']:.0f} years lease remaining"
+                 if pd.notna(stats_row['remaining_lease']) else "")
+    lines = [
+        f"{_subject(level, key)} in {period} (summary of {stats_row['count']:,.0f} resale transactions):",
+        f"- Resale price: median ${stats_row['median']:,.0f}, average ${stats_row['mean']:,.0f}, "
+        f"range ${stats_row['min']:,.0f} - ${stats_row['max']:,.0f} "
+        f"(10th-90th percentile ${stats_row['p10']:,.0f} - ${stats_row['p90']:,.0f})",
+        f"- Price per sqm: median ${stats_row['price_per_sqm']:,.0f}, median size {stats_row['floor_area_sqm']:.0f} sqm",
+        f"- Trend: {_trend_text(level, stats_row)}",
+        f"- Lease profile: built {stats_row['built_first']:.0f}-{stats_row['built_last']:.0f} "
+        f"(median {stats_row['built_median']:.0f}){remaining}",
+    ]
+    if top_items:
+        lines.append(f"- {top_items[0]}: {top_items[1]}")
+    return "\n".join(lines)
+
+
+_TOP_ITEM_COLUMNS = {'year': ('Busiest streets', 'street_name'), 'quarter': ('Busiest streets', 'street_name'),
+                     'street': ('Busiest blocks', 'block'), 'block': ('Flat types', 'flat_type')}
+
+
+def _level_documents(work, level):
+    dims = SUMMARY_LEVELS[level]
+    if level == 'quarter':
+        work = work[work['year'] > work['year'].max() - QUARTER_LEVEL_YEARS]
+    stats = _add_trend(_group_statistics(work, dims), work, level, dims)
+    top_label, top_column = _TOP_ITEM_COLUMNS[level]
+    top = _top_items(work, dims, top_column)
+
+    documents = []
+    for values, stats_row in zip(stats.index, stats.to_dict('records')):
+        key = dict(zip(dims, values if isinstance(values, tuple) else (values,)))
+        top_value = top.get(values)
+        documents.append({
+            'id': "summary_" + level + "_" + "|".join(str(value) for value in key.values()),
+            'text': _format_summary(level, key, stats_row, (top_label, top_value) if top_value else None),
+            'metadata': {
+                'level': level,
+                'town': key['town'],
+                'flat_type': key.get('flat_type', ''),
+                'street_name': key.get('street_name', ''),
+                'block': key.get('block', ''),
+                'price': float(stats_row['mean']),
+                'price_median': float(stats_row['median']),
+                'price_min': float(stats_row['min']),
+                'price_max': float(stats_row['max']),
+                'count': int(stats_row['count']),
+                'sold_date': _period_label(level, key, stats_row),
+                'remaining_lease': float(np.nan_to_num(stats_row['remaining_lease'])),
+                # streets and blocks span many years, year filters leave them out
+                'year': int(key.get('year', 0)),
+                'quarter': int(key.get('quarter', 0)),
+                'year_month': 0,
+            },
+        })
+    return documents
+
+
+@traced("create_summary_documents")
+def create_summary_documents(df, levels=DEFAULT_SUMMARY_LEVELS):
+    """
+    Aggregate the cleaned dataframe into summary documents, one per group of each level in levels
+    (see SUMMARY_LEVELS), with price statistics, trend and lease profile.
+    The documents have the same shape as create_rag_documents and cover every row, not a sample.
+    """
+    logger.info("Creating summary documents...")
+    work = _summary_frame(df)
+    documents = []
+    for level in levels:
+        with span("summaries.level", level=level) as level_span:
+            level_documents = _level_documents(work, level)
+            level_span.set(rows=len(level_documents))
+        logger.info(f"{len(level_documents)} {level} summaries")
+        documents.extend(level_documents)
+    current_span().set(rows=len(documents), transactions=len(work))
+    logger.info(f"Created {len(documents)} summary documents for {len(work)} transactions")
+    return documents
+
+
+def drill_down_filter(summary_metadata):
+    """
+    Where clause selecting the transaction documents a summary document was computed from
+    """
+    conditions = [{'town': summary_metadata['town']}]
+    for field in ('flat_type', 'street_name', 'block'):
+        if summary_metadata.get(field):
+            conditions.append({field: summary_metadata[field]})
+    if summary_metadata.get('year'):
+        conditions.append({'year': summary_metadata['year']})
+    if summary_metadata.get('quarter'):
+        first_month = summary_metadata['year'] * 100 + (summary_metadata['quarter'] - 1) * 3 + 1
+        conditions.append({'year_month': {'$in': [first_month, first_month + 1, first_month + 2]}})
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+from array import array
+from collections import Counter
+import numpy as np
+
+from compact_vector_store import where_mask
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+KEYWORD_INDEX_FILENAME = "keyword_index.npz"  # saved next to the vector index, part of the serving snapshot
+# metadata fields kept per document so keyword hits honour the same where clauses as vector queries
+FILTER_FIELDS = {'town': 'category', 'flat_type': 'category', 'street_name': 'category', 'block': 'category',
+                 'level': 'category', 'year': 'int', 'quarter': 'int', 'year_month': 'int'}
+MISSING = np.iinfo(np.int64).min  # integer field value of documents without the field
+BM25_K1 = 1.2
+BM25_B = 0.75
+# words and numbers, keeping "442,000" or "68.5" whole so prices and sizes don't match block numbers
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+
+
+def tokenize(text):
+    """
+    Lowercase word and number tokens of a document or question, "4-room" gives "4" and "room"
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _document_hash(doc):
+    # 64-bit hash of what the index stores about a document: its text and filter fields
+    fields = json.dumps([doc['metadata'].get(field) for field in FILTER_FIELDS])
+    digest = hashlib.blake2b(f"{doc['text']}\0{fields}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class KeywordIndex:
+    """
+    BM25 inverted index over document texts, for exact matches on towns, streets, blocks and flat types.
+    Postings are typed arrays: a compacted base (document numbers, term frequencies and per-term offsets)
+    plus per-term append buffers for documents added since, merged into the base when saved.
+    Updating a document appends a new version and marks the old one dead, so updates never rewrite postings.
+    """
+
+    def __init__(self):
+        self.index_version = None
+        self._terms = {}
+        self._base_offsets = np.zeros(1, dtype=np.int64)
+        self._base_docs = np.zeros(0, dtype=np.int32)
+        self._base_tfs = np.zeros(0, dtype=np.uint16)
+        self._added = {}  # term -> (document numbers, term frequencies) added since the last compaction
+        self._doc_ids = []
+        self._doc_numbers = {}  # id -> number of its live version
+        self._hashes = array('q')
+        self._lengths = array('I')
+        self._live = bytearray()
+        self._live_count = 0
+        self._live_length = 0
+        self._fields = {field: array('q') for field in FILTER_FIELDS}
+        self._categories = {field: {} for field, kind in FILTER_FIELDS.items() if kind == 'category'}
+
+    def count(self):
+        return self._live_count
+
+    def _kill(self, number):
+        if self._live[number]:
+            self._live[number] = 0
+            self._live_count -= 1
+            self._live_length -= self._lengths[number]
+            del self._doc_numbers[self._doc_ids[number]]
+
+    def _add(self, doc, doc_hash):
+        number = len(self._doc_ids)
+        if doc['id'] in self._doc_numbers:
+            self._kill(self._doc_numbers[doc['id']])
+        tokens = tokenize(doc['text'])
+        for token, frequency in Counter(tokens).items():
+            term = self._terms.setdefault(token, len(self._terms))
+            postings = self._added.get(term)
+            if postings is None:
+                postings = self._added[term] = (array('i'), array('H'))
+            postings[0].append(number)
+            postings[1].append(min(frequency, 65535))
+        self._doc_ids.append(doc['id'])
+        self._doc_numbers[doc['id']] = number
+        self._hashes.append(doc_hash)
+        self._lengths.append(len(tokens))
+        self._live.append(1)
+        self._live_count += 1
+        self._live_length += len(tokens)
+        for field, kind in FILTER_FIELDS.items():
+            value = doc['metadata'].get(field)
+            if kind == 'category':
+                self._fields[field].append(
+                    -1 if value is None else self._categories[field].setdefault(value, len(self._categories[field])))
+            else:
+                self._fields[field].append(MISSING if value is None else int(value))
+
+    def update(self, documents):
+        """
+        Add new documents and replace changed ones, unchanged documents are skipped.
+        Returns the number of documents indexed.
+        """
+        indexed = 0
+        with span("keyword_index.update", rows=len(documents)) as update_span:
+            for doc in documents:
+                doc_hash = _document_hash(doc)
+                number = self._doc_numbers.get(doc['id'])
+                if number is None or self._hashes[number] != doc_hash:
+                    self._add(doc, doc_hash)
+                    indexed += 1
+            update_span.set(indexed=indexed)
+        return indexed
+
+    def remove(self, ids):
+        """
+        Remove the documents with the given ids, unknown ids are ignored
+        """
+        for doc_id in ids:
+            if doc_id in self._doc_numbers:
+                self._kill(self._doc_numbers[doc_id])
+
+    def retain(self, keep):
+        """
+        Remove every document whose id keep(id) rejects, returning how many were removed
+        """
+        stale_ids = [doc_id for doc_id in self._doc_numbers if not keep(doc_id)]
+        self.remove(stale_ids)
+        return len(stale_ids)
+
+    def _postings(self, term):
+        # (document numbers, term frequencies) of a term, base and appended together
+        start, end = ((self._base_offsets[term], self._base_offsets[term + 1])
+                      if term + 1 < len(self._base_offsets) else (0, 0))
+        docs, tfs = self._base_docs[start:end], self._base_tfs[start:end]
+        if term in self._added:
+            added_docs, added_tfs = self._added[term]
+            docs = np.concatenate([docs, np.frombuffer(added_docs, dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.frombuffer(added_tfs, dtype=np.uint16)])
+        return docs, tfs
+
+    def _filter_columns(self):
+        # the filter fields in the layout where_mask reads
+        columns = {}
+        for field, kind in FILTER_FIELDS.items():
+            values = np.frombuffer(self._fields[field], dtype=np.int64)
+            if kind == 'category':
+                columns[field] = ('category', values, values >= 0, self._categories[field])
+            else:
+                columns[field] = ('int', values, values != MISSING, None)
+        return columns
+
+    def search(self, query, n_results=10, where=None):
+        """
+        (id, BM25 score) of the best matching live documents for a query, best first,
+        restricted to documents matching a Chroma style where clause on FILTER_FIELDS
+        """
+        with span("keyword_index.search", top_k=n_results, filtered=where is not None) as search_span:
+            terms = [self._terms[token] for token in dict.fromkeys(tokenize(query)) if token in self._terms]
+            if not terms or not self._live_count:
+                return []
+            live = np.frombuffer(self._live, dtype=np.uint8).astype(bool)
+            lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (self._live_length / self._live_count))
+            scores = np.zeros(len(self._doc_ids))
+            for term in terms:
+                docs, tfs = self._postings(term)
+                alive = live[docs]
+                docs, tfs = docs[alive], tfs[alive].astype(np.float64)
+                if not len(docs):
+                    continue
+                idf = math.log(1 + (self._live_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                # a document appears once in a term's postings, so the fancy-indexed add is safe
+                scores[docs] += idf * tfs * (BM25_K1 + 1) / (tfs + length_norm[docs])
+            matching = scores > 0
+            if where:
+                matching &= where_mask(where, self._filter_columns(), len(self._doc_ids))
+            candidates = np.flatnonzero(matching)
+            if len(candidates) > n_results:
+                candidates = candidates[np.argpartition(-scores[candidates], n_results - 1)[:n_results]]
+            best = candidates[np.argsort(-scores[candidates], kind='stable')]
+            search_span.set(rows=len(best))
+        return [(self._doc_ids[number], float(scores[number])) for number in best]
+
+    def _compact(self):
+        # merge appended postings into the base and drop dead documents, renumbering the live ones
+        live = np.frombuffer(self._live, dtype=np.uint8).astype(bool)
+        new_numbers = np.full(len(live), -1, dtype=np.int64)
+        new_numbers[live] = np.arange(live.sum())
+
+        term_parts = [np.repeat(np.arange(len(self._base_offsets) - 1), np.diff(self._base_offsets))]
+        doc_parts = [self._base_docs.astype(np.int64)]
+        tf_parts = [self._base_tfs]
+        for term, (docs, tfs) in self._added.items():
+            term_parts.append(np.full(len(docs), term, dtype=np.int64))
+            doc_parts.append(np.frombuffer(docs, dtype=np.int32).astype(np.int64))
+            tf_parts.append(np.frombuffer(tfs, dtype=np.uint16))
+        terms, docs, tfs = np.concatenate(term_parts), np.concatenate(doc_parts), np.concatenate(tf_parts)
+        alive = live[docs]
+        terms, docs, tfs = terms[alive], new_numbers[docs[alive]], tfs[alive]
+        order = np.lexsort((docs, terms))
+        self._base_docs = docs[order].astype(np.int32)
+        self._base_tfs = tfs[order]
+        self._base_offsets = np.zeros(len(self._terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self._terms)), out=self._base_offsets[1:])
+        self._added = {}
+
+        keep = np.flatnonzero(live)
+        self._doc_ids = [self._doc_ids[number] for number in keep]
+        self._doc_numbers = {doc_id: number for number, doc_id in enumerate(self._doc_ids)}
+        self._hashes = array('q', np.frombuffer(self._hashes, dtype=np.int64)[keep].tobytes())
+        self._lengths = array('I', np.frombuffer(self._lengths, dtype=np.uint32)[keep].tobytes())
+        self._live = bytearray(b"\x01" * len(keep))
+        for field in FILTER_FIELDS:
+            self._fields[field] = array('q', np.frombuffer(self._fields[field], dtype=np.int64)[keep].tobytes())
+
+    @traced("keyword_index.save")
+    def save(self, path, index_version=None):
+        """
+        Compact the index and write it to an .npz file, written to a temporary file first.
+        index_version records which vector index the keyword index was built alongside.
+        """
+        self._compact()
+        self.index_version = index_version
+        current_span().set(rows=self._live_count, terms=len(self._terms), postings=len(self._base_docs))
+        temp_path = path + ".tmp.npz"
+        arrays = {f"field_{field}": np.frombuffer(values, dtype=np.int64) for field, values in self._fields.items()}
+        arrays.update({f"categories_{field}": np.array(list(codes), dtype=str)
+                       for field, codes in self._categories.items()})
+        np.savez(
+            temp_path,
+            terms=np.array(list(self._terms), dtype=str),
+            offsets=self._base_offsets,
+            docs=self._base_docs,
+            tfs=self._base_tfs,
+            doc_ids=np.array(self._doc_ids, dtype=str),
+            hashes=np.frombuffer(self._hashes, dtype=np.int64),
+            lengths=np.frombuffer(self._lengths, dtype=np.uint32),
+            index_version=np.array(index_version or ''),
+            **arrays,
+        )
+        os.replace(temp_path, path)
+        logger.info(f"Keyword index with {self._live_count} documents and {len(self._terms)} terms saved to {path}")
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by save, an empty index when there is none at path
+        """
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        with span("keyword_index.load", path=path) as load_span, np.load(path) as data:
+            index.index_version = str(data['index_version']) or None
+            index._terms = {term: number for number, term in enumerate(data['terms'].tolist())}
+            index._base_offsets = data['offsets']
+            index._base_docs = data['docs']
+            index._base_tfs = data['tfs']
+            index._doc_ids = data['doc_ids'].tolist()
+            index._doc_numbers = {doc_id: number for number, doc_id in enumerate(index._doc_ids)}
+            index._hashes = array('q', data['hashes'].tobytes())
+            index._lengths = array('I', data['lengths'].tobytes())
+            index._live = bytearray(b"\x01" * len(index._doc_ids))
+            index._live_count = len(index._doc_ids)
+            index._live_length = int(data['lengths'].sum())
+            for field, kind in FILTER_FIELDS.items():
+                index._fields[field] = array('q', data[f"field_{field}"].tobytes())
+                if kind == 'category':
+                    index._categories[field] = {value: code for code, value
+                                                in enumerate(data[f"categories_{field}"].tolist())}
+            load_span.set(rows=index._live_count)
+        logger.info(f"Keyword index with {index._live_count} documents loaded from {path}")
+        return index
@@ -1,78 +1,114 @@
 #import requests
-import pandas as pd
 import os
+import argparse
 import logging
-from datetime import datetime
-from pathlib import Path
 #import glob
-from sentence_transformers import SentenceTransformer
-import chromadb
-from transformers import pipeline
-from get_hdb_data import get_hdb_datasets_from_api
-from get_hdb_data import load_hdb_data_from_csv
-from preprocessing_hdb_data import preprocessing_hdb_dataframe
+from get_hdb_data import LocalDirectorySource, DataGovSGSource
+from hdb_ingest import ingest_new_sources, load_cleaned_store
+from streaming_index import index_hdb_csv_streaming, build_streamed_snapshot, STREAMING_CHUNK_SIZE
+from tracing import tracer, TRACE_FILE_ENV_VAR
+from hdb_data_cache import load_cleaned_hdb_data, raw_data_key
+from hdb_price_cube import HDBPriceCube, PRICE_CUBE_FILENAME, PRICE_CUBE_COLUMNS
+from hdb_comps import ComparablesIndex, COMPS_FILENAME, COMPS_COLUMNS
+from hdb_summary_documents import create_summary_documents
+from compact_vector_store import export_collection, COMPACT_STORE_FOLDER
+from keyword_index import KeywordIndex, KEYWORD_INDEX_FILENAME
 from rag_setup import (create_rag_documents, setup_vector_database, create_simple_qa_system,
-                       ask_hdb_question, ask_hdb_question_txtgen)
+                       ask_hdb_questions, get_index_version,
+                       VECTOR_DB_PATH, TRANSACTIONS_COLLECTION_NAME)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def main():
-    """Main function to execute the HDB data processing and LLM based Q&A setup"""
+def main(streaming=False, incremental=False, summaries=False, drill_down=False, source="local",
+         chunk_size=STREAMING_CHUNK_SIZE, compact_store=None, ivf_lists=0, keyword=False):
+    """Main function to execute the HDB data processing and LLM based Q&A setup.
+    With streaming, every row is indexed chunk by chunk instead of a sample of the loaded data.
+    With incremental, only sources not yet in the ingestion manifest are processed and appended.
+    With summaries, summary documents over all rows are indexed instead of sampled transactions,
+    and with drill_down the sampled transactions go to a second collection behind them.
+    With compact_store ('float16' or 'int8') the index is also exported as a memory-mapped compact store.
+    With keyword, a BM25 keyword index is kept in step with the vector index for hybrid retrieval."""
 
     try:
         DATA_FOLDER = "ResaleFlatPrices/"
         OUTPUT_FOLDER = "Processed_Data/"
         SAMPLE_SIZE = 1000  # For RAG documents, set to None to use all data
+        EMBEDDING_BATCH_SIZE = 256
+        EMBEDDING_WORKERS = 0  # CPU processes for embedding, 0 or 1 encodes in this process
 
         logger.info("Starting HDB data processing")
+        if tracer.trace_file:
+            logger.info(f"Writing stage traces to {tracer.trace_file}")
+        else:
+            logger.info(f"Set {TRACE_FILE_ENV_VAR} to a file path to record stage traces")
         #loading data
-        if not os.path.exists(DATA_FOLDER):
+        if source == "local" and not os.path.exists(DATA_FOLDER):
             logger.error(f"Data folder '{DATA_FOLDER}' not found.")
             return False
         
-        combined_hdb_df=load_hdb_data_from_csv(folder_path=DATA_FOLDER)
-
-        if combined_hdb_df.empty:
-            logger.error("No data loaded from combined CSV files.")
-            return False
-        
-        logger.info(f"Loaded {len(combined_hdb_df)} records")
-        logger.info(f"Columns: {list(combined_hdb_df.columns)}")
-
-        # Data type conversions
-        logger.info("Converting data types...")
-        combined_hdb_df = combined_hdb_df.astype({
-                    'month': str, #use date format later
-                    'town': str,
-                    'flat_type': str,
-                    'block': str,
-                    'street_name': str,
-                    'storey_range': str, #split later
-                    'floor_area_sqm': float,
-                    'flat_model': str,
-                    'lease_commence_date': int, # convert to flat later to consider months? or use date format
-                    'remaining_lease': str, #convert to float later
-                    'resale_price': float
-        })
-
-        #preprocessing data
-        logger.info("Preprocessing HDB dataframe...")
-
-        cleaned_hdb_df = preprocessing_hdb_dataframe(combined_hdb_df)
-        cleaned_hdb_df.to_csv(os.path.join(OUTPUT_FOLDER,f"preprocessed_combined_hdb_data_{timestamp}.csv"), index=False)   
-        
-        logger.info(f"Preprocessed data saved to {OUTPUT_FOLDER}preprocessed_combined_hdb_data_{timestamp}.csv")
-
-        # Create RAG system
-        rag_documents = create_rag_documents(cleaned_hdb_df, sample_size=SAMPLE_SIZE)
-        vector_db_collection, embedding_model = setup_vector_database(rag_documents)
+        keyword_index_path = os.path.join(VECTOR_DB_PATH, KEYWORD_INDEX_FILENAME)
+        keyword_index = KeywordIndex.load(keyword_index_path) if keyword else None
+        drill_down_collection = None
+
+        if incremental:
+            # append new or changed source files or datasets to the cleaned store and the index
+            source_client = DataGovSGSource() if source == "data.gov.sg" else LocalDirectorySource(DATA_FOLDER)
+            vector_db_collection, embedding_model = ingest_new_sources(
+                source_client, chunk_size=chunk_size, batch_size=EMBEDDING_BATCH_SIZE, keyword_index=keyword_index)
+            price_cube = HDBPriceCube.from_dataframe(load_cleaned_store(columns=PRICE_CUBE_COLUMNS))
+            comps_index = ComparablesIndex.from_dataframe(load_cleaned_store(columns=COMPS_COLUMNS))
+        elif streaming:
+            # read, preprocess, embed and upsert chunk by chunk, resuming from the last checkpoint
+            logger.info(f"Streaming all rows in chunks of {chunk_size}")
+            vector_db_collection, embedding_model = index_hdb_csv_streaming(
+                DATA_FOLDER, chunk_size=chunk_size, batch_size=EMBEDDING_BATCH_SIZE, num_workers=EMBEDDING_WORKERS,
+                keyword_index=keyword_index)
+            # built from the cube and comparables columns the pass wrote per chunk, not the csv files
+            price_cube, comps_index = build_streamed_snapshot()
+        else:
+            # loading and preprocessing data, reusing the cached cleaned dataset when the raw files are unchanged
+            cleaned_hdb_df = load_cleaned_hdb_data(DATA_FOLDER, cache_folder=OUTPUT_FOLDER)
+
+            if cleaned_hdb_df.empty:
+                logger.error("No data loaded from combined CSV files.")
+                return False
+
+            logger.info(f"Loaded {len(cleaned_hdb_df)} cleaned records")
+            logger.info(f"Columns: {list(cleaned_hdb_df.columns)}")
+
+            # Create RAG system
+            if summaries:
+                # a few thousand summaries cover every row, transactions are only the drill-down tier
+                rag_documents = create_summary_documents(cleaned_hdb_df)
+                if drill_down:
+                    drill_down_collection, _ = setup_vector_database(
+                        create_rag_documents(cleaned_hdb_df, sample_size=SAMPLE_SIZE),
+                        batch_size=EMBEDDING_BATCH_SIZE, num_workers=EMBEDDING_WORKERS,
+                        collection_name=TRANSACTIONS_COLLECTION_NAME)
+            else:
+                rag_documents = create_rag_documents(cleaned_hdb_df, sample_size=SAMPLE_SIZE)
+            vector_db_collection, embedding_model = setup_vector_database(
+                rag_documents, batch_size=EMBEDDING_BATCH_SIZE, num_workers=EMBEDDING_WORKERS,
+                keyword_index=keyword_index)
+            price_cube = HDBPriceCube.from_dataframe(cleaned_hdb_df)
+            comps_index = ComparablesIndex.from_dataframe(cleaned_hdb_df)
         qa_pipeline = create_simple_qa_system(vector_db_collection)
+        # the index, the cube and the comparables together are the snapshot app.py serves from,
+        # the cube and comparables record the index version and raw files they were built with
+        index_version = get_index_version(vector_db_collection)
+        data_key = raw_data_key(DATA_FOLDER) if source == "local" or not incremental else None
+        price_cube.save(os.path.join(VECTOR_DB_PATH, PRICE_CUBE_FILENAME), index_version=index_version,
+                        data_key=data_key)
+        comps_index.save(os.path.join(VECTOR_DB_PATH, COMPS_FILENAME), index_version=index_version, data_key=data_key)
+        if keyword_index is not None:
+            keyword_index.save(keyword_index_path, index_version=index_version)
+        if compact_store:
+            # same documents and embeddings, served by app.py without Chroma's in-memory copies
+            export_collection(vector_db_collection, os.path.join(VECTOR_DB_PATH, COMPACT_STORE_FOLDER),
+                              quantization=compact_store, n_lists=ivf_lists)
 
         logger.info("HDB Housing assistant setup complete.")
 
@@ -80,21 +116,52 @@ def main():
         test_questions = [
             "Tell me the average resale price of 2 room HDB in Tampines in 2024?",
             "What's the most expensive flat type?",
-            "How much do 4-room flats cost in Jurong?"
+            "How much do 4-room flats cost in Jurong?",
+            "What would a 4-room flat in Tampines of 95 sqm on the 10th floor, lease from 1990, sell for?"
         ]
 
         logger.info("Testing the HDB Q&A system with sample questions...")
 
-        for question in test_questions:
+        answers = ask_hdb_questions(test_questions, vector_db_collection, embedding_model, price_cube=price_cube,
+                                    comps_index=comps_index, keyword_index=keyword_index,
+                                    drill_down_collection=drill_down_collection)
+        for question, answer in zip(test_questions, answers):
             print(f"\n{'='*25}")
-            ask_hdb_question(question, vector_db_collection)
+            print(f"Question: {question}")
+            print(f"Answer: {answer}")
         return True
     except Exception as e:
         logger.error(f"An error occurred in main execution: {e}")
         return False
 
 if __name__ == "__main__":
-    success = main()
+    parser = argparse.ArgumentParser(description="Build the HDB index and price cube, then answer sample questions")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--streaming", action="store_true",
+                      help="index every row chunk by chunk with bounded memory, resuming an interrupted run")
+    mode.add_argument("--incremental", action="store_true",
+                      help="only ingest sources that are new or changed since the last run")
+    mode.add_argument("--summaries", action="store_true",
+                      help="index town/flat type/period and street summaries of all rows instead of sampled transactions")
+    parser.add_argument("--drill-down", action="store_true",
+                        help="with --summaries, also index the sampled transactions as a drill-down tier")
+    parser.add_argument("--source", choices=["local", "data.gov.sg"], default="local",
+                        help="where --incremental finds the resale files")
+    parser.add_argument("--chunk-size", type=int, default=STREAMING_CHUNK_SIZE,
+                        help="rows per chunk in streaming and incremental mode")
+    parser.add_argument("--compact-store", choices=["float16", "int8"], default=None,
+                        help="also export the index as a memory-mapped compact store for serving")
+    parser.add_argument("--ivf-lists", type=int, default=0,
+                        help="coarse partitions of the compact store, 0 for exact search only")
+    parser.add_argument("--keyword-index", action="store_true",
+                        help="also keep a BM25 keyword index for hybrid keyword + vector retrieval")
+    args = parser.parse_args()
+    if args.drill_down and not args.summaries:
+        parser.error("--drill-down requires --summaries")
+
+    success = main(streaming=args.streaming, incremental=args.incremental, summaries=args.summaries,
+                   drill_down=args.drill_down, source=args.source, chunk_size=args.chunk_size,
+                   compact_store=args.compact_store, ivf_lists=args.ivf_lists, keyword=args.keyword_index)
     if success:
         logger.info("Script completed successfully.")
     else:
@@ -103,9 +170,10 @@ if __name__ == "__main__":
     # If you want to test the text generation based Q&A system separately, uncomment below:
     '''
     ####---Assuming vector_db_collection and embedding_model are already set up---####
+    from rag_setup import ask_hdb_question_txtgen
     question = "Tell me the average resale price of 2 room HDB in Tampines in 2024?"
     print("\nTesting text generation based Q&A system...")
-    ask_hdb_question_txtgen(question, vector_db_collection, embedding_model)
+    ask_hdb_question_txtgen(question, vector_db_collection, create_simple_qa_system(vector_db_collection))
     '''
 
 
@@ -2,21 +2,71 @@ import requests
 import pandas as pd
 import os
 import glob
+import logging
 
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the loading or cleaning logic changes so cached cleaned data is rebuilt
+PREPROCESSING_VERSION = 2
+
+def map_unique_values(series, parse):
+    """
+    Apply parse to the distinct values of series only, and broadcast the result
+    (a Series or DataFrame aligned with those values) back to every row through the factorized codes
+    """
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    parsed = parse(pd.Series(uniques, dtype=series.dtype))
+    result = parsed.take(codes)
+    result.index = series.index
+    current_span().set(unique_values=len(uniques))
+    return result
+
+
+def parse_month(values):
+    # 'YYYY-MM' strings to datetimes (assumes day=1)
+    return pd.to_datetime(values + '-01', format='%Y-%m-%d', errors='coerce')
+
+
+def parse_lease_commence_date(values):
+    # years to datetimes (assumes January)
+    return pd.to_datetime(values.astype(str) + '-01-01', format='%Y-%m-%d', errors='coerce')
+
+
+def parse_storey_range(values):
+    # "min TO max" ranges, or a single floor number, to integer min and max floors
+    # Extract "min TO max" pattern
+    with span("preprocess.storey_range.range_regex"):
+        ranges = values.str.extract(r'(?P<min>\d+)\s*TO\s*(?P<max>\d+)', expand=True)
+    # Extract single numbers if no "TO"
+    with span("preprocess.storey_range.single_regex"):
+        single = values.str.extract(r'(?P<single>\d+)', expand=True)
+
+    return pd.DataFrame({
+        'storey_range_min': ranges['min'].fillna(single['single']).astype(int),
+        'storey_range_max': ranges['max'].fillna(single['single']).astype(int),
+    })
+
+
+@traced("preprocessing_hdb_dataframe")
 def preprocessing_hdb_dataframe(df):
     """
-    Clean HDB dataframe with specific transformations
+    Clean HDB dataframe with specific transformations.
+    The text columns hold few distinct values, so each one is parsed once per distinct value.
+    df is left unchanged and its untouched columns are shared with the result rather than copied.
     """
-    # Make a copy to avoid modifying original
-    clean_df = df.copy()
+    current_span().set(rows=len(df))
 
     # 1. Convert 'month' to datetime (assumes day=1)
-    print("Converting month to datetime...")
-    clean_df['month'] = pd.to_datetime(clean_df['month'] + '-01', format='%Y-%m-%d', errors='coerce')
+    logger.info("Converting month to datetime...")
+    with span("preprocess.month"):
+        month = map_unique_values(df['month'], parse_month)
 
     # 2. Convert lease_commence_date to datetime (assumes January if only year)
-    print("Converting lease_commence_date to datetime...")
-    clean_df['lease_commence_date'] = pd.to_datetime(clean_df['lease_commence_date'].astype(str) + '-01-01', format='%Y-%m-%d', errors='coerce')
+    logger.info("Converting lease_commence_date to datetime...")
+    with span("preprocess.lease_commence_date"):
+        lease_commence_date = map_unique_values(df['lease_commence_date'], parse_lease_commence_date)
     '''
     def convert_lease_date(date_val):
         if pd.isna(date_val):
@@ -33,28 +83,32 @@ def preprocessing_hdb_dataframe(df):
     '''
 
     #3. Convert remaining_lease to float
-    print("Converting remaining_lease to float...")
+    logger.info("Converting remaining_lease to float...")
     def convert_remaining_lease_vectorized(series):
         s = series.fillna('0').astype(str).str.lower()
 
         # Extract years
-        years = s.str.extract(r'(\d+(?:\.\d+)?)\s*year')[0].astype(float).fillna(0)
+        with span("preprocess.remaining_lease.years_regex"):
+            years = s.str.extract(r'(\d+(?:\.\d+)?)\s*year')[0].astype(float).fillna(0)
         # Extract months
-        months = s.str.extract(r'(\d+(?:\.\d+)?)\s*month')[0].astype(float).fillna(0)
+        with span("preprocess.remaining_lease.months_regex"):
+            months = s.str.extract(r'(\d+(?:\.\d+)?)\s*month')[0].astype(float).fillna(0)
 
         # If it's just a number without 'year' or 'month', treat as years
-        only_number = s.str.replace(r'[^\d.]', '', regex=True)
-        only_number = pd.to_numeric(only_number, errors='coerce').fillna(0)
+        with span("preprocess.remaining_lease.number_regex"):
+            only_number = s.str.replace(r'[^\d.]', '', regex=True)
+            only_number = pd.to_numeric(only_number, errors='coerce').fillna(0)
 
         # Combine
         total_years = years + months / 12
         total_years = total_years.where(total_years != 0, only_number)  # fallback for plain numbers
 
         return total_years
-    clean_df['remaining_lease'] = convert_remaining_lease_vectorized(clean_df['remaining_lease'])
+    with span("preprocess.remaining_lease"):
+        remaining_lease = map_unique_values(df['remaining_lease'], convert_remaining_lease_vectorized)
 
     # 4. For NaN remaining_lease, calculate from lease_commence_date and month
-    print("Calculating missing remaining_lease values...")
+    logger.info("Calculating missing remaining_lease values...")
     '''
     def calculate_remaining_lease(row):
         if pd.isna(row['remaining_lease']) and pd.notna(row['lease_commence_date']) and pd.notna(row['month']):
@@ -66,19 +120,20 @@ def preprocessing_hdb_dataframe(df):
     clean_df['remaining_lease'] = clean_df.apply(calculate_remaining_lease, axis=1)
     '''
     #Fully vectorised faster version
-    lease_duration = 99
-    mask = clean_df['remaining_lease'].isna() & clean_df['lease_commence_date'].notna() & clean_df['month'].notna()
-    years_elapsed = (clean_df.loc[mask, 'month'] - clean_df.loc[mask, 'lease_commence_date']).dt.days / 365.25
-    clean_df.loc[mask, 'remaining_lease'] = (lease_duration - years_elapsed).clip(lower=0)
+    with span("preprocess.missing_remaining_lease") as missing_span:
+        lease_duration = 99
+        mask = remaining_lease.isna() & lease_commence_date.notna() & month.notna()
+        if mask.any():
+            years_elapsed = (month[mask] - lease_commence_date[mask]).dt.days / 365.25
+            remaining_lease = remaining_lease.mask(mask, (lease_duration - years_elapsed).clip(lower=0))
+        missing_span.set(rows=int(mask.sum()))
 
     # 5. Split storey_range into min and max
-    print("Splitting storey_range into min and max...")
-    # Extract "min TO max" pattern
-    ranges = clean_df['storey_range'].str.extract(r'(?P<min>\d+)\s*TO\s*(?P<max>\d+)', expand=True)
-    # Extract single numbers if no "TO"
-    single = clean_df['storey_range'].str.extract(r'(?P<single>\d+)', expand=True)
-
-    clean_df['storey_range_min'] = ranges['min'].fillna(single['single']).astype(int)
-    clean_df['storey_range_max'] = ranges['max'].fillna(single['single']).astype(int)
+    logger.info("Splitting storey_range into min and max...")
+    with span("preprocess.storey_range"):
+        storey_ranges = map_unique_values(df['storey_range'], parse_storey_range)
 
-    return clean_df
\ No newline at end of file
+    # replaced columns keep their position, the storey range columns are appended
+    return df.assign(month=month, lease_commence_date=lease_commence_date, remaining_lease=remaining_lease,
+                     storey_range_min=storey_ranges['storey_range_min'],
+                     storey_range_max=storey_ranges['storey_range_max'])
\ No newline at end of file
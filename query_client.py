@@ -0,0 +1,105 @@
+import http.client
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+QUERY_SERVER_URL = "http://127.0.0.1:8765"
+QUERY_SERVER_URL_ENV_VAR = "HDB_QUERY_SERVER_URL"
+BATCH_REQUEST_SIZE = 64  # questions per /ask_batch request
+BUSY_RETRIES = 10
+BUSY_RETRY_SECONDS = 0.5
+
+
+class QueryServerBusy(RuntimeError):
+    """
+    The query server's queue was full and the questions were not queued
+    """
+
+
+class QueryClient:
+    """
+    Blocking client of query_server.py for app.py and batch scripts.
+    Each thread keeps its own keep-alive connection, so one client can be shared across threads.
+    """
+
+    def __init__(self, url=QUERY_SERVER_URL, timeout=60):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port,
+                                                                              timeout=self.timeout)
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                data = json.loads(response.read() or b"{}")
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # the server may have closed an idle keep-alive connection, reconnect once
+                self.close()
+                if attempt:
+                    raise
+        if response.status == 503:
+            raise QueryServerBusy(data.get('error'))
+        if response.status != 200:
+            raise RuntimeError(f"Query server returned {response.status}: {data.get('error')}")
+        return data
+
+    def health(self):
+        """
+        Server status: documents served, queue length and batching counters
+        """
+        return self._request("GET", "/health")
+
+    def ask(self, question):
+        """
+        Answer one question, raising QueryServerBusy when the server's queue is full
+        """
+        return self.ask_with_latency(question)[0]
+
+    def ask_with_latency(self, question):
+        """
+        (answer, latency_ms) of one question, latency_ms being how long the server took to answer it
+        """
+        response = self._request("POST", "/ask", {'question': question})
+        return response['answer'], response['latency_ms']
+
+    def ask_batch(self, questions, request_size=BATCH_REQUEST_SIZE):
+        """
+        Answer many questions in input order, request_size per request,
+        waiting and retrying a request while the server is busy
+        """
+        answers = []
+        for start in range(0, len(questions), request_size):
+            chunk = list(questions[start:start + request_size])
+            for attempt in range(BUSY_RETRIES + 1):
+                try:
+                    answers.extend(self._request("POST", "/ask_batch", {'questions': chunk})['answers'])
+                    break
+                except QueryServerBusy:
+                    if attempt == BUSY_RETRIES:
+                        raise
+                    logger.info(f"Query server busy, retrying in {BUSY_RETRY_SECONDS}s")
+                    time.sleep(BUSY_RETRY_SECONDS)
+        return answers
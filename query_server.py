@@ -0,0 +1,285 @@
+"""
+Local asyncio HTTP query service in front of the retrieval stack.
+
+The snapshot written by main.py (index, price cube, comparables, keyword index and drill-down
+transactions when they were built) and the embedding model are loaded once. Concurrent questions
+wait in a bounded queue and are answered in micro-batches, flushed when max_batch_size questions
+are waiting or max_batch_delay_ms after the first one arrived, with one batched embedding call and
+batched index queries per batch. A full queue rejects new questions with 503 so
+clients back off instead of piling up latency.
+
+Endpoints, all JSON:
+    POST /ask        {"question": "..."}        -> {"answer": "...", "latency_ms": ...}
+    POST /ask_batch  {"questions": ["...", ...]} -> {"answers": [...], "latency_ms": ...}
+    GET  /health                                -> {"status": "ok", "documents": ..., "queue": ..., ...}
+Run from the repository root after main.py:
+    python query_server.py --port 8765
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from compact_vector_store import CompactVectorStore, COMPACT_STORE_FOLDER
+from hdb_comps import ComparablesIndex, COMPS_FILENAME
+from hdb_price_cube import HDBPriceCube, PRICE_CUBE_FILENAME
+from keyword_index import KeywordIndex, KEYWORD_INDEX_FILENAME
+from rag_setup import (ask_hdb_questions, get_index_version, open_vector_database, VECTOR_DB_PATH,
+                       TRANSACTIONS_COLLECTION_NAME)
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+MAX_BATCH_SIZE = 32
+MAX_BATCH_DELAY_MS = 5.0
+MAX_QUEUE_SIZE = 256  # questions waiting for a batch, more are rejected with 503
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+def load_serving_state(persist_directory=VECTOR_DB_PATH):
+    """
+    Open the snapshot written by main.py and load the embedding model now rather than on the first question.
+    The compact store is served instead of Chroma when it matches the index version, and the keyword
+    index is used for hybrid retrieval when it matches too, as in the app.
+    """
+    collection, embedding_model = open_vector_database(persist_directory)
+    if collection is None:
+        raise ValueError(f"No index in {persist_directory}, run main.py first")
+    keyword_index = KeywordIndex.load(os.path.join(persist_directory, KEYWORD_INDEX_FILENAME))
+    if not keyword_index.count() or keyword_index.index_version != get_index_version(collection):
+        keyword_index = None
+    drill_down_collection, _ = open_vector_database(persist_directory, collection_name=TRANSACTIONS_COLLECTION_NAME)
+    compact_store = CompactVectorStore.open(os.path.join(persist_directory, COMPACT_STORE_FOLDER))
+    if compact_store is not None and get_index_version(compact_store) == get_index_version(collection):
+        collection, embedding_model = compact_store, compact_store.embedding_model
+    price_cube_path = os.path.join(persist_directory, PRICE_CUBE_FILENAME)
+    price_cube = HDBPriceCube.load(price_cube_path) if os.path.exists(price_cube_path) else None
+    comps_index = ComparablesIndex.load(os.path.join(persist_directory, COMPS_FILENAME))
+    for name, saved in (("Price cube", price_cube), ("Comparables index", comps_index)):
+        if saved is not None and saved.index_version != get_index_version(collection):
+            logger.warning(f"{name} in {persist_directory} was saved with another index version, "
+                           f"run main.py to rebuild the snapshot")
+    embedding_model.load()
+    return {'collection': collection, 'embedding_model': embedding_model, 'price_cube': price_cube,
+            'comps_index': comps_index, 'keyword_index': keyword_index, 'drill_down_collection': drill_down_collection}
+
+
+class MicroBatcher:
+    """
+    Bounded queue of pending questions answered in batches by ask_hdb_questions in a worker thread.
+    A batch closes when max_batch_size questions are in it or max_batch_delay_ms after its first question,
+    and the questions queued while a batch runs make up the next one.
+    """
+
+    def __init__(self, state, max_batch_size=MAX_BATCH_SIZE, max_batch_delay_ms=MAX_BATCH_DELAY_MS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.state = state
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay_ms / 1000
+        self.max_queue_size = max_queue_size
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=1)  # one batch at a time owns the model
+        self._task = None
+        self.batches = 0
+        self.answered = 0
+        self.rejected = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown(wait=True)
+
+    def free_slots(self):
+        return self._queue.maxsize - self._queue.qsize()
+
+    def submit(self, questions):
+        """
+        Queue questions and return one future per answer, raising asyncio.QueueFull
+        without queueing any of them when there is no room for all
+        """
+        if len(questions) > self.free_slots():
+            self.rejected += len(questions)
+            raise asyncio.QueueFull
+        loop = asyncio.get_running_loop()
+        futures = []
+        for question in questions:
+            future = loop.create_future()
+            self._queue.put_nowait((question, future))
+            futures.append(future)
+        return futures
+
+    def _answer_batch(self, questions):
+        with span("query_server.batch", rows=len(questions)):
+            return ask_hdb_questions(questions, self.state['collection'], self.state['embedding_model'],
+                                     batch_size=len(questions), price_cube=self.state['price_cube'],
+                                     comps_index=self.state['comps_index'], keyword_index=self.state['keyword_index'],
+                                     drill_down_collection=self.state['drill_down_collection'])
+
+    async def _next_batch(self):
+        # wait for a first question, then gather more until the batch is full or its deadline passes
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_batch_delay
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            try:
+                answers = await loop.run_in_executor(self._executor, self._answer_batch,
+                                                     [question for question, _ in batch])
+            except Exception as e:
+                logger.exception(f"Batch of {len(batch)} questions failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.answered += len(batch)
+            for (_, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+    def stats(self):
+        return {'queue': self._queue.qsize(), 'batches': self.batches, 'answered': self.answered,
+                'rejected': self.rejected, 'mean_batch_size': self.answered / self.batches if self.batches else 0.0}
+
+
+class QueryServer:
+    """
+    Minimal HTTP/1.1 server with keep-alive over asyncio streams, routing requests to a MicroBatcher
+    """
+
+    def __init__(self, state, host=SERVER_HOST, port=SERVER_PORT, **batcher_kwargs):
+        self.state = state
+        self.host = host
+        self.port = port
+        self.batcher = MicroBatcher(state, **batcher_kwargs)
+
+    async def _ask(self, questions):
+        start = time.perf_counter()
+        try:
+            futures = self.batcher.submit(questions)
+        except asyncio.QueueFull:
+            return HTTPStatus.SERVICE_UNAVAILABLE, {'error': "Too many pending questions, retry later"}
+        try:
+            answers = await asyncio.gather(*futures)
+        except Exception as e:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f"Answering failed: {e}"}
+        return HTTPStatus.OK, {'answers': answers, 'latency_ms': round((time.perf_counter() - start) * 1000, 3)}
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {'status': 'ok', 'documents': self.state['collection'].count(),
+                                   **self.batcher.stats()}
+        if method != "POST" or path not in ("/ask", "/ask_batch"):
+            return HTTPStatus.NOT_FOUND, {'error': f"No route for {method} {path}"}
+        try:
+            request = json.loads(body)
+            questions = [request['question']] if path == "/ask" else list(request['questions'])
+        except (ValueError, KeyError, TypeError):
+            return HTTPStatus.BAD_REQUEST, {'error': "Expected JSON with a question or a list of questions"}
+        if not all(isinstance(question, str) and question.strip() for question in questions):
+            return HTTPStatus.BAD_REQUEST, {'error': "Questions must be non-empty strings"}
+        if len(questions) > self.batcher.max_queue_size:
+            return HTTPStatus.BAD_REQUEST, {'error': f"At most {self.batcher.max_queue_size} questions per request"}
+        status, payload = await self._ask(questions)
+        if status == HTTPStatus.OK and path == "/ask":
+            payload = {'answer': payload['answers'][0], 'latency_ms': payload['latency_ms']}
+        return status, payload
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_REQUEST_BYTES:
+                    status, payload = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': "Request body too large"}
+                    headers['connection'] = 'close'
+                else:
+                    status, payload = await self._route(method, path, await reader.readexactly(length))
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode("utf-8")
+                head = (f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n"
+                        f"Content-Length: {len(data)}\r\n")
+                if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                    head += "Retry-After: 1\r\n"
+                if not keep_alive:
+                    head += "Connection: close\r\n"
+                writer.write(head.encode("latin-1") + b"\r\n" + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # client disconnected or sent a malformed request
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        """
+        Serve until cancelled, setting the ready event once the port is listening
+        """
+        self.batcher.start()
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Query server listening on http://{self.host}:{self.port}")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--persist-directory", default=VECTOR_DB_PATH)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-batch-delay-ms", type=float, default=MAX_BATCH_DELAY_MS)
+    parser.add_argument("--max-queue-size", type=int, default=MAX_QUEUE_SIZE)
+    args = parser.parse_args()
+
+    query_server = QueryServer(load_serving_state(args.persist_directory), host=args.host, port=args.port,
+                               max_batch_size=args.max_batch_size, max_batch_delay_ms=args.max_batch_delay_ms,
+                               max_queue_size=args.max_queue_size)
+    try:
+        asyncio.run(query_server.serve())
+    except KeyboardInterrupt:
+        logger.info("Query server stopped")
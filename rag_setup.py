@@ -1,90 +1,411 @@
 
-from sentence_transformers import SentenceTransformer
+import hashlib
+import json
+import logging
+import uuid
+import numpy as np
+import pandas as pd
 import chromadb
-from transformers import pipeline
+from chromadb.errors import NotFoundError
+from chromadb.utils.embedding_functions import register_embedding_function
+from hdb_question_parser import parse_question
+from hdb_summary_documents import drill_down_filter
+from generation import (build_prompt, generate_texts, model_and_tokenizer, stream_text, GENERATION_BATCH_SIZE,
+                        GENERATION_MAX_NEW_TOKENS)
+from embedding import EmbeddingCache, LazySentenceTransformer, embed_texts, embedding_pool, EMBEDDING_BATCH_SIZE
+from tracing import current_span, span, traced
 
+logger = logging.getLogger(__name__)
+
+VECTOR_DB_PATH = "vector_db/"
+COLLECTION_NAME = "hdb_data"
+TRANSACTIONS_COLLECTION_NAME = "hdb_transactions"  # per-transaction drill-down tier under summary documents
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+INDEX_BATCH_SIZE = 5000  # chroma rejects very large add/upsert/get calls
+
+RAG_BATCH_SIZE = 10000
+RRF_K = 60  # reciprocal rank fusion constant, larger values flatten the weight of the top ranks
+HYBRID_CANDIDATES = 20  # results taken from each retriever before fusion
+
+def _format_column(series, formatter=str):
+    # format each distinct value once and broadcast the strings back through the codes
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    formatted = np.array([formatter(value) for value in uniques], dtype=object)
+    return formatted[codes]
+
+def _format_year(year):
+    # integer years even when a batch has missing dates, "nan" for those like the per-row template
+    return "nan" if pd.isna(year) else str(year)
+
+def _build_rag_documents(df):
+    # Columnar version of the per-row document template
+    town = _format_column(df['town'])
+    flat_type = _format_column(df['flat_type'])
+    sold_month = df['month']
+    price_per_sqm = df['resale_price'].astype(float) / df['floor_area_sqm'].astype(float)
+
+    texts = (flat_type + " HDB flat in " + town + ":"
+        + "\n        - Location: Block " + _format_column(df['block']) + ", " + _format_column(df['street_name']) + ", " + town
+        + "\n        - Size: " + _format_column(df['floor_area_sqm']) + " square meters"
+        + "\n        - Floor level: " + _format_column(df['storey_range'])
+        + " (floors " + _format_column(df['storey_range_min']) + " to " + _format_column(df['storey_range_max']) + ")"
+        + "\n        - Building age: Built in " + _format_column(df['lease_commence_date'].dt.year.astype('Int64'), _format_year)
+        + ", " + _format_column(df['remaining_lease'], '{:.0f}'.format) + " years lease remaining"
+        + "\n        - Price: Sold for $" + _format_column(df['resale_price'], '{:,.0f}'.format)
+        + " SGD in " + _format_column(sold_month, lambda d: d.strftime('%B %Y'))
+        + "\n        - Model: flat model " + _format_column(df['flat_model']) + "  "
+        + "\n        - Price per sqm: $" + _format_column(price_per_sqm, '{:,.0f}'.format) + " per square meter")
+
+    ids = "hdb_" + _format_column(df.index.to_series())
+    metadata_columns = zip(
+        town.tolist(),
+        flat_type.tolist(),
+        df['resale_price'].astype(float).tolist(),
+        _format_column(sold_month, lambda d: d.strftime('%Y-%m')).tolist(),
+        df['remaining_lease'].astype(float).tolist(),
+        _format_column(df['street_name']).tolist(),
+        _format_column(df['block']).tolist(),
+        # numeric dates so metadata filters can select year and month ranges, 0 when the date is missing
+        sold_month.dt.year.fillna(0).astype(int).tolist(),
+        (sold_month.dt.year * 100 + sold_month.dt.month).fillna(0).astype(int).tolist(),
+    )
+    documents = [
+        {
+            'id': doc_id,
+            'text': text,
+            'metadata': {
+                'town': meta_town,
+                'flat_type': meta_flat_type,
+                'price': price,
+                'sold_date': sold_date,
+                'remaining_lease': remaining_lease,
+                'street_name': street_name,
+                'block': block,
+                'year': year,
+                'year_month': year_month
+            }
+        }
+        for doc_id, text, (meta_town, meta_flat_type, price, sold_date, remaining_lease, street_name, block, year,
+                           year_month)
+        in zip(ids.tolist(), texts.tolist(), metadata_columns)
+    ]
+    # rows ingested through the manifest record the source file or dataset they came from
+    if 'source_id' in df.columns:
+        for doc, source_id in zip(documents, _format_column(df['source_id']).tolist()):
+            doc['metadata']['source_id'] = source_id
+    return documents
+
+def iter_rag_document_batches(df, batch_size=RAG_BATCH_SIZE):
+    """
+    Yield RAG documents for every row of df in lists of at most batch_size documents
+    """
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size]
+        with span("documents.batch", rows=len(chunk)):
+            batch = _build_rag_documents(chunk)
+        yield batch
+
+@traced("create_rag_documents")
 def create_rag_documents(df, sample_size=1000):
     #Step 1: Convert your HDB data into text documents for RAG
-    # chooseing saple_size=1000 for fast testing, use larger size for production later
+    # chooseing saple_size=1000 for fast testing, use larger size for production later, None uses all rows
 
-    print("Creating RAG documents...")
+    logger.info("Creating RAG documents...")
 
     # Sample data to keep it fast for testing
-    if len(df) > sample_size:
+    if sample_size is not None and len(df) > sample_size:
         df_sample = df.sample(n=sample_size, random_state=42)
-        print(f"Using {sample_size} samples from {len(df)} total records")
+        logger.info(f"Using {sample_size} samples from {len(df)} total records")
     else:
         df_sample = df
-    
-    documents = []
 
-    for idx, row in df_sample.iterrows():
-        # Create a text representation of each row
-        doc_text= f"""
-        {row['flat_type']} HDB flat in {row['town']}:
-        - Location: Block {row['block']}, {row['street_name']}, {row['town']}
-        - Size: {row['floor_area_sqm']} square meters
-        - Floor level: {row['storey_range']} (floors {row['storey_range_min']} to {row['storey_range_max']})
-        - Building age: Built in {row['lease_commence_date'].year}, {row['remaining_lease']:.0f} years lease remaining
-        - Price: Sold for ${row['resale_price']:,.0f} SGD in {row['month'].strftime('%B %Y')}
-        - Model: flat model {row['flat_model']}  
-        - Price per sqm: ${row['resale_price']/row['floor_area_sqm']:,.0f} per square meter
-            """.strip()
-        
-        documents.append({
-            'id': f"hdb_{idx}",
-            'text': doc_text,
-            'metadata': {
-                'town': row['town'],
-                'flat_type': row['flat_type'],
-                'price': row['resale_price'],
-                'sold_date': row['month'].strftime('%Y-%m'),
-                'remaining_lease': row['remaining_lease']
-            }
-        })
-    print(f"Created {len(documents)} documents for RAG, one document per flat record")
+    documents = []
+    for batch in iter_rag_document_batches(df_sample):
+        documents.extend(batch)
+    current_span().set(rows=len(documents))
+    logger.info(f"Created {len(documents)} documents for RAG, one document per flat record")
     return documents
 
-def setup_vector_database(input_documents):
-    # Create vector database for retrieval
-    print("Setting up vector database...")
+@register_embedding_function
+class HDBEmbeddingFunction(chromadb.EmbeddingFunction):
+    """
+    Chroma embedding function backed by the pipeline's SentenceTransformer (loaded lazily),
+    so queries are embedded with the same model as the indexed documents
+    """
+
+    def __init__(self, embedding_model, model_name=EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE):
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.batch_size = batch_size
+
+    def __call__(self, input):
+        return list(embed_texts(list(input), self.embedding_model, batch_size=self.batch_size))
+
+    @staticmethod
+    def name():
+        return "hdb_sentence_transformer"
 
-    # Initialize embedding model (lightweight and free)
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-    print("embedding model initialized: all-MiniLM-L6-v2 ")
+    def get_config(self):
+        return {"model_name": self.model_name, "batch_size": self.batch_size}
 
-    # Initialize ChromaDB (local vector database)
-    client = chromadb.Client()
+    @staticmethod
+    def build_from_config(config):
+        return HDBEmbeddingFunction(LazySentenceTransformer(config["model_name"]), config["model_name"],
+                                    config["batch_size"])
 
-    # Create collection (delete if already exists)
+def document_hash(text, model_name=EMBEDDING_MODEL_NAME):
+    """
+    Content hash of a document's text under a given embedding model
+    """
+    return hashlib.sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+def _get_indexed_metadata(collection, ids=None):
+    # map every stored id, or only those in ids, to its metadata, which includes the content hash it was embedded from
+    indexed = {}
+    if ids is not None:
+        for start in range(0, len(ids), INDEX_BATCH_SIZE):
+            batch = collection.get(ids=ids[start:start + INDEX_BATCH_SIZE], include=["metadatas"])
+            for doc_id, meta in zip(batch['ids'], batch['metadatas']):
+                indexed[doc_id] = meta or {}
+        return indexed
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=INDEX_BATCH_SIZE, offset=offset)
+        if not batch['ids']:
+            break
+        for doc_id, meta in zip(batch['ids'], batch['metadatas']):
+            indexed[doc_id] = meta or {}
+        offset += len(batch['ids'])
+    return indexed
+
+def get_index_version(collection):
+    """
+    Version id of the indexed content, changes whenever documents are added, updated or removed
+    """
+    return (collection.metadata or {}).get('index_version')
+
+def read_index_version(persist_directory=VECTOR_DB_PATH, collection_name=COLLECTION_NAME):
+    """
+    Index version as stored on disk now, None when there is no index.
+    An open collection keeps the metadata it was opened with, so it misses rebuilds made since.
+    """
     try:
-        client.delete_collection(name="hdb_data")
-        print("Deleted existing 'hdb_flats' collection")
-    except:
-        pass
+        collection = chromadb.PersistentClient(path=persist_directory).get_collection(collection_name)
+    except (ValueError, NotFoundError):
+        return None
+    return get_index_version(collection)
 
-    collection = client.create_collection("hdb_data")
-    print("Vector database collection 'hdb_data' created")
+def bump_index_version(collection):
+    """
+    Give the collection a new index version, invalidating answers cached under the old one
+    """
+    collection.modify(metadata={**(collection.metadata or {}), 'index_version': uuid.uuid4().hex})
+
+def get_or_create_collection(persist_directory=VECTOR_DB_PATH, model_name=EMBEDDING_MODEL_NAME,
+                             batch_size=EMBEDDING_BATCH_SIZE, collection_name=COLLECTION_NAME):
+    """
+    Open or create the persistent collection, returning (collection, embedding_model).
+    The embedding model is only loaded when something has to be embedded.
+    """
+    # Embedding model (lightweight and free)
+    embedding_model = LazySentenceTransformer(model_name)
+
+    # Initialize ChromaDB (local vector database persisted on disk)
+    client = chromadb.PersistentClient(path=persist_directory)
+    collection = client.get_or_create_collection(
+        collection_name,
+        metadata={"embedding_model": model_name},
+        embedding_function=HDBEmbeddingFunction(embedding_model, model_name, batch_size),
+    )
+    logger.info(f"Vector database collection '{collection_name}' opened at {persist_directory}")
+    return collection, embedding_model
 
-    # Add documents to database
-    print("Adding documents to vector database...")
-    texts = [doc['text'] for doc in input_documents]
-    ids = [doc['id'] for doc in input_documents]
-    metadatas = [doc['metadata'] for doc in input_documents]
+def _diff_documents(documents, indexed_metadata, model_name):
+    # (doc, doc_hash) pairs whose text changed, and those where only the metadata changed
+    changed_documents = []
+    changed_metadata = []
+    for doc in documents:
+        doc_hash = document_hash(doc['text'], model_name)
+        indexed = indexed_metadata.get(doc['id'])
+        if indexed is None or indexed.get('doc_hash') != doc_hash:
+            changed_documents.append((doc, doc_hash))
+        elif indexed != {**doc['metadata'], 'doc_hash': doc_hash}:
+            # same text, only the metadata changed: no need to embed again
+            changed_metadata.append((doc, doc_hash))
+    return changed_documents, changed_metadata
+
+def delete_documents(collection, ids, keyword_index=None):
+    """
+    Delete the documents with the given ids, in batches the index accepts, and from the keyword index if given
+    """
+    with span("index.delete", rows=len(ids)):
+        for start in range(0, len(ids), INDEX_BATCH_SIZE):
+            collection.delete(ids=ids[start:start + INDEX_BATCH_SIZE])
+        if keyword_index is not None:
+            keyword_index.remove(ids)
+
+def _write_documents(collection, embedding_model, changed_documents, changed_metadata, batch_size, pool,
+                     embedding_cache):
+    # metadata-only changes are updated in place, changed texts are embedded and upserted
+    with span("index.update_metadata", rows=len(changed_metadata)):
+        for start in range(0, len(changed_metadata), INDEX_BATCH_SIZE):
+            batch = changed_metadata[start:start + INDEX_BATCH_SIZE]
+            collection.update(ids=[doc['id'] for doc, _ in batch],
+                              metadatas=[{**doc['metadata'], 'doc_hash': doc_hash} for doc, doc_hash in batch])
+
+    for start in range(0, len(changed_documents), INDEX_BATCH_SIZE):
+        batch = changed_documents[start:start + INDEX_BATCH_SIZE]
+        texts = [doc['text'] for doc, _ in batch]
+        ids = [doc['id'] for doc, _ in batch]
+        metadatas = [{**doc['metadata'], 'doc_hash': doc_hash} for doc, doc_hash in batch]
+        with span("index.upsert", rows=len(batch)):
+            embeddings = embed_texts(texts, embedding_model, batch_size=batch_size, pool=pool,
+                                     cache=embedding_cache)
+            collection.upsert(documents=texts, embeddings=embeddings.tolist(), ids=ids, metadatas=metadatas)
+
+@traced("setup_vector_database")
+def setup_vector_database(input_documents, persist_directory=VECTOR_DB_PATH, model_name=EMBEDDING_MODEL_NAME,
+                          batch_size=EMBEDDING_BATCH_SIZE, num_workers=0, embedding_cache=None,
+                          collection_name=COLLECTION_NAME, keyword_index=None):
+    """
+    Sync the documents into a persistent vector database.
+    Only new or changed documents are embedded, stale ids are deleted and the rest is reused.
+    Embeddings come from the SentenceTransformer in batches of batch_size, spread over
+    num_workers CPU processes when num_workers > 1.
+    A keyword_index is synced to the same documents.
+    """
+    logger.info("Setting up vector database...")
+    collection, embedding_model = get_or_create_collection(persist_directory, model_name, batch_size,
+                                                           collection_name)
 
-    # generate embeddings and add to vector database collection
-    collection.add( documents=texts, ids=ids, metadatas=metadatas)
-    print(f"Added {len(input_documents)} documents to vector database")
+    # Compare content hashes against what is already indexed
+    with span("index.diff", rows=len(input_documents)) as diff_span:
+        indexed_metadata = _get_indexed_metadata(collection)
+        changed_documents, changed_metadata = _diff_documents(input_documents, indexed_metadata, model_name)
+        current_ids = {doc['id'] for doc in input_documents}
+        stale_ids = [doc_id for doc_id in indexed_metadata if doc_id not in current_ids]
+        diff_span.set(indexed=len(indexed_metadata), changed=len(changed_documents),
+                      metadata_only=len(changed_metadata), stale=len(stale_ids))
+    logger.info(f"{len(indexed_metadata)} documents already indexed: {len(changed_documents)} new or changed, "
+                f"{len(changed_metadata)} with new metadata, {len(stale_ids)} stale")
 
+    # Remove documents that are no longer part of the dataset
+    delete_documents(collection, stale_ids)
+
+    # Embed and upsert only what changed, identical texts are embedded once
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache()
+    with embedding_pool(embedding_model, num_workers) as pool:
+        _write_documents(collection, embedding_model, changed_documents, changed_metadata, batch_size, pool,
+                         embedding_cache)
+    logger.info(f"Embedded {len(embedding_cache)} distinct texts")
+
+    if keyword_index is not None:
+        # synced on its own content hashes, so an index saved at another point catches up too
+        keyword_index.retain(current_ids.__contains__)
+        keyword_index.update(input_documents)
+
+    # a new index version whenever the indexed content changes, answer caches are keyed on it
+    if changed_documents or changed_metadata or stale_ids or get_index_version(collection) is None:
+        bump_index_version(collection)
+    indexed_count = collection.count()
+    current_span().set(rows=indexed_count)
+    logger.info(f"Vector database holds {indexed_count} documents")
+
+    return collection, embedding_model
+
+def index_document_batch(collection, embedding_model, documents, model_name=EMBEDDING_MODEL_NAME,
+                         batch_size=EMBEDDING_BATCH_SIZE, pool=None, keyword_index=None):
+    """
+    Sync one batch of documents into the collection, and the keyword index if given, leaving every
+    other indexed id alone. Only the ids of the batch are looked up, so memory is bounded by the batch size.
+    Returns the number of documents embedded and of documents whose metadata was updated.
+    """
+    with span("index.diff", rows=len(documents)):
+        indexed_metadata = _get_indexed_metadata(collection, ids=[doc['id'] for doc in documents])
+        changed_documents, changed_metadata = _diff_documents(documents, indexed_metadata, model_name)
+    _write_documents(collection, embedding_model, changed_documents, changed_metadata, batch_size, pool,
+                     EmbeddingCache())
+    if keyword_index is not None:
+        keyword_index.update(documents)
+    return len(changed_documents), len(changed_metadata)
+
+def delete_documents_except(collection, keep, keyword_index=None):
+    """
+    Delete every indexed document whose id keep(id) rejects, paging through the ids,
+    from the collection and the keyword index if given. Returns the number of deleted documents.
+    """
+    stale_ids = []
+    offset = 0
+    while True:
+        batch = collection.get(include=[], limit=INDEX_BATCH_SIZE, offset=offset)
+        if not batch['ids']:
+            break
+        stale_ids.extend(doc_id for doc_id in batch['ids'] if not keep(doc_id))
+        offset += len(batch['ids'])
+    delete_documents(collection, stale_ids)
+    if keyword_index is not None:
+        keyword_index.retain(keep)
+    return len(stale_ids)
+
+def open_vector_database(persist_directory=VECTOR_DB_PATH, model_name=EMBEDDING_MODEL_NAME,
+                         batch_size=EMBEDDING_BATCH_SIZE, collection_name=COLLECTION_NAME):
+    """
+    Open a prebuilt vector database for serving without any documents.
+    Returns (collection, embedding_model), or (None, None) when no non-empty index exists there.
+    The embedding model is loaded on the first query that needs it.
+    """
+    with span("index.open", path=persist_directory) as open_span:
+        client = chromadb.PersistentClient(path=persist_directory)
+        embedding_model = LazySentenceTransformer(model_name)
+        try:
+            collection = client.get_collection(
+                collection_name, embedding_function=HDBEmbeddingFunction(embedding_model, model_name, batch_size))
+        except (ValueError, NotFoundError):
+            return None, None
+        indexed_model = (collection.metadata or {}).get('embedding_model')
+        if indexed_model != model_name:
+            logger.warning(f"Index at {persist_directory} was built with {indexed_model}, not {model_name}")
+            return None, None
+        indexed_count = collection.count()
+        open_span.set(rows=indexed_count)
+    if not indexed_count:
+        return None, None
+    logger.info(f"Opened vector database with {indexed_count} documents at {persist_directory}")
     return collection, embedding_model
 
+class LazyQAPipeline:
+    """
+    transformers pipeline that is only imported and built on its first call
+    """
+
+    def __init__(self, task, **pipeline_kwargs):
+        self.task = task
+        self.pipeline_kwargs = pipeline_kwargs
+        self._pipeline = None
+
+    @property
+    def loaded(self):
+        return self._pipeline is not None
+
+    def load(self):
+        if self._pipeline is None:
+            with span("qa_pipeline.load", model=self.pipeline_kwargs.get('model')):
+                from transformers import pipeline
+                self._pipeline = pipeline(self.task, **self.pipeline_kwargs)
+            logger.info(f"Q&A pipeline loaded with {self.pipeline_kwargs.get('model')} model")
+        return self._pipeline
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
 def create_simple_qa_system(collection):
 
     #Create a simple Q&A pipeline/system
-    print("Setting up simple Q&A system...")
+    logger.info("Setting up simple Q&A system...")
 
-    # Use a free, lightweight language model
-    qa_pipeline = pipeline(
+    # Use a free, lightweight language model, loaded when the first answer is generated
+    qa_pipeline = LazyQAPipeline(
         "text2text-generation",
         model= "google/flan-t5-small",  # small and free model "microsoft/DialoGPT-medium"
         max_length=200,
@@ -95,94 +416,373 @@ def create_simple_qa_system(collection):
        # tokenizer="google/flan-t5-small",
         #device=-1  # use CPU; set to 0 if you have a compatible GPU
     )
-    print("Q&A pipeline initialized with microsoft/DialoGPT-medium model")
     return qa_pipeline
 
 
-def ask_hdb_question(question, collection, qa_pipeline=None, top_k=3):
+NO_INFORMATION_ANSWER = "I don't have information about that in my HDB database."
+
+def _format_retrieval_answer(count, avg_price, min_price, max_price, towns, flat_types, sold_dates,
+                             transactions=None):
+    # summary of the prices and labels of the retrieved documents,
+    # transactions is the number of sales behind them when the documents are summaries
+    source = (f"{count} relevant summaries of {transactions:,} HDB transactions" if transactions
+              else f"{count} relevant documents I found about HDB transactions")
+    return f"""Based on {source}:
+                        - Average price: ${avg_price:,.0f}
+                        - Price range: ${min_price:,.0f} - ${max_price:,.0f}
+                        - Locations: {', '.join(towns)}
+                        - Flat types: {', '.join(flat_types)}
+                        - Sold dates:{', '.join(sold_dates)}"""
+
+def _summarize_retrieved(metadatas):
+    # count-weighted price statistics of the retrieved documents, a transaction document counts as one sale.
+    # Only documents of the best hit's summary level are used so overlapping levels don't count a sale twice.
+    level = metadatas[0].get('level') if metadatas else None
+    prices, counts, min_prices, max_prices = [], [], [], []
+    towns, flat_types, sold_dates = [], [], []
+    for meta in metadatas:
+        if meta.get('level') != level:
+            continue
+        if meta.get('price') and float(meta.get('price', 0)) > 0:
+            prices.append(float(meta['price']))
+            counts.append(int(meta.get('count', 1)))
+            min_prices.append(float(meta.get('price_min', meta['price'])))
+            max_prices.append(float(meta.get('price_max', meta['price'])))
+        if meta.get('town'):
+            towns.append(meta['town'])
+        if meta.get('flat_type'):
+            flat_types.append(meta['flat_type'])
+        if meta.get('sold_date'):
+            sold_dates.append(meta['sold_date'])
+    if not prices:
+        return None
+    avg_price = sum(price * count for price, count in zip(prices, counts)) / sum(counts)
+    return _format_retrieval_answer(
+        len(prices), avg_price, min(min_prices), max(max_prices), list(dict.fromkeys(towns)),
+        list(dict.fromkeys(flat_types)), list(dict.fromkeys(sold_dates)), sum(counts) if level else None)
+
+def drill_down_transactions(question, summary_metadata, drill_down_collection, top_k=3):
     """
-    Answer questions about HDB data without using text generation model
+    Transactions behind a summary document most relevant to question, as a list of metadata dicts
     """
-    print(f"\n Question: {question}")
-    
-    # Step 1: Retrieve relevant documents
-    results = collection.query(query_texts=[question], n_results=top_k)
+    with span("index.drill_down", top_k=top_k) as drill_span:
+        results = drill_down_collection.query(query_texts=[question], n_results=top_k,
+                                              where=drill_down_filter(summary_metadata))
+        metadatas = results['metadatas'][0] if results['metadatas'] else []
+        drill_span.set(rows=len(metadatas))
+    return metadatas
+
+def _format_transactions(metadatas):
+    # one line per drilled-down transaction
+    return "\n".join(
+        f"                        - Block {meta.get('block', '')} {meta.get('street_name', '')}, {meta.get('flat_type', '')}:"
+        f" ${float(meta.get('price', 0)):,.0f} in {meta.get('sold_date', '')}"
+        for meta in metadatas)
+
+def build_metadata_filter(intent):
+    """
+    Chroma where clause restricting retrieval to the towns, flat types and dates of a parsed question,
+    None when the question names none of them
+    """
+    conditions = []
+    if intent['towns']:
+        conditions.append({'town': {'$in': intent['towns']}})
+    if intent['flat_types']:
+        conditions.append({'flat_type': {'$in': intent['flat_types']}})
+    if intent['month']:
+        year, month = intent['month'].split('-')
+        conditions.append({'year_month': int(year) * 100 + int(month)})
+    elif intent['years']:
+        conditions.append({'year': {'$in': intent['years']}})
+    else:
+        first_year, last_year = intent['year_range']
+        if first_year is not None:
+            conditions.append({'year': {'$gte': first_year}})
+        if last_year is not None:
+            conditions.append({'year': {'$lte': last_year}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+def hybrid_query(question, collection, keyword_index, top_k=3, where=None, candidates=HYBRID_CANDIDATES,
+                 rrf_k=RRF_K):
+    """
+    Vector and BM25 keyword retrieval fused with reciprocal rank fusion, in the collection's query result format.
+    Each retriever contributes its best candidates, a document scores 1 / (rrf_k + rank) per list it is in.
+    """
+    n_results = max(candidates, top_k)
+    with span("index.query", top_k=n_results, filtered=where is not None):
+        vector_results = collection.query(query_texts=[question], n_results=n_results, where=where,
+                                          include=["documents", "metadatas"])
+    ids, documents, metadatas = fuse_keyword_results(
+        question, collection, keyword_index, vector_results['ids'][0], vector_results['documents'][0],
+        vector_results['metadatas'][0], top_k, where, candidates, rrf_k)
+    return {'ids': [ids], 'documents': [documents], 'metadatas': [metadatas]}
+
+def fuse_keyword_results(question, collection, keyword_index, vector_ids, vector_documents, vector_metadatas,
+                         top_k=3, where=None, candidates=HYBRID_CANDIDATES, rrf_k=RRF_K):
+    """
+    (ids, documents, metadatas) of the top_k documents after fusing one question's vector results,
+    queried with max(candidates, top_k) results, with its BM25 keyword results
+    """
+    n_results = max(candidates, top_k)
+    keyword_results = keyword_index.search(question, n_results, where=where)
+
+    fused = {}
+    for ranked_ids in (vector_ids, [doc_id for doc_id, _ in keyword_results]):
+        for rank, doc_id in enumerate(ranked_ids, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+    best = sorted(fused, key=fused.get, reverse=True)[:top_k]
+
+    # keyword hits the vector query did not return are fetched by id
+    found = {doc_id: (document, meta) for doc_id, document, meta
+             in zip(vector_ids, vector_documents, vector_metadatas)}
+    missing = [doc_id for doc_id in best if doc_id not in found]
+    if missing:
+        with span("index.get", rows=len(missing)):
+            fetched = collection.get(ids=missing, include=["documents", "metadatas"])
+        found.update((doc_id, (document, meta)) for doc_id, document, meta
+                     in zip(fetched['ids'], fetched['documents'], fetched['metadatas']))
+    best = [doc_id for doc_id in best if doc_id in found]
+    return best, [found[doc_id][0] for doc_id in best], [found[doc_id][1] for doc_id in best]
+
+def _add_drill_down(answer, question, best_metadata, drill_down_collection):
+    # example transactions behind the best matching summary, when there is a drill-down tier
+    if drill_down_collection is None or not best_metadata.get('level'):
+        return answer
+    transactions = drill_down_transactions(question, best_metadata, drill_down_collection)
+    if transactions:
+        answer += "\n                        - Example transactions:\n" + _format_transactions(transactions)
+    return answer
+
+@traced("ask_hdb_question")
+def ask_hdb_question(question, collection, qa_pipeline=None, top_k=3, price_cube=None, use_filters=True,
+                     drill_down_collection=None, keyword_index=None, comps_index=None):
+    """
+    Answer questions about HDB data without using text generation model.
+    Statistical questions are answered exactly from the price cube when one is given,
+    everything else from the retrieved documents. With use_filters, retrieval only
+    searches documents matching the towns, flat types and dates named in the question.
+    When the collection holds summary documents and a drill_down_collection of transaction
+    documents is given, the answer lists example transactions behind the best summary.
+    With a keyword_index, vector and BM25 keyword results are fused with reciprocal rank fusion.
+    With a comps_index, questions describing a flat (floor area, storey, lease) are answered
+    with a price estimate from its most similar recent sales.
+    """
+    logger.info(f"Question: {question}")
+
+    # Step 0: Value a described flat from its comparable sales
+    if comps_index is not None:
+        answer = comps_index.answer_question(question)
+        if answer is not None:
+            current_span().set(source='comps')
+            logger.info(f"Answer: {answer}")
+            return answer
+
+    # Step 1: Answer statistical questions from the precomputed aggregates
+    if price_cube is not None:
+        answer = price_cube.answer_question(question)
+        if answer is not None:
+            current_span().set(source='price_cube')
+            logger.info(f"Answer: {answer}")
+            return answer
+
+    # Step 2: Retrieve relevant documents, narrowed by the entities in the question
+    with span("metadata_filter"):
+        where = build_metadata_filter(parse_question(question)) if use_filters else None
+    if keyword_index is not None:
+        results = hybrid_query(question, collection, keyword_index, top_k, where)
+    else:
+        with span("index.query", top_k=top_k, filtered=where is not None) as query_span:
+            results = collection.query(query_texts=[question], n_results=top_k, where=where)
+            query_span.set(rows=len(results['documents'][0]) if results['documents'] else 0)
+    current_span().set(source='hybrid_retrieval' if keyword_index is not None else 'retrieval')
     
     if results['documents'] and results['documents'][0]:
-        print(f"Found {len(results['documents'][0])} relevant documents")
-        
-        # Extract prices and info from metadata (this works!)
-        prices = []
-        towns = []
-        flat_types = []
-        sold_date = []
-        
-        for meta in results['metadatas'][0]:
-            if meta.get('price') and float(meta.get('price', 0)) > 0:
-                prices.append(float(meta['price']))
-            if meta.get('town'):
-                towns.append(meta['town'])
-            if meta.get('flat_type'):
-                flat_types.append(meta['flat_type'])
-            if meta.get('sold_date'):
-                sold_date.append(meta['sold_date'])
+        logger.info(f"Found {len(results['documents'][0])} relevant documents")
         
-        if prices:
-            avg_price = sum(prices) / len(prices)
-            min_price = min(prices)
-            max_price = max(prices)
-            unique_towns = list(set(towns))
-            unique_types = list(set(flat_types))
-            unique_dates = list(set(sold_date))
-            
-            answer = f"""Based on {len(prices)} relevant documents I found about HDB transactions:
-                        - Average price: ${avg_price:,.0f}
-                        - Price range: ${min_price:,.0f} - ${max_price:,.0f}
-                        - Locations: {', '.join(unique_towns)}
-                        - Flat types: {', '.join(unique_types)}
-                        - Sold dates:{', '.join(unique_dates)}"""
-            
-            print(f"Answer: {answer}")
+        # Extract prices and info from metadata (this works!), weighted by the sales a summary covers
+        metadatas = results['metadatas'][0]
+        answer = _summarize_retrieved(metadatas)
+        if answer is not None:
+            answer = _add_drill_down(answer, question, metadatas[0], drill_down_collection)
+            logger.info(f"Answer: {answer}")
             return answer
     
-    return "I don't have information about that in my HDB database."
+    return NO_INFORMATION_ANSWER
 
-def ask_hdb_question_txtgen(question, collection, qa_pipeline, top_k=3):
-    #Answer questions about HDB data
-    print(f"Answering question: {question}")
+@traced("ask_hdb_questions")
+def ask_hdb_questions(questions, collection, embedding_model=None, top_k=3, batch_size=64, price_cube=None,
+                      use_filters=True, comps_index=None, keyword_index=None, drill_down_collection=None):
+    """
+    Answer many questions in one pass, returning the answers in input order.
+    Questions are embedded in batches and sent to the index as batched queries, one query per
+    batch of questions sharing the same metadata filter; the price summaries are computed column-wise.
+    Without an embedding_model the collection embeds the query texts itself.
+    Questions describing a flat are valued from a comps_index when one is given.
+    keyword_index and drill_down_collection work as in ask_hdb_question, so both give the same answers:
+    each question's batched vector results are fused with its keyword results.
+    """
+    logger.info(f"Answering {len(questions)} questions in batches of {batch_size}...")
+    current_span().set(rows=len(questions))
+    answers = [None] * len(questions)
 
-    # Step 1: Retrieve relevant documents from vector database
-    results = collection.query(
-        query_texts=[question],
-        n_results=top_k)
-    
-    print(f"Retrieved {len(results['documents'][0])} documents")
-    #print(f"First document preview: {results['documents'][0][0][:200]}...")
-    
-    # Step 2: Combine retrieved documents into context
-    if results['documents'] and results['documents'][0]:
-        context = "\n\n".join(results['documents'][0])
-        print(f"Retrieved {len(results['documents'][0])} relevant documents from vector database")
+    # Step 0: described flats from their comparable sales, statistical questions from the precomputed aggregates
+    pending = []
+    with span("price_cube.answers", rows=len(questions)):
+        for i, question in enumerate(questions):
+            answer = comps_index.answer_question(question) if comps_index is not None else None
+            if answer is None and price_cube is not None:
+                answer = price_cube.answer_question(question)
+            if answer is None:
+                pending.append(i)
+            else:
+                answers[i] = answer
 
-        prompt= f""" Based on the HDB resale data provided, answer this question: {question}
-        HDB data:
-        {context[:1500]}  # limit context to first 1500 characters to avoid token limits
-        Answer:"""
+    # Step 1: group the remaining questions by metadata filter
+    groups = {}
+    with span("metadata_filter", rows=len(pending)):
+        for i in pending:
+            where = build_metadata_filter(parse_question(questions[i])) if use_filters else None
+            groups.setdefault(json.dumps(where, sort_keys=True), (where, []))[1].append(i)
 
-        # Step 4: Generate answer
-        try:
-            response = qa_pipeline(prompt, max_length=len(prompt.split()) + 50)
-            answer = response[0]['generated_text'][len(prompt):].strip()
-            
-            print(f"💡 Answer: {answer}")
-            return answer
-        except Exception as e:
-            # Simple fallback answer
-            avg_price = sum([float(meta.get('price', 0)) for meta in results['metadatas'][0]]) / len(results['metadatas'][0])
-            towns = [meta.get('town', '') for meta in results['metadatas'][0]]
-            fallback_answer = f"Based on the data I found, the HDB flats in {', '.join(set(towns))} have average resale price around ${avg_price:,.0f}."
-            print(f"💡 Answer: {fallback_answer}")
-            return fallback_answer
+    embeddings = None
+    if embedding_model is not None and pending:
+        embeddings = dict(zip(pending, embed_texts([questions[i] for i in pending], embedding_model,
+                                                     batch_size=batch_size)))
+
+    # Step 2: batched index queries, flattened into metadata columns
+    rows = []
+    best_metadata = {}
+    n_results = max(HYBRID_CANDIDATES, top_k) if keyword_index is not None else top_k
+    include = ["documents", "metadatas"] if keyword_index is not None else ["metadatas"]
+    for where, indices in groups.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            with span("index.query", rows=len(chunk), top_k=n_results, filtered=where is not None):
+                if embeddings is not None:
+                    results = collection.query(query_embeddings=[embeddings[i] for i in chunk], n_results=n_results,
+                                               where=where, include=include)
+                else:
+                    results = collection.query(query_texts=[questions[i] for i in chunk], n_results=n_results,
+                                               where=where, include=include)
+            for position, i in enumerate(chunk):
+                metadatas = results['metadatas'][position]
+                if keyword_index is not None:
+                    _, _, metadatas = fuse_keyword_results(
+                        questions[i], collection, keyword_index, results['ids'][position],
+                        results['documents'][position], metadatas, top_k, where)
+                if metadatas:
+                    best_metadata[i] = metadatas[0]
+                rows.extend((i, meta.get('level', ''), meta.get('price'), meta.get('count', 1),
+                             meta.get('price_min', meta.get('price')), meta.get('price_max', meta.get('price')),
+                             meta.get('town'), meta.get('flat_type'), meta.get('sold_date'))
+                            for meta in metadatas)
+
+    # Step 3: per-question summaries in one groupby, weighted by the sales a summary document covers
+    if rows:
+        found = pd.DataFrame(rows, columns=['question', 'level', 'price', 'count', 'price_min', 'price_max',
+                                            'town', 'flat_type', 'sold_date'])
+        # only the best hit's summary level, overlapping levels would count a sale twice
+        found = found[found['level'] == found.groupby('question')['level'].transform('first')]
+        for column in ('price', 'count', 'price_min', 'price_max'):
+            found[column] = pd.to_numeric(found[column], errors='coerce')
+        priced = found[found['price'] > 0].assign(weighted=lambda rows: rows['price'] * rows['count'])
+        summaries = priced.groupby('question').agg(
+            documents=('price', 'size'), transactions=('count', 'sum'), weighted=('weighted', 'sum'),
+            min=('price_min', 'min'), max=('price_max', 'max'), level=('level', 'first'))
+        labels = found.groupby('question')[['town', 'flat_type', 'sold_date']].agg(
+            lambda values: [value for value in pd.unique(values.dropna()) if value])
+        summaries = summaries.join(labels)
+        for i, summary in summaries.iterrows():
+            answers[i] = _format_retrieval_answer(
+                int(summary['documents']), summary['weighted'] / summary['transactions'], summary['min'],
+                summary['max'], summary['town'], summary['flat_type'], summary['sold_date'],
+                int(summary['transactions']) if summary['level'] else None)
+            answers[i] = _add_drill_down(answers[i], questions[i], best_metadata[i], drill_down_collection)
+
+    logger.info(f"Answered {len(questions)} questions: {len(questions) - len(pending)} from the price cube, "
+                f"{len(pending)} from {len(groups)} filtered retrieval groups")
+    return [answer if answer is not None else NO_INFORMATION_ANSWER for answer in answers]
+
+NO_CONTEXT_ANSWER = "I'm sorry, I couldn't find relevant information to answer your question."
+
+def retrieve_for_generation(question, collection, top_k, use_filters, keyword_index=None):
+    """
+    Documents and metadata retrieved for a question, most relevant first
+    """
+    where = build_metadata_filter(parse_question(question)) if use_filters else None
+    if keyword_index is not None:
+        results = hybrid_query(question, collection, keyword_index, top_k, where)
     else:
-        print("No relevant data found")
-        return "I'm sorry, I couldn't find relevant information to answer your question."
+        with span("index.query", top_k=top_k, filtered=where is not None):
+            results = collection.query(query_texts=[question], n_results=top_k, where=where)
+    if not results['documents'] or not results['documents'][0]:
+        return [], []
+    return results['documents'][0], results['metadatas'][0]
+
+def _fallback_answer(metadatas):
+    # Simple fallback answer when text generation is unavailable
+    avg_price = sum([float(meta.get('price', 0)) for meta in metadatas]) / len(metadatas)
+    towns = [meta.get('town', '') for meta in metadatas]
+    return f"Based on the data I found, the HDB flats in {', '.join(set(towns))} have average resale price around ${avg_price:,.0f}."
+
+@traced("ask_hdb_questions_txtgen")
+def ask_hdb_questions_txtgen(questions, collection, qa_pipeline, top_k=5, use_filters=True, keyword_index=None,
+                             batch_size=GENERATION_BATCH_SIZE, max_new_tokens=GENERATION_MAX_NEW_TOKENS):
+    """
+    Answer questions with the text generation model, returning the answers in input order.
+    Each prompt packs the question's retrieved documents, most relevant first and without duplicates,
+    by tokenizer token count into the model's input; batch_size prompts share one generate call.
+    """
+    logger.info(f"Generating answers to {len(questions)} questions...")
+    answers = [NO_CONTEXT_ANSWER] * len(questions)
+
+    # Step 1: Retrieve relevant documents from vector database, narrowed by the entities in the question
+    retrieved = [retrieve_for_generation(question, collection, top_k, use_filters, keyword_index)
+                 for question in questions]
+    pending = [i for i, (documents, _) in enumerate(retrieved) if documents]
+    logger.info(f"Retrieved documents for {len(pending)} of {len(questions)} questions")
+    if not pending:
+        return answers
+
+    # Step 2: Pack the documents into prompts and generate the answers in batches
+    try:
+        _, tokenizer = model_and_tokenizer(qa_pipeline)
+        with span("pack_context", rows=len(pending)):
+            prompts = [build_prompt(questions[i], retrieved[i][0], tokenizer) for i in pending]
+        texts, _ = generate_texts(qa_pipeline, prompts, max_new_tokens=max_new_tokens, batch_size=batch_size)
+        for i, text in zip(pending, texts):
+            answers[i] = text
+    except Exception as e:
+        logger.warning(f"Text generation failed ({e}), using fallback answers")
+        for i in pending:
+            answers[i] = _fallback_answer(retrieved[i][1])
+    return answers
+
+@traced("ask_hdb_question_txtgen")
+def ask_hdb_question_txtgen(question, collection, qa_pipeline, top_k=5, use_filters=True, keyword_index=None):
+    #Answer questions about HDB data with the text generation model
+    logger.info(f"Answering question: {question}")
+    answer = ask_hdb_questions_txtgen([question], collection, qa_pipeline, top_k, use_filters, keyword_index)[0]
+    logger.info(f"Answer: {answer}")
+    return answer
+
+def stream_hdb_answer_txtgen(question, collection, qa_pipeline, top_k=5, use_filters=True, keyword_index=None,
+                             max_new_tokens=GENERATION_MAX_NEW_TOKENS):
+    """
+    Generate the answer to a question piece by piece, for showing it while it is written
+    """
+    documents, metadatas = retrieve_for_generation(question, collection, top_k, use_filters, keyword_index)
+    if not documents:
+        yield NO_CONTEXT_ANSWER
+        return
+    try:
+        _, tokenizer = model_and_tokenizer(qa_pipeline)
+        yield from stream_text(qa_pipeline, build_prompt(question, documents, tokenizer), max_new_tokens)
+    except Exception as e:
+        logger.warning(f"Text generation failed ({e}), using fallback answer")
+        yield _fallback_answer(metadatas)
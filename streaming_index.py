@@ -0,0 +1,191 @@
+import glob
+import json
+import logging
+import os
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from get_hdb_data import iter_hdb_csv_chunks
+from hdb_data_cache import raw_data_cache_key
+from hdb_price_cube import HDBPriceCube, PRICE_CUBE_COLUMNS
+from hdb_comps import ComparablesIndex, COMPS_COLUMNS
+from preprocessing_hdb_data import preprocessing_hdb_dataframe
+from rag_setup import (iter_rag_document_batches, get_or_create_collection, index_document_batch,
+                       delete_documents_except, bump_index_version, get_index_version,
+                       VECTOR_DB_PATH, EMBEDDING_MODEL_NAME)
+from embedding import embedding_pool, EMBEDDING_BATCH_SIZE
+from tracing import current_span, span, traced
+
+logger = logging.getLogger(__name__)
+
+STREAMING_CHUNK_SIZE = 50000
+CHECKPOINT_FILENAME = "ingest_checkpoint.json"
+# parquet parts holding the price cube and comparables columns of every indexed chunk
+SNAPSHOT_COLUMNS_FOLDER = "snapshot_columns"
+SNAPSHOT_COLUMNS = list(dict.fromkeys(COMPS_COLUMNS + PRICE_CUBE_COLUMNS))
+SNAPSHOT_TEXT_COLUMNS = ['town', 'flat_type', 'block', 'street_name']
+
+
+def _new_checkpoint(key):
+    # rows indexed so far and their snapshot column parts per csv file, in the order the files are read
+    return {'key': key, 'files': {}, 'changed': 0}
+
+
+def _load_checkpoint(path, key):
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return _new_checkpoint(key)
+    if checkpoint.get('key') != key:
+        logger.info("Raw files or embedding model changed since the last checkpoint, reading all files")
+        return _new_checkpoint(key)
+    if any('parts' not in progress for progress in checkpoint['files'].values()):
+        logger.info("Checkpoint has no snapshot column parts, reading all files")
+        return _new_checkpoint(key)
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+def _write_snapshot_part(cleaned_chunk, first_row, columns_folder):
+    # the chunk's cube and comparables columns, text as categoricals, named by its first row
+    part = f"part-{first_row:012d}.parquet"
+    columns = cleaned_chunk[SNAPSHOT_COLUMNS]
+    columns = columns.assign(**{column: columns[column].astype('category') for column in SNAPSHOT_TEXT_COLUMNS})
+    columns.to_parquet(os.path.join(columns_folder, part), index=False)
+    return part
+
+
+def _row_id_below(total_rows):
+    # document ids are hdb_<row>, rows at or past total_rows no longer exist
+    def keep(doc_id):
+        row = doc_id[4:] if doc_id.startswith("hdb_") else ""
+        return row.isdigit() and int(row) < total_rows
+    return keep
+
+
+@traced("index_hdb_csv_streaming")
+def index_hdb_csv_streaming(data_folder, persist_directory=VECTOR_DB_PATH, chunk_size=STREAMING_CHUNK_SIZE,
+                            model_name=EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE, num_workers=0,
+                            keyword_index=None):
+    """
+    Index every row of the csv files in data_folder without loading them all at once.
+    Each chunk of chunk_size rows is read, preprocessed, turned into documents, embedded and upserted
+    before the next one is read, so memory is bounded by the chunk size rather than the data size.
+    Progress is checkpointed after every chunk and an interrupted run resumes after the last indexed chunk
+    without reading the rows before it again. A keyword_index is updated with the same documents.
+    The columns the price cube and comparables need are written to a parquet part per chunk,
+    build_streamed_snapshot builds both from them. Returns (collection, embedding_model).
+    """
+    csv_files = sorted(glob.glob(os.path.join(data_folder, "*.csv")))
+    if not csv_files:
+        raise ValueError(f"No csv files found in {data_folder}")
+
+    collection, embedding_model = get_or_create_collection(persist_directory, model_name, batch_size)
+    checkpoint_path = os.path.join(persist_directory, CHECKPOINT_FILENAME)
+    checkpoint = _load_checkpoint(checkpoint_path, f"{raw_data_cache_key(csv_files)}:{model_name}")
+    checkpointed_rows = sum(progress['rows'] for progress in checkpoint['files'].values())
+    if checkpointed_rows > collection.count():
+        # the index was rebuilt or pruned since the checkpoint was written
+        logger.info("Index holds fewer documents than checkpointed, reading all files")
+        checkpoint = _new_checkpoint(checkpoint['key'])
+    elif keyword_index is not None and checkpointed_rows > keyword_index.count():
+        # the keyword index is saved at the end of a run, an interrupted run lost its updates;
+        # reading the files again embeds nothing that is already in the collection
+        logger.info("Keyword index holds fewer documents than checkpointed, reading all files")
+        checkpoint = _new_checkpoint(checkpoint['key'])
+
+    # parts of a chunk interrupted before the checkpoint was saved, or of an earlier checkpoint
+    columns_folder = os.path.join(persist_directory, SNAPSHOT_COLUMNS_FOLDER)
+    os.makedirs(columns_folder, exist_ok=True)
+    recorded_parts = {part for progress in checkpoint['files'].values() for part in progress['parts']}
+    for part_path in glob.glob(os.path.join(columns_folder, "part-*.parquet")):
+        if os.path.basename(part_path) not in recorded_parts:
+            os.remove(part_path)
+
+    offset = 0
+    with embedding_pool(embedding_model, num_workers) as pool:
+        for file in csv_files:
+            progress = checkpoint['files'].setdefault(os.path.basename(file),
+                                                      {'rows': 0, 'complete': False, 'parts': []})
+            if progress['complete']:
+                logger.info(f"{file} already indexed ({progress['rows']} rows)")
+                offset += progress['rows']
+                continue
+            if progress['rows']:
+                logger.info(f"Resuming {file} after {progress['rows']} indexed rows")
+
+            for chunk in iter_hdb_csv_chunks(file, chunk_size, first_row=progress['rows'], start_index=offset):
+                with span("streaming.chunk", rows=len(chunk), file=os.path.basename(file)):
+                    cleaned_chunk = preprocessing_hdb_dataframe(chunk)
+                    embedded = updated = 0
+                    for documents in iter_rag_document_batches(cleaned_chunk):
+                        batch_embedded, batch_updated = index_document_batch(
+                            collection, embedding_model, documents, model_name, batch_size, pool, keyword_index)
+                        embedded += batch_embedded
+                        updated += batch_updated
+                    progress['parts'].append(_write_snapshot_part(cleaned_chunk, chunk.index[0], columns_folder))
+                progress['rows'] += len(chunk)
+                checkpoint['changed'] += embedded + updated
+                _save_checkpoint(checkpoint_path, checkpoint)
+                logger.info(f"Indexed rows {chunk.index[0]}-{chunk.index[-1]} "
+                            f"of {file}: {embedded} embedded, {updated} with new metadata")
+
+            progress['complete'] = True
+            offset += progress['rows']
+            _save_checkpoint(checkpoint_path, checkpoint)
+
+    # rows beyond the end of the data belong to files that shrank or were removed
+    deleted = delete_documents_except(collection, _row_id_below(offset), keyword_index)
+    if checkpoint['changed'] or deleted or get_index_version(collection) is None:
+        bump_index_version(collection)
+        checkpoint['changed'] = 0
+        _save_checkpoint(checkpoint_path, checkpoint)
+
+    indexed_count = collection.count()
+    current_span().set(rows=offset, indexed=indexed_count, deleted=deleted)
+    logger.info(f"Streamed {offset} rows from {len(csv_files)} files, vector database holds {indexed_count} documents")
+    return collection, embedding_model
+
+
+def load_streamed_columns(persist_directory=VECTOR_DB_PATH):
+    """
+    The price cube and comparables columns of every row indexed by index_hdb_csv_streaming as one dataframe,
+    read from the parts its checkpoint records
+    """
+    with open(os.path.join(persist_directory, CHECKPOINT_FILENAME)) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    parts = [part for progress in checkpoint['files'].values() for part in progress.get('parts', [])]
+    if not parts:
+        raise ValueError(f"No streamed rows recorded in {persist_directory}")
+    columns_folder = os.path.join(persist_directory, SNAPSHOT_COLUMNS_FOLDER)
+    with span("streaming.read_columns", parts=len(parts)) as read_span:
+        frames = [pd.read_parquet(os.path.join(columns_folder, part)) for part in parts]
+        # parts have their own categories, union them instead of falling back to strings
+        compact_df = pd.DataFrame({
+            column: (union_categoricals([frame[column] for frame in frames]) if column in SNAPSHOT_TEXT_COLUMNS
+                     else pd.concat([frame[column] for frame in frames], ignore_index=True))
+            for column in SNAPSHOT_COLUMNS
+        })
+        read_span.set(rows=len(compact_df))
+    return compact_df
+
+
+@traced("snapshot.build_streaming")
+def build_streamed_snapshot(persist_directory=VECTOR_DB_PATH):
+    """
+    (price cube, comparables index) over every row indexed by index_hdb_csv_streaming.
+    Exact medians and percentiles need every price, so this reads the compact columns of all rows,
+    about 65 bytes per row, but never the csv files.
+    """
+    compact_df = load_streamed_columns(persist_directory)
+    current_span().set(rows=len(compact_df))
+    logger.info(f"Building the price cube and comparables from {len(compact_df)} rows "
+                f"({compact_df.memory_usage(deep=True).sum() / 1024 / 1024:.1f} MB)")
+    return HDBPriceCube.from_dataframe(compact_df), ComparablesIndex.from_dataframe(compact_df)
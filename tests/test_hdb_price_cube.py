@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hdb_price_cube import HDBPriceCube, GROUPING_SETS, PERCENTILES
+
+
+def _sales(n_rows=3000, seed=7):
+    # rows in random order so groups first appear out of sorted order
+    rng = np.random.default_rng(seed)
+    towns = np.array(['YISHUN', 'BEDOK', 'WOODLANDS', 'ANG MO KIO'])
+    flat_types = np.array(['5 ROOM', '2 ROOM', '4 ROOM', '3 ROOM'])
+    months = pd.date_range("2012-01-01", "2014-12-01", freq="MS")
+    town = rng.integers(len(towns), size=n_rows)
+    flat_type = rng.integers(len(flat_types), size=n_rows)
+    floor_area = 40.0 + 25 * flat_type + rng.normal(0, 5, n_rows)
+    return pd.DataFrame({
+        'town': pd.Categorical(towns[town]),
+        'flat_type': pd.Categorical(flat_types[flat_type]),
+        'month': months[rng.integers(len(months), size=n_rows)],
+        'floor_area_sqm': floor_area,
+        'resale_price': np.round(floor_area * (4000 + 500 * town) + rng.normal(0, 20000, n_rows), -2),
+    })
+
+
+@pytest.mark.parametrize("dims", [dims for dims in GROUPING_SETS if dims])
+def test_percentiles_match_direct_groupby(dims):
+    df = _sales()
+    cube = HDBPriceCube.from_dataframe(df)
+    work = df.assign(year=df['month'].dt.year, month=df['month'].dt.strftime('%Y-%m'),
+                     town=df['town'].astype(str), flat_type=df['flat_type'].astype(str))
+    expected = work.groupby(list(dims))['resale_price'].quantile([p / 100 for p in PERCENTILES]).unstack()
+    for key, row in expected.iterrows():
+        cell = dict(zip(dims, key if isinstance(key, tuple) else (key,)))
+        for p in PERCENTILES:
+            value = cube.lookup(cell.get('town'), cell.get('flat_type'), cell.get('year'), cell.get('month'),
+                                statistic=f"p{p}")
+            assert value == pytest.approx(row[p / 100]), (cell, p)
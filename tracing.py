@@ -0,0 +1,214 @@
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Set to a file path to export every span as a JSON line
+TRACE_FILE_ENV_VAR = "REALTORAI_TRACE_FILE"
+
+
+def current_rss_bytes():
+    """
+    Resident set size of this process, from /proc on linux and the rusage high-water mark elsewhere
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSSMonitor:
+    """
+    Samples the process RSS in a background thread and keeps the peak seen while active
+    """
+
+    def __init__(self, interval_seconds=0.01):
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+            self._stop.wait(self.interval_seconds)
+
+    def __enter__(self):
+        self.peak_bytes = current_rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, current_rss_bytes())
+
+
+class _NoopSpan:
+    # returned when tracing is off so instrumented code pays for one attribute check
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    One timed stage or sub-step: duration, row count, RSS delta and free-form attributes
+    """
+
+    def __init__(self, tracer, name, rows, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.rows = rows
+        self.attributes = attributes
+        self.span_id = next(tracer._ids)
+        self.parent_id = None
+        self.depth = 0
+
+    def set(self, rows=None, **attributes):
+        """
+        Record the row count or extra attributes once they are known inside the span
+        """
+        if rows is not None:
+            self.rows = rows
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        if stack:
+            self.parent_id = stack[-1].span_id
+            self.depth = len(stack)
+        stack.append(self)
+        self._start_rss = current_rss_bytes()
+        self._start_wall = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = time.perf_counter() - self._start
+        self.tracer._stack().pop()
+        record = {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'depth': self.depth,
+            'start': self._start_wall,
+            'duration_ms': round(duration * 1000, 3),
+            'rows': self.rows,
+            'rss_delta_mb': round((current_rss_bytes() - self._start_rss) / 1024 / 1024, 2),
+            'pid': os.getpid(),
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.attributes)
+        self.tracer._finish(record)
+        return False
+
+
+class Tracer:
+    """
+    Creates spans and sends finished span records to a JSON lines file and to active collectors.
+    Spans cost nearly nothing while neither is enabled.
+    """
+
+    def __init__(self, trace_file=None):
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = None
+        self.trace_file = None
+        if trace_file:
+            self.configure(trace_file)
+
+    def configure(self, trace_file):
+        """
+        Export spans to trace_file (appending), or stop exporting when trace_file is None
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(trace_file, "a", buffering=1) if trace_file else None
+            self.trace_file = trace_file
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _collectors(self):
+        return getattr(self._local, 'collectors', None)
+
+    def span(self, name, rows=None, **attributes):
+        """
+        Context manager timing the enclosed block as a span named name
+        """
+        if self._file is None and not self._collectors():
+            return _NOOP_SPAN
+        return Span(self, name, rows, attributes)
+
+    def current_span(self):
+        """
+        Innermost open span of this thread, a no-op span when there is none
+        """
+        stack = self._stack()
+        return stack[-1] if stack else _NOOP_SPAN
+
+    def traced(self, name):
+        """
+        Decorator running the whole function inside a span named name
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def collect(self):
+        """
+        Collect the span records finished in this thread while the block runs, even when export is off
+        """
+        if getattr(self._local, 'collectors', None) is None:
+            self._local.collectors = []
+        records = []
+        self._local.collectors.append(records)
+        try:
+            yield records
+        finally:
+            self._local.collectors.remove(records)
+
+    def _finish(self, record):
+        for records in self._collectors() or ():
+            records.append(record)
+        if self._file is not None:
+            line = json.dumps(record, default=str)
+            with self._lock:
+                if self._file is not None:
+                    self._file.write(line + "\n")
+
+
+tracer = Tracer(os.environ.get(TRACE_FILE_ENV_VAR))
+span = tracer.span
+traced = tracer.traced
+current_span = tracer.current_span
+collect_spans = tracer.collect
+configure_tracing = tracer.configure